@@ -0,0 +1,97 @@
+"""Microbenchmark of `TemplateV2.extract_all` against the previous field-by-field `extract`, per completion.
+
+    python benchmarks/bench_template_extract.py
+"""
+
+import timeit
+
+import dsp
+import dspy
+from dsp.templates.template_v2 import TemplateV2
+
+
+def baseline_extract(template, example, raw_pred):
+    """`TemplateV2.extract` before it parsed each completion in a single pass, kept verbatim for comparison."""
+    example = dsp.Example(example)
+
+    raw_pred = raw_pred.strip()
+
+    idx = 0
+    while idx < len(template.fields):
+        if (
+            template.fields[idx].input_variable not in example
+            or example[template.fields[idx].input_variable] is None
+        ):
+            break
+        idx += 1
+
+    idx = min(idx, len(template.fields) - 1)
+    while raw_pred != "" and idx < len(template.fields):
+        if idx < len(template.fields) - 1:
+            next_field_name = "\n" + template.fields[idx + 1].name
+            offset = raw_pred.find(next_field_name)
+
+            if offset >= 0:
+                if dspy.settings.release >= 20231003:
+                    example[template.fields[idx].output_variable] = raw_pred[:offset].strip().rstrip('---').strip()
+                    raw_pred = raw_pred[offset + len(next_field_name) :].strip().rstrip('---').strip()
+                else:
+                    example[template.fields[idx].output_variable] = raw_pred[:offset].strip()
+                    raw_pred = raw_pred[offset + len(next_field_name) :].strip()
+
+                idx += 1
+            else:
+                if dspy.settings.release >= 20231003:
+                    example[template.fields[idx].output_variable] = raw_pred.strip().rstrip('---').strip()
+                else:
+                    example[template.fields[idx].output_variable] = raw_pred.strip()
+
+                raw_pred = ""
+                idx += 1
+                break
+
+        else:
+            assert idx == len(template.fields) - 1, (idx, len(template.fields))
+
+            if dspy.settings.release >= 20231003:
+                example[template.fields[idx].output_variable] = raw_pred.strip().rstrip('---').strip()
+            else:
+                example[template.fields[idx].output_variable] = raw_pred.strip()
+
+            break
+
+    return example
+
+
+TEMPLATE = ("Answer questions.\n\nContext: {context} ${the passages}\n\nQuestion: {question} ${the question}\n\n"
+            "Reasoning: {rationale} ${produce the answer}\n\nAnswer: {answer} ${a short answer}")
+
+COMPLETIONS = {
+    "short": "produce the answer. We know that the capital is Paris.\nAnswer: Paris",
+    "long": "produce the answer. " + "Some lengthy reasoning about the passages. " * 40 + "\nAnswer: Paris\n\n---",
+}
+
+
+def main(num_completions=20, number=500, repeat=5):
+    template = TemplateV2(TEMPLATE)
+    example = dict(context="some passages " * 50, question="what is it?")
+
+    for release in [0, 20231003]:
+        with dspy.settings.context(release=release):
+            for name, text in COMPLETIONS.items():
+                completions = [text] * num_completions
+
+                expected = [baseline_extract(template, example, c) for c in completions]
+                assert template.extract_all(example, completions) == expected
+
+                baseline = min(timeit.repeat(lambda: [baseline_extract(template, example, c) for c in completions],
+                                             number=number, repeat=repeat)) / number
+                single_pass = min(timeit.repeat(lambda: template.extract_all(example, completions),
+                                                number=number, repeat=repeat)) / number
+
+                print(f"release={release:<8} {name:5} x{num_completions}: baseline {baseline * 1e6:7.1f}us  "
+                      f"extract_all {single_pass * 1e6:7.1f}us  ({baseline / single_pass:.2f}x)")
+
+
+if __name__ == "__main__":
+    main()
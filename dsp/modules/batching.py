@@ -0,0 +1,110 @@
+import asyncio
+import threading
+import concurrent.futures
+
+from typing import Any, Awaitable, Callable, Hashable
+
+
+class MicroBatcher:
+    """Coalesces concurrent single-item calls into batched calls.
+
+    Items submitted from any thread or event loop are grouped by `key(item)`. A group is dispatched as one
+    call to `batch_fn(items)` once it holds `max_batch_size` items, or `window` seconds after its first item
+    arrived, whichever comes first. `batch_fn` is a coroutine function returning one result per item, in
+    order. A result may be an exception, which is then raised to that item's caller only.
+
+    Batches run on a private event loop thread, so HTTP sessions opened by `batch_fn` stay alive across batches.
+    """
+
+    def __init__(
+        self,
+        batch_fn: Callable[[list], Awaitable[list]],
+        key: Callable[[Any], Hashable] = None,
+        max_batch_size: int = 16,
+        window: float = 0.005,
+    ):
+        self.batch_fn = batch_fn
+        self.key = key
+        self.max_batch_size = max_batch_size
+        self.window = window
+
+        self.num_items = 0
+        self.num_batches = 0
+
+        self._loop = None
+        self._pending = {}
+        self._tasks = set()
+        self._lock = threading.Lock()
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    threading.Thread(target=loop.run_forever, name="dsp-micro-batcher", daemon=True).start()
+                    self._loop = loop
+
+        return self._loop
+
+    def submit(self, item) -> concurrent.futures.Future:
+        future = concurrent.futures.Future()
+        self._ensure_loop().call_soon_threadsafe(self._enqueue, item, future)
+        return future
+
+    def __call__(self, item):
+        return self.submit(item).result()
+
+    async def acall(self, item):
+        return await asyncio.wrap_future(self.submit(item))
+
+    def _enqueue(self, item, future):
+        key = self.key(item) if self.key else None
+        batch = self._pending.setdefault(key, [])
+        batch.append((item, future))
+
+        if len(batch) >= self.max_batch_size:
+            self._flush(key, batch)
+        elif len(batch) == 1:
+            self._loop.call_later(self.window, self._flush, key, batch)
+
+    def _flush(self, key, batch):
+        # The timer of a batch that was already flushed for being full must not flush its successor.
+        if self._pending.get(key) is not batch:
+            return
+
+        del self._pending[key]
+
+        # The loop only keeps weak references to tasks: an unreferenced dispatch could be collected mid-flight,
+        # leaving its callers waiting forever.
+        task = self._loop.create_task(self._dispatch(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    def __deepcopy__(self, memo):
+        # Copies of a client (e.g., made by `Module.deepcopy`) keep feeding the same dispatcher.
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.update(_loop=None, _pending={}, _tasks=set(), _lock=None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    async def _dispatch(self, batch):
+        self.num_items += len(batch)
+        self.num_batches += 1
+
+        try:
+            results = await self.batch_fn([item for item, _ in batch])
+            assert len(results) == len(batch), (len(results), len(batch))
+        except Exception as e:
+            results = [e] * len(batch)
+
+        for (_, future), result in zip(batch, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
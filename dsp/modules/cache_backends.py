@@ -0,0 +1,684 @@
+import os
+import sys
+import time
+import pickle
+import hashlib
+import inspect
+import sqlite3
+import asyncio
+import threading
+import functools
+import weakref
+
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from joblib import Memory, hash as joblib_hash
+from joblib.func_inspect import filter_args, get_func_name
+
+from dsp.utils import dotdict
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+class Fingerprint(str):
+    """A precomputed cache key. Cached functions take it as their first argument so no tier re-hashes the request."""
+    pass
+
+
+def _feed(hasher, value):
+    """Feeds a canonical, type-tagged encoding of `value` into `hasher` without building an intermediate string."""
+    if value is None:
+        hasher.update(b"N")
+
+    elif isinstance(value, bool):
+        hasher.update(b"T" if value else b"F")
+
+    elif isinstance(value, int):
+        hasher.update(b"n%d;" % value)
+
+    elif isinstance(value, float):
+        # 1.0 and 0.7000000000000001 should map to the same key as 1 and 0.7. Ints are hashed exactly, so that
+        # large seeds, timestamps or token ids never collide.
+        value = float(f"{value:.12g}")
+        hasher.update(b"n%d;" % value if value.is_integer() else b"n%r;" % value)
+
+    elif isinstance(value, str):
+        value = value.encode("utf-8")
+        hasher.update(b"s%d:" % len(value))
+        hasher.update(value)
+
+    elif isinstance(value, dict):
+        hasher.update(b"d%d:" % len(value))
+        # Keys are fed with their type tag, so that {1: x} and {"1": x} differ.
+        for key in sorted(value, key=lambda key: (type(key).__name__, str(key))):
+            _feed(hasher, key)
+            _feed(hasher, value[key])
+
+    elif isinstance(value, (list, tuple)):
+        hasher.update(b"l%d:" % len(value))
+        for item in value:
+            _feed(hasher, item)
+
+    else:
+        raise TypeError(f"Cannot fingerprint a value of type {type(value)}")
+
+
+def request_fingerprint(**request) -> Fingerprint:
+    """Returns a canonical key for a request: sorted keys, normalized numbers, and a fast hash over the prompt."""
+    hasher = xxhash.xxh3_128() if xxhash is not None else hashlib.sha1(usedforsecurity=False)
+    _feed(hasher, request)
+
+    return Fingerprint(hasher.hexdigest())
+
+
+class _Abandoned(Exception):
+    """Set on a flight whose leader was cancelled, so that its followers try again themselves."""
+
+
+class Flights:
+    """The calls of cached functions currently in progress, by namespace and key.
+
+    Of concurrent callers that miss the cache on the same key, the first (the leader) makes the call while the
+    others (followers) wait on its future. Followers get the leader's result or exception, though if the leader was
+    cancelled they look the key up again and one of them takes over.
+    """
+
+    def __init__(self):
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.num_coalesced = 0
+
+    def join(self, flight) -> tuple[Future, bool]:
+        """Returns the future of `flight` and whether the caller is its leader."""
+        with self._lock:
+            future = self._futures.get(flight)
+
+            if future is None:
+                future = self._futures[flight] = Future()
+                future.leader = threading.get_ident()
+                return future, True
+
+            self.num_coalesced += 1
+            return future, False
+
+    def land(self, flight, future: Future, value=None, error: BaseException = None):
+        with self._lock:
+            del self._futures[flight]
+
+        if error is None:
+            future.set_result(value)
+        else:
+            future.set_exception(error if isinstance(error, Exception) else _Abandoned())
+
+    def _after_fork(self):
+        # Reset in place, as the wrappers of cached functions hold on to this object. The leaders of the calls in
+        # flight stayed behind in the parent process, so their followers in a forked child would wait forever.
+        self._futures = {}
+        self._lock = threading.Lock()
+
+
+class CacheRecorder:
+    """Collects the `(backend, namespace, key)` of every cache entry read or written while it is active.
+
+    Use it as a context manager. Calls from all threads are recorded, see `dsp.modules.cache_bundle`.
+    """
+
+    def __init__(self):
+        self.touched = set()
+
+    def __enter__(self):
+        with _recorders_lock:
+            _recorders.append(self)
+        return self
+
+    def __exit__(self, *exc):
+        with _recorders_lock:
+            _recorders.remove(self)
+
+
+_recorders = []
+_recorders_lock = threading.Lock()
+
+# Backends with state that a forked child process (e.g. a worker of `Evaluate(executor="process",
+# mp_context="fork")`) must not inherit, see `_after_fork`.
+_forkable = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+    for backend in list(_forkable):
+        backend._after_fork()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def _touch(backend, namespace, key):
+    if not backend.persistent:
+        return
+
+    for recorder in _recorders:
+        recorder.touched.add((backend, namespace, str(key)))
+
+
+class CacheBackend:
+    """Base class for the cache tiers behind `CacheMemory`, `NotebookCacheMemory` and `MemoCache`.
+
+    Subclasses implement `get`, `set` and `stats`. The `cache` decorator mirrors `joblib.Memory.cache`,
+    so call sites can swap backends without changing how they are decorated.
+    """
+
+    # Whether entries outlive the process. Only those of persistent tiers are recorded by a `CacheRecorder`.
+    persistent = True
+
+    def get(self, namespace: str, key: str):
+        """Returns a `(hit, value)` pair."""
+        raise NotImplementedError
+
+    def set(self, namespace: str, key: str, value) -> None:
+        raise NotImplementedError
+
+    def stats(self) -> dotdict:
+        raise NotImplementedError
+
+    def clear(self) -> None:
+        raise NotImplementedError
+
+    def items(self):
+        """Yields a `(namespace, key, value)` triple for every entry."""
+        raise NotImplementedError
+
+    def _lookup(self, namespace, key):
+        # While recording, in-process tiers let calls through, so that the entries they would have served are read,
+        # and recorded, from the persistent tiers behind them.
+        if _recorders and not self.persistent:
+            return False, None
+
+        return self.get(namespace, key)
+
+    def _after_fork(self):
+        flights = self.__dict__.get("_flights")
+
+        if flights is not None:
+            flights._after_fork()
+
+    def namespace(self, func, name=None) -> str:
+        module, func_name = get_func_name(func)
+        return os.path.join(*module, name or func_name)
+
+    def make_key(self, func, ignore, args, kwargs) -> str:
+        if args and isinstance(args[0], Fingerprint):
+            return args[0]
+
+        filtered = filter_args(func, ignore, args, kwargs)
+
+        try:
+            return request_fingerprint(**filtered)
+        except TypeError:
+            return joblib_hash(filtered)
+
+    @property
+    def flights(self) -> Flights:
+        if "_flights" not in self.__dict__:
+            self.__dict__.setdefault("_flights", Flights())
+            _forkable.add(self)
+
+        return self.__dict__["_flights"]
+
+    def cache(self, func=None, ignore=None, name=None):
+        """Decorates `func` so that its results are looked up in (and stored to) this backend.
+
+        Coroutine functions are supported too. Passing the `name` of a synchronous function makes an async
+        implementation share its cache entries (the two must take the same arguments).
+
+        Concurrent calls that miss on the same key are made once (see `Flights`), including calls to a synchronous
+        function and its async twin.
+        """
+        if func is None:
+            return functools.partial(self.cache, ignore=ignore, name=name)
+
+        ignore = list(ignore or [])
+        namespace = self.namespace(func, name)
+        flights = self.flights
+
+        if inspect.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                key = self.make_key(func, ignore, args, kwargs)
+
+                while True:
+                    hit, value = self._lookup(namespace, key)
+
+                    if hit:
+                        _touch(self, namespace, key)
+                        return value
+
+                    future, leader = flights.join((namespace, key))
+
+                    if leader:
+                        break
+
+                    try:
+                        return await asyncio.wrap_future(future)
+                    except _Abandoned:
+                        continue
+
+                try:
+                    value = await func(*args, **kwargs)
+                    self.set(namespace, key, value)
+                    _touch(self, namespace, key)
+                except BaseException as e:
+                    flights.land((namespace, key), future, error=e)
+                    raise
+
+                flights.land((namespace, key), future, value)
+                return value
+
+            wrapper = async_wrapper
+
+        else:
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key = self.make_key(func, ignore, args, kwargs)
+
+                while True:
+                    hit, value = self._lookup(namespace, key)
+
+                    if hit:
+                        _touch(self, namespace, key)
+                        return value
+
+                    future, leader = flights.join((namespace, key))
+
+                    if leader:
+                        break
+
+                    # A coroutine leading on this very thread cannot finish while we block it.
+                    if future.leader == threading.get_ident():
+                        return func(*args, **kwargs)
+
+                    try:
+                        return future.result()
+                    except _Abandoned:
+                        continue
+
+                try:
+                    value = func(*args, **kwargs)
+                    self.set(namespace, key, value)
+                    _touch(self, namespace, key)
+                except BaseException as e:
+                    flights.land((namespace, key), future, error=e)
+                    raise
+
+                flights.land((namespace, key), future, value)
+                return value
+
+        def check_call_in_cache(*args, **kwargs):
+            return self.get(namespace, self.make_key(func, ignore, args, kwargs))[0]
+
+        def store(value, *args, **kwargs):
+            """Records `value` as the result of calling the function with `args` and `kwargs`."""
+            key = self.make_key(func, ignore, args, kwargs)
+            self.set(namespace, key, value)
+            _touch(self, namespace, key)
+
+        wrapper.check_call_in_cache = check_call_in_cache
+        wrapper.store = store
+        wrapper.func = func
+
+        return wrapper
+
+
+class JoblibCache(CacheBackend):
+    """One pickle per entry under `location`, in the directory layout of `joblib.Memory`.
+
+    Entries are keyed by `request_fingerprint` rather than by joblib's hash of the arguments, so entries written by
+    `joblib.Memory` itself (e.g. caches from before the cache backends) are not found: those calls are made again.
+    """
+
+    def __init__(self, location: str):
+        self.memory = Memory(location=location, verbose=0)
+        self.store = self.memory.store_backend
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, namespace, key):
+        try:
+            value = self.store.load_item([namespace, key], verbose=0)
+        except (KeyError, OSError, EOFError, pickle.UnpicklingError):
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        return True, value
+
+    def set(self, namespace, key, value):
+        self.store.dump_item([namespace, key], value, verbose=0)
+
+    def stats(self):
+        return dotdict(backend="joblib", hits=self.hits, misses=self.misses, evictions=0, expirations=0)
+
+    def clear(self):
+        self.memory.clear(warn=False)
+
+    def items(self):
+        # Entries live at <location>/<namespace>/<key>/output.pkl, and namespaces may span several directories.
+        root = self.store.location
+
+        for dirpath, _, filenames in os.walk(root):
+            if "output.pkl" not in filenames:
+                continue
+
+            namespace, key = os.path.split(os.path.relpath(dirpath, root))
+
+            try:
+                value = self.store.load_item([namespace, key], verbose=0)
+            except (KeyError, OSError, EOFError, pickle.UnpicklingError):
+                continue
+
+            yield namespace, key, value
+
+
+class ShardedSQLiteCache(CacheBackend):
+    """A size-bounded cache spread over `num_shards` SQLite databases in WAL mode.
+
+    Each shard holds a single table of pickled values. Entries are evicted least-recently-used first once a
+    shard exceeds its share of `max_bytes` or `max_entries`, and entries older than `ttl` seconds are treated
+    as misses. Writers from several threads (or processes) only contend on the shard they touch.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            namespace TEXT NOT NULL,
+            key TEXT NOT NULL,
+            value BLOB NOT NULL,
+            size INTEGER NOT NULL,
+            created REAL NOT NULL,
+            accessed REAL NOT NULL,
+            PRIMARY KEY (namespace, key)
+        ) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed);
+    """
+
+    def __init__(self, location: str, num_shards: int = 16, max_bytes: int = None, max_entries: int = None,
+                 ttl: float = None):
+        self.location = location
+        self.num_shards = num_shards
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+        os.makedirs(location, exist_ok=True)
+
+        self._shards = [None] * num_shards
+        self._locks = [threading.Lock() for _ in range(num_shards)]
+        self._sizes = [None] * num_shards
+        self._counter_lock = threading.Lock()
+
+        _forkable.add(self)
+
+    def _after_fork(self):
+        # SQLite connections must not be used across a fork: the child reopens its own.
+        super()._after_fork()
+
+        self._shards = [None] * self.num_shards
+        self._locks = [threading.Lock() for _ in range(self.num_shards)]
+        self._sizes = [None] * self.num_shards
+        self._counter_lock = threading.Lock()
+
+    def _shard(self, key: str) -> int:
+        return int(key[:8], 16) % self.num_shards
+
+    def _connect(self, idx: int) -> sqlite3.Connection:
+        conn = self._shards[idx]
+
+        if conn is None:
+            path = os.path.join(self.location, f"shard-{idx:03d}.sqlite3")
+            conn = sqlite3.connect(path, timeout=60, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(self.SCHEMA)
+
+            self._shards[idx] = conn
+            self._sizes[idx] = list(conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone())
+
+        return conn
+
+    def _count(self, name: str, amount: int = 1):
+        with self._counter_lock:
+            setattr(self, name, getattr(self, name) + amount)
+
+    def get(self, namespace, key):
+        idx = self._shard(key)
+        now = time.time()
+
+        with self._locks[idx]:
+            conn = self._connect(idx)
+            row = conn.execute(
+                "SELECT value, size, created FROM entries WHERE namespace = ? AND key = ?", (namespace, key)
+            ).fetchone()
+
+            if row is not None and self.ttl is not None and row[2] < now - self.ttl:
+                conn.execute("DELETE FROM entries WHERE namespace = ? AND key = ?", (namespace, key))
+                self._sizes[idx][0] -= 1
+                self._sizes[idx][1] -= row[1]
+                self._count("expirations")
+                row = None
+
+            if row is None:
+                self._count("misses")
+                return False, None
+
+            conn.execute("UPDATE entries SET accessed = ? WHERE namespace = ? AND key = ?", (now, namespace, key))
+
+        self._count("hits")
+        return True, pickle.loads(row[0])
+
+    def set(self, namespace, key, value):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        idx = self._shard(key)
+        now = time.time()
+
+        with self._locks[idx]:
+            conn = self._connect(idx)
+            old = conn.execute("SELECT size FROM entries WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (namespace, key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?, ?)",
+                (namespace, key, blob, len(blob), now, now),
+            )
+
+            if old is None:
+                self._sizes[idx][0] += 1
+            self._sizes[idx][1] += len(blob) - (old[0] if old else 0)
+
+            self._enforce_limits(idx, conn, now)
+
+    def _enforce_limits(self, idx: int, conn: sqlite3.Connection, now: float):
+        max_entries = self.max_entries and max(1, self.max_entries // self.num_shards)
+        max_bytes = self.max_bytes and max(1, self.max_bytes // self.num_shards)
+        count, size = self._sizes[idx]
+
+        if not ((max_entries and count > max_entries) or (max_bytes and size > max_bytes)):
+            return
+
+        # Other processes may share this shard, so re-read the true totals before deleting anything.
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.ttl is not None:
+                expired = conn.execute("DELETE FROM entries WHERE created < ?", (now - self.ttl,)).rowcount
+                self._count("expirations", max(0, expired))
+
+            count, size = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+
+            # Evict down to 90% of the limits so that we don't pay for this on every subsequent insert.
+            evicted = 0
+            rows = conn.execute("SELECT namespace, key, size FROM entries ORDER BY accessed ASC")
+            victims = []
+            for namespace, key, entry_size in rows:
+                if not ((max_entries and count > 0.9 * max_entries) or (max_bytes and size > 0.9 * max_bytes)):
+                    break
+                victims.append((namespace, key))
+                count -= 1
+                size -= entry_size
+
+            if victims:
+                conn.executemany("DELETE FROM entries WHERE namespace = ? AND key = ?", victims)
+                evicted = len(victims)
+
+            conn.execute("COMMIT")
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+        self._sizes[idx] = [count, size]
+        self._count("evictions", evicted)
+
+    def stats(self):
+        entries, size = 0, 0
+        for idx in range(self.num_shards):
+            with self._locks[idx]:
+                self._connect(idx)
+                entries += self._sizes[idx][0]
+                size += self._sizes[idx][1]
+
+        return dotdict(backend="sqlite", hits=self.hits, misses=self.misses, evictions=self.evictions,
+                       expirations=self.expirations, entries=entries, bytes=size,
+                       max_entries=self.max_entries, max_bytes=self.max_bytes, ttl=self.ttl)
+
+    def clear(self):
+        for idx in range(self.num_shards):
+            with self._locks[idx]:
+                self._connect(idx).execute("DELETE FROM entries")
+                self._sizes[idx] = [0, 0]
+
+    def items(self):
+        oldest = time.time() - self.ttl if self.ttl is not None else float("-inf")
+
+        for idx in range(self.num_shards):
+            last = ("", "")
+
+            # Page through the shard by primary key, so neither the whole shard nor its lock is held at once.
+            while True:
+                with self._locks[idx]:
+                    rows = self._connect(idx).execute(
+                        "SELECT namespace, key, value, created FROM entries WHERE (namespace, key) > (?, ?) "
+                        "ORDER BY namespace, key LIMIT 256",
+                        last,
+                    ).fetchall()
+
+                if not rows:
+                    break
+
+                for namespace, key, blob, created in rows:
+                    if created >= oldest:
+                        yield namespace, key, pickle.loads(blob)
+
+                last = rows[-1][:2]
+
+
+class MemoryCache(CacheBackend):
+    """An in-process LRU tier bounded by both entry count and (approximate, pickled) size in bytes.
+
+    It replaces `functools.lru_cache(maxsize=None)` in front of the persistent caches, so that long-running
+    processes keep only the hottest responses in memory.
+    """
+
+    persistent = False
+
+    def __init__(self, max_bytes: int = None, max_entries: int = None):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+        _forkable.add(self)
+
+    def _after_fork(self):
+        super()._after_fork()
+        self._lock = threading.Lock()
+
+    def namespace(self, func, name=None) -> str:
+        return f"{func.__module__}.{name or func.__qualname__}"
+
+    def _sizeof(self, value) -> int:
+        try:
+            return len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        except Exception:
+            return sys.getsizeof(value)
+
+    def get(self, namespace, key):
+        with self._lock:
+            entry = self._entries.get((namespace, key))
+
+            if entry is None:
+                self.misses += 1
+                return False, None
+
+            self._entries.move_to_end((namespace, key))
+            self.hits += 1
+
+            return True, entry[0]
+
+    def set(self, namespace, key, value):
+        size = self._sizeof(value)
+
+        if self.max_bytes is not None and size > self.max_bytes:
+            return
+
+        with self._lock:
+            old = self._entries.pop((namespace, key), None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            self._entries[(namespace, key)] = (value, size)
+            self.bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self._entries and (
+            (self.max_entries is not None and len(self._entries) > self.max_entries)
+            or (self.max_bytes is not None and self.bytes > self.max_bytes)
+        ):
+            _, (_, size) = self._entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+
+    def resize(self, max_bytes: int = None, max_entries: int = None):
+        """Changes the limits in place, evicting entries right away if needed."""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self.max_entries = max_entries
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            return dotdict(backend="memory", hits=self.hits, misses=self.misses, evictions=self.evictions,
+                           entries=len(self._entries), bytes=self.bytes,
+                           max_entries=self.max_entries, max_bytes=self.max_bytes)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def items(self):
+        with self._lock:
+            entries = list(self._entries.items())
+
+        for (namespace, key), (value, _) in entries:
+            yield namespace, key, value
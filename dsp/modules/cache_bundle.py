@@ -0,0 +1,220 @@
+"""Cache bundles: the LM/RM cache entries of a run in a single file, to warm up or replay from on another machine.
+
+A bundle is a gzip-compressed stream of pickles: a header, then one `(tier, namespace, key, value)` record per
+entry, then an end marker. `tier` names the persistent cache the entry belongs to (see `cache_tiers`), 'disk' or
+'notebook'. While recording, the in-memory tier lets calls through to them, so a warm process records the same
+entries as a cold one.
+
+    with record_cache() as recorder:
+        program.forward(...)
+
+    export_cache_bundle("run.dspcache", recorder)
+    import_cache_bundle("run.dspcache")  # elsewhere
+
+Also available as `python -m dsp.modules.cache_bundle {record,export,import,merge,info}`. Bundles contain pickles,
+so only import those you trust.
+"""
+
+import os
+import sys
+import gzip
+import time
+import pickle
+import runpy
+import argparse
+import collections
+
+from dsp.utils import dotdict
+from dsp.modules.cache_backends import CacheRecorder
+from dsp.modules.cache_utils import cache_tiers
+
+
+BUNDLE_FORMAT = "dsp-cache-bundle"
+BUNDLE_VERSION = 1
+
+_END = "end"
+
+
+def record_cache() -> CacheRecorder:
+    """Returns a context manager that records the cache entries read or written while it is active."""
+    return CacheRecorder()
+
+
+def _persistent_tiers() -> dict:
+    return {name: tier for name, tier in cache_tiers().items() if tier.persistent}
+
+
+def _entries(recorder=None, tiers=None):
+    tiers = {name: tier for name, tier in _persistent_tiers().items() if tiers is None or name in tiers}
+    names = {id(tier): name for name, tier in tiers.items()}
+
+    if recorder is None:
+        for name, tier in tiers.items():
+            for namespace, key, value in tier.items():
+                yield name, namespace, key, value
+
+        return
+
+    for backend, namespace, key in sorted(recorder.touched, key=lambda t: (names.get(id(t[0]), ""), t[1], t[2])):
+        if id(backend) not in names:
+            continue
+
+        hit, value = backend.get(namespace, key)
+
+        if hit:
+            yield names[id(backend)], namespace, key, value
+
+
+def _write(path, entries) -> dotdict:
+    counts = collections.Counter()
+    partial = f"{path}.tmp-{os.getpid()}"
+
+    # Written next to the target and renamed into place, so readers never see half a bundle.
+    with gzip.open(partial, "wb") as f:
+        pickle.dump(dict(format=BUNDLE_FORMAT, version=BUNDLE_VERSION, created=time.time()), f)
+
+        for tier, namespace, key, value in entries:
+            pickle.dump((tier, namespace, key, value), f, protocol=pickle.HIGHEST_PROTOCOL)
+            counts[tier] += 1
+
+        pickle.dump(_END, f)
+
+    os.replace(partial, path)
+
+    return dotdict(entries=sum(counts.values()), tiers=dict(counts))
+
+
+def read_cache_bundle(path):
+    """Yields the `(tier, namespace, key, value)` entries of the bundle at `path`."""
+    with gzip.open(path, "rb") as f:
+        header = pickle.load(f)
+
+        if not isinstance(header, dict) or header.get("format") != BUNDLE_FORMAT:
+            raise ValueError(f"{path} is not a cache bundle.")
+
+        if header["version"] > BUNDLE_VERSION:
+            raise ValueError(f"{path} is a version {header['version']} cache bundle, newer than this version of "
+                             f"DSPy supports ({BUNDLE_VERSION}).")
+
+        while True:
+            try:
+                entry = pickle.load(f)
+            except (EOFError, pickle.UnpicklingError):
+                # Cut off between entries or in the middle of one.
+                raise ValueError(f"{path} is truncated.") from None
+
+            if entry == _END:
+                return
+
+            yield entry
+
+
+def export_cache_bundle(path, recorder: CacheRecorder = None, tiers=None) -> dotdict:
+    """Writes the entries `recorder` saw, or else every cached entry, to a bundle at `path`.
+
+    `tiers` restricts the export to 'disk' or 'notebook'. Returns the number of entries per tier.
+    """
+    return _write(path, _entries(recorder, tiers))
+
+
+def import_cache_bundle(path, overwrite: bool = False) -> dotdict:
+    """Adds the entries of the bundle at `path` to the caches, keeping existing entries unless `overwrite`.
+
+    Entries of tiers that are not enabled here (e.g. 'notebook' without DSP_NOTEBOOK_CACHEDIR) or not persistent
+    are skipped.
+    """
+    tiers = _persistent_tiers()
+    counts = dotdict(imported=0, existing=0, skipped=0)
+
+    for tier, namespace, key, value in read_cache_bundle(path):
+        if tier not in tiers:
+            counts.skipped += 1
+            continue
+
+        if not overwrite and tiers[tier].get(namespace, key)[0]:
+            counts.existing += 1
+            continue
+
+        tiers[tier].set(namespace, key, value)
+        counts.imported += 1
+
+    return counts
+
+
+def merge_cache_bundles(path, *paths) -> dotdict:
+    """Writes the entries of the bundles at `paths` to a bundle at `path`. Later bundles win on conflicts."""
+
+    def entries():
+        seen = set()
+
+        for path_ in reversed(paths):
+            for tier, namespace, key, value in read_cache_bundle(path_):
+                if (tier, namespace, key) not in seen:
+                    seen.add((tier, namespace, key))
+                    yield tier, namespace, key, value
+
+    return _write(path, entries())
+
+
+def cache_bundle_info(path) -> dotdict:
+    """Returns the header of the bundle at `path` and its number of entries per tier and namespace."""
+    with gzip.open(path, "rb") as f:
+        header = pickle.load(f)
+
+    namespaces = collections.Counter((tier, namespace) for tier, namespace, _, _ in read_cache_bundle(path))
+
+    return dotdict(header, entries=sum(namespaces.values()),
+                   namespaces={f"{tier}:{namespace}": n for (tier, namespace), n in sorted(namespaces.items())})
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m dsp.modules.cache_bundle", description=__doc__.split("\n")[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="run a script and export the cache entries it used")
+    record.add_argument("bundle")
+    record.add_argument("script")
+    record.add_argument("args", nargs=argparse.REMAINDER)
+
+    export = commands.add_parser("export", help="export every entry of the local caches")
+    export.add_argument("bundle")
+    export.add_argument("--tier", action="append", choices=["disk", "notebook"])
+
+    import_ = commands.add_parser("import", help="import bundles into the local caches")
+    import_.add_argument("bundles", nargs="+")
+    import_.add_argument("--overwrite", action="store_true")
+
+    merge = commands.add_parser("merge", help="merge bundles into one, later ones winning on conflicts")
+    merge.add_argument("bundle")
+    merge.add_argument("bundles", nargs="+")
+
+    info = commands.add_parser("info", help="describe a bundle")
+    info.add_argument("bundle")
+
+    args = parser.parse_args(argv)
+
+    if args.command == "record":
+        sys.argv = [args.script, *args.args]
+
+        with record_cache() as recorder:
+            try:
+                runpy.run_path(args.script, run_name="__main__")
+            finally:
+                print(export_cache_bundle(args.bundle, recorder))
+
+    elif args.command == "export":
+        print(export_cache_bundle(args.bundle, tiers=args.tier))
+
+    elif args.command == "import":
+        for bundle in args.bundles:
+            print(bundle, import_cache_bundle(bundle, overwrite=args.overwrite))
+
+    elif args.command == "merge":
+        print(merge_cache_bundles(args.bundle, *args.bundles))
+
+    elif args.command == "info":
+        print(cache_bundle_info(args.bundle))
+
+
+if __name__ == "__main__":
+    main()
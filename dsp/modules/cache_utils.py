@@ -1,10 +1,12 @@
 import os
+import inspect
 
 from pathlib import Path
-from joblib import Memory
 from functools import wraps
 
 from dsp.utils import dotdict
+from dsp.modules.cache_backends import CacheBackend, JoblibCache, ShardedSQLiteCache, MemoryCache, Fingerprint, \
+    request_fingerprint
 
 
 cache_turn_on = True
@@ -12,10 +14,16 @@ cache_turn_on = True
 
 def noop_decorator(arg=None, *noop_args, **noop_kwargs):
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            return func
+
         @wraps(func)
         def wrapper(*args, **kwargs):
             return func(*args, **kwargs)
 
+        wrapper.check_call_in_cache = lambda *args, **kwargs: False
+        wrapper.store = lambda value, *args, **kwargs: None
+
         return wrapper
 
     if callable(arg):
@@ -24,15 +32,51 @@ def noop_decorator(arg=None, *noop_args, **noop_kwargs):
         return decorator
 
 
+def _env_number(name, cast=int):
+    value = os.environ.get(name)
+    return cast(value) if value else None
+
+
+# `DSP_CACHE_BACKEND` selects the persistent store behind every `@CacheMemory.cache` call site:
+#   - "joblib" (default): one pickle per entry, unbounded. Keys differ from those of `joblib.Memory`, so caches
+#     written before the cache backends existed are not read.
+#   - "sqlite": sharded SQLite databases in WAL mode, bounded by DSP_CACHE_MAX_BYTES / DSP_CACHE_MAX_ENTRIES,
+#     with LRU eviction and an optional DSP_CACHE_TTL (in seconds).
+cache_backend = os.environ.get('DSP_CACHE_BACKEND', 'joblib')
+cache_num_shards = _env_number('DSP_CACHE_SHARDS') or 16
+cache_max_bytes = _env_number('DSP_CACHE_MAX_BYTES') or 10 * 2**30
+cache_max_entries = _env_number('DSP_CACHE_MAX_ENTRIES')
+cache_ttl = _env_number('DSP_CACHE_TTL', float)
+
+# The in-process tier in front of the persistent cache, bounded by DSP_MEMO_MAX_BYTES / DSP_MEMO_MAX_ENTRIES.
+memo_max_bytes = _env_number('DSP_MEMO_MAX_BYTES') or 512 * 2**20
+memo_max_entries = _env_number('DSP_MEMO_MAX_ENTRIES') or 100_000
+
+
+def create_cache_memory(location, backend=None):
+    backend = backend or cache_backend
+
+    if backend == 'joblib':
+        return JoblibCache(location)
+
+    if backend == 'sqlite':
+        return ShardedSQLiteCache(os.path.join(location, 'sqlite'), num_shards=cache_num_shards,
+                                  max_bytes=cache_max_bytes, max_entries=cache_max_entries, ttl=cache_ttl)
+
+    raise ValueError(f"Unknown cache backend: {backend}. Expected 'joblib' or 'sqlite'.")
+
+
 cachedir = os.environ.get('DSP_CACHEDIR') or os.path.join(Path.home(), 'cachedir_joblib')
-CacheMemory = Memory(location=cachedir, verbose=0)
+CacheMemory = create_cache_memory(cachedir)
 
 cachedir2 = os.environ.get('DSP_NOTEBOOK_CACHEDIR')
 NotebookCacheMemory = dotdict()
 NotebookCacheMemory.cache = noop_decorator
 
 if cachedir2:
-    NotebookCacheMemory = Memory(location=cachedir2, verbose=0)
+    NotebookCacheMemory = create_cache_memory(cachedir2)
+
+MemoCache = MemoryCache(max_bytes=memo_max_bytes, max_entries=memo_max_entries)
 
 
 if not cache_turn_on:
@@ -41,3 +85,21 @@ if not cache_turn_on:
 
     NotebookCacheMemory = dotdict()
     NotebookCacheMemory.cache = noop_decorator
+
+    MemoCache = dotdict()
+    MemoCache.cache = noop_decorator
+
+
+def cache_tiers() -> dict:
+    """Returns the enabled cache tiers by name: 'memory' (in-process), 'disk' and 'notebook'."""
+    tiers = dict(memory=MemoCache, disk=CacheMemory, notebook=NotebookCacheMemory)
+    return {name: tier for name, tier in tiers.items() if isinstance(tier, CacheBackend)}
+
+
+def cache_stats():
+    """Returns the counters of the in-memory tier and of the persistent cache(s).
+
+    `coalesced` counts the calls that missed while an identical one was in progress, and waited for its result.
+    """
+    return dotdict({name: dotdict(tier.stats(), coalesced=tier.flights.num_coalesced)
+                    for name, tier in cache_tiers().items()})
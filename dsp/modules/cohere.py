@@ -1,8 +1,9 @@
 import math
-from typing import Any, Optional
+from typing import Optional
 import backoff
 
-from dsp.modules.lm import LM
+from dsp.modules.lm import LM, History
+from dsp.modules.rate_limiter import throttle, estimate_tokens
 
 try:
     import cohere
@@ -68,7 +69,7 @@ class Cohere(LM):
         self.stop_sequences = stop_sequences
         self.max_num_generations = 5
 
-        self.history: list[dict[str, Any]] = []
+        self.history = History()
 
     def basic_request(self, prompt: str, **kwargs):
         raw_kwargs = kwargs
@@ -78,7 +79,8 @@ class Cohere(LM):
             "prompt": prompt,
             **kwargs,
         }
-        response = self.co.generate(**kwargs)
+        with throttle(estimate_tokens(prompt, kwargs["max_tokens"], kwargs["num_generations"])):
+            response = self.co.generate(**kwargs)
 
         history = {
             "prompt": prompt,
@@ -1,8 +1,7 @@
-import functools
 from typing import Optional, Union, Any
-import requests
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, MemoCache
+from dsp.modules.http_pool import http_pool
 from dsp.utils import dotdict
 
 
@@ -42,14 +41,14 @@ def colbertv2_get_request_v2(url: str, query: str, k: int):
     ), "Only k <= 100 is supported for the hosted ColBERTv2 server at the moment."
 
     payload = {"query": query, "k": k}
-    res = requests.get(url, params=payload, timeout=10)
+    res = http_pool.get(url, params=payload, timeout=10)
 
     topk = res.json()["topk"][:k]
     topk = [{**d, "long_text": d["text"]} for d in topk]
     return topk[:k]
 
 
-@functools.lru_cache(maxsize=None)
+@MemoCache.cache
 @NotebookCacheMemory.cache
 def colbertv2_get_request_v2_wrapped(*args, **kwargs):
     return colbertv2_get_request_v2(*args, **kwargs)
@@ -62,12 +61,12 @@ colbertv2_get_request = colbertv2_get_request_v2_wrapped
 def colbertv2_post_request_v2(url: str, query: str, k: int):
     headers = {"Content-Type": "application/json; charset=utf-8"}
     payload = {"query": query, "k": k}
-    res = requests.post(url, json=payload, headers=headers, timeout=10)
+    res = http_pool.post(url, json=payload, headers=headers, timeout=10)
 
     return res.json()["topk"][:k]
 
 
-@functools.lru_cache(maxsize=None)
+@MemoCache.cache
 @NotebookCacheMemory.cache
 def colbertv2_post_request_v2_wrapped(*args, **kwargs):
     return colbertv2_post_request_v2(*args, **kwargs)
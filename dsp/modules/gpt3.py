@@ -1,14 +1,30 @@
 import functools
-import json
-from typing import Any, Literal, Optional, cast
+from typing import Any, Iterator, Literal, Optional, cast
 
 import backoff
 import openai
 import openai.error
 from openai.openai_object import OpenAIObject
 
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
-from dsp.modules.lm import LM
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, MemoCache, Fingerprint, request_fingerprint
+from dsp.modules.lm import LM, History
+from dsp.modules.rate_limiter import throttle, athrottle, estimate_tokens
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+@functools.lru_cache(maxsize=None)
+def _tiktoken_encoding(model: str):
+    if tiktoken is None:
+        return None
+
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return None
 
 
 def backoff_hdlr(details):
@@ -20,6 +36,21 @@ def backoff_hdlr(details):
     )
 
 
+_OPENAI_CLIENT_SETTINGS = ("api_key", "api_base", "api_type", "api_version", "organization")
+
+
+def openai_client_settings() -> dict:
+    """The openai client's module-level configuration, which `GPT3.__init__` sets and pickled LMs do not carry."""
+    return {name: getattr(openai, name, None) for name in _OPENAI_CLIENT_SETTINGS}
+
+
+def configure_openai_client(client_settings: dict):
+    """Applies `openai_client_settings()` taken in another process, e.g. in the workers of `Evaluate`."""
+    for name, value in client_settings.items():
+        if value is not None:
+            setattr(openai, name, value)
+
+
 class GPT3(LM):
     """Wrapper around OpenAI's GPT API. Supports both the OpenAI and Azure APIs.
 
@@ -73,7 +104,16 @@ class GPT3(LM):
         
         if api_provider != "azure":
             self.kwargs["model"] = model
-        self.history: list[dict[str, Any]] = []
+        self.history = History()
+
+    def count_tokens(self, text: str) -> int:
+        """Counts with the model's tiktoken encoding when tiktoken is installed and knows the model."""
+        encoding = _tiktoken_encoding(self.kwargs.get("model", ""))
+
+        if encoding is None:
+            return super().count_tokens(text)
+
+        return len(encoding.encode(text, disallowed_special=()))
 
     def _openai_client():
         return openai
@@ -83,16 +123,34 @@ class GPT3(LM):
 
         kwargs = {**self.kwargs, **kwargs}
         if self.model_type == "chat":
-            # caching mechanism requires hashable kwargs
             kwargs["messages"] = [{"role": "user", "content": prompt}]
-            kwargs = {
-                "stringify_request": json.dumps(kwargs)
-            }
-            response = cached_gpt3_turbo_request(**kwargs)
-            
+            response = cached_gpt3_turbo_request(request_fingerprint(**kwargs), kwargs)
+
         else:
             kwargs["prompt"] = prompt
-            response = cached_gpt3_request(**kwargs)
+            response = cached_gpt3_request(request_fingerprint(**kwargs), kwargs)
+
+        history = {
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
+        return response
+
+    async def abasic_request(self, prompt: str, **kwargs) -> OpenAIObject:
+        raw_kwargs = kwargs
+
+        kwargs = {**self.kwargs, **kwargs}
+        if self.model_type == "chat":
+            kwargs["messages"] = [{"role": "user", "content": prompt}]
+            response = await acached_gpt3_turbo_request(request_fingerprint(**kwargs), kwargs)
+
+        else:
+            kwargs["prompt"] = prompt
+            response = await acached_gpt3_request(request_fingerprint(**kwargs), kwargs)
 
         history = {
             "prompt": prompt,
@@ -117,6 +175,72 @@ class GPT3(LM):
         
         return self.basic_request(prompt, **kwargs)
 
+    @backoff.on_exception(
+        backoff.expo,
+        (openai.error.RateLimitError, openai.error.ServiceUnavailableError, openai.error.APIError),
+        max_time=1000,
+        on_backoff=backoff_hdlr,
+    )
+    async def arequest(self, prompt: str, **kwargs) -> OpenAIObject:
+        """Asynchronous `request`, sharing its cache, history and retry policy."""
+        if "model_type" in kwargs:
+            del kwargs["model_type"]
+
+        return await self.abasic_request(prompt, **kwargs)
+
+    def stream(self, prompt: str, **kwargs) -> Iterator[str]:
+        """Yields the text of a single completion of `prompt` as it is generated.
+
+        A cached completion is yielded whole. Streamed completions are written to the persistent cache when done.
+        """
+        raw_kwargs = kwargs
+
+        kwargs = {**self.kwargs, **kwargs, "n": 1}
+        if self.model_type == "chat":
+            kwargs["messages"] = [{"role": "user", "content": prompt}]
+            cached_request, create = _cached_gpt3_turbo_request_v3, openai.ChatCompletion.create
+        else:
+            kwargs["prompt"] = prompt
+            cached_request, create = cached_gpt3_request_v3, openai.Completion.create
+
+        fingerprint = request_fingerprint(**kwargs)
+
+        if cached_request.check_call_in_cache(fingerprint, kwargs):
+            response = cached_request(fingerprint, kwargs)
+            yield self._get_choice_text(response["choices"][0])
+
+        else:
+            text, finish_reason = "", None
+
+            with throttle(_request_tokens(kwargs)):
+                for chunk in create(**kwargs, stream=True):
+                    if not chunk["choices"]:
+                        continue
+
+                    choice = chunk["choices"][0]
+                    delta = choice["delta"].get("content") if self.model_type == "chat" else choice["text"]
+                    finish_reason = choice.get("finish_reason") or finish_reason
+
+                    if delta:
+                        text += delta
+                        yield delta
+
+            if self.model_type == "chat":
+                choice = {"index": 0, "message": {"role": "assistant", "content": text}}
+            else:
+                choice = {"index": 0, "text": text}
+
+            response = OpenAIObject.construct_from({"choices": [{**choice, "finish_reason": finish_reason}]})
+            cached_request.store(response, fingerprint, kwargs)
+
+        history = {
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
     def _get_choice_text(self, choice: dict[str, Any]) -> str:
         if self.model_type == "chat":
             return choice["message"]["content"]
@@ -150,6 +274,24 @@ class GPT3(LM):
         #         kwargs = {**kwargs, "logprobs": 5}
 
         response = self.request(prompt, **kwargs)
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    async def acall(
+        self,
+        prompt: str,
+        only_completed: bool = True,
+        return_sorted: bool = False,
+        **kwargs,
+    ) -> list[dict[str, Any]]:
+        """Asynchronously retrieves completions from GPT-3. See `__call__`."""
+
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        response = await self.arequest(prompt, **kwargs)
+        return self._get_completions(response, only_completed, return_sorted, **kwargs)
+
+    def _get_completions(self, response, only_completed: bool, return_sorted: bool, **kwargs) -> list[str]:
         choices = response["choices"]
 
         completed_choices = [c for c in choices if c["finish_reason"] != "length"]
@@ -181,31 +323,84 @@ class GPT3(LM):
         return completions
 
 
-@CacheMemory.cache
-def cached_gpt3_request_v2(**kwargs):
-    return openai.Completion.create(**kwargs)
+def _request_tokens(request: dict[str, Any]) -> int:
+    text = request.get("prompt") or "".join(m["content"] for m in request.get("messages", []))
+    return estimate_tokens(text, request.get("max_tokens"), request.get("n"))
+
+
+def _usage(response) -> Optional[int]:
+    return (response.get("usage") or {}).get("total_tokens")
+
+
+# The request dict is ignored when hashing: every tier keys on the fingerprint computed once in `basic_request`.
+
+@CacheMemory.cache(ignore=['request'])
+def cached_gpt3_request_v3(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    with throttle(_request_tokens(request)) as reservation:
+        response = openai.Completion.create(**request)
+        reservation.update(_usage(response))
+
+    return response
+
+
+@MemoCache.cache(ignore=['request'])
+@NotebookCacheMemory.cache(ignore=['request'])
+def cached_gpt3_request_v3_wrapped(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    return cached_gpt3_request_v3(fingerprint, request)
+
+
+cached_gpt3_request = cached_gpt3_request_v3_wrapped
+
+
+@CacheMemory.cache(ignore=['request'], name='cached_gpt3_request_v3')
+async def acached_gpt3_request_v3(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    async with athrottle(_request_tokens(request)) as reservation:
+        response = await openai.Completion.acreate(**request)
+        reservation.update(_usage(response))
+
+    return response
+
+
+@MemoCache.cache(ignore=['request'], name='cached_gpt3_request_v3_wrapped')
+@NotebookCacheMemory.cache(ignore=['request'], name='cached_gpt3_request_v3_wrapped')
+async def acached_gpt3_request_v3_wrapped(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    return await acached_gpt3_request_v3(fingerprint, request)
+
+
+acached_gpt3_request = acached_gpt3_request_v3_wrapped
+
+
+@CacheMemory.cache(ignore=['request'])
+def _cached_gpt3_turbo_request_v3(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    with throttle(_request_tokens(request)) as reservation:
+        response = openai.ChatCompletion.create(**request)
+        reservation.update(_usage(response))
+
+    return cast(OpenAIObject, response)
+
 
+@MemoCache.cache(ignore=['request'])
+@NotebookCacheMemory.cache(ignore=['request'])
+def _cached_gpt3_turbo_request_v3_wrapped(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    return _cached_gpt3_turbo_request_v3(fingerprint, request)
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-@NotebookCacheMemory.cache
-def cached_gpt3_request_v2_wrapped(**kwargs):
-    return cached_gpt3_request_v2(**kwargs)
 
+cached_gpt3_turbo_request = _cached_gpt3_turbo_request_v3_wrapped
 
-cached_gpt3_request = cached_gpt3_request_v2_wrapped
 
+@CacheMemory.cache(ignore=['request'], name='_cached_gpt3_turbo_request_v3')
+async def _acached_gpt3_turbo_request_v3(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    async with athrottle(_request_tokens(request)) as reservation:
+        response = await openai.ChatCompletion.acreate(**request)
+        reservation.update(_usage(response))
 
-@CacheMemory.cache
-def _cached_gpt3_turbo_request_v2(**kwargs) -> OpenAIObject:
-    if "stringify_request" in kwargs:
-        kwargs = json.loads(kwargs["stringify_request"])
-    return cast(OpenAIObject, openai.ChatCompletion.create(**kwargs))
+    return cast(OpenAIObject, response)
 
 
-@functools.lru_cache(maxsize=None if cache_turn_on else 0)
-@NotebookCacheMemory.cache
-def _cached_gpt3_turbo_request_v2_wrapped(**kwargs) -> OpenAIObject:
-    return _cached_gpt3_turbo_request_v2(**kwargs)
+@MemoCache.cache(ignore=['request'], name='_cached_gpt3_turbo_request_v3_wrapped')
+@NotebookCacheMemory.cache(ignore=['request'], name='_cached_gpt3_turbo_request_v3_wrapped')
+async def _acached_gpt3_turbo_request_v3_wrapped(fingerprint: Fingerprint, request: dict[str, Any]) -> OpenAIObject:
+    return await _acached_gpt3_turbo_request_v3(fingerprint, request)
 
 
-cached_gpt3_turbo_request = _cached_gpt3_turbo_request_v2_wrapped
+acached_gpt3_turbo_request = _acached_gpt3_turbo_request_v3_wrapped
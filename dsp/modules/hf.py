@@ -1,10 +1,11 @@
 import os
 import json
+import asyncio
 # from peft import PeftConfig, PeftModel
 # from transformers import AutoModelForSeq2SeqLM, AutoModelForCausalLM, AutoTokenizer, AutoConfig
 from typing import Optional, Literal
 
-from dsp.modules.lm import LM
+from dsp.modules.lm import LM, History
 # from dsp.modules.finetuning.finetune_hf import preprocess_prompt
 from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
 import functools
@@ -83,7 +84,18 @@ class HFModel(LM):
                 self.drop_prompt_from_output = True
                 self.tokenizer = AutoTokenizer.from_pretrained(model)
                 self.drop_prompt_from_output = True
-        self.history = []
+
+            # Tokenizers without a known limit report a huge sentinel value.
+            if self.tokenizer.model_max_length < 1_000_000:
+                self.context_window = self.tokenizer.model_max_length
+
+        self.history = History()
+
+    def count_tokens(self, text: str) -> int:
+        if getattr(self, "tokenizer", None) is None:
+            return super().count_tokens(text)
+
+        return len(self.tokenizer(text, add_special_tokens=False)["input_ids"])
 
     def basic_request(self, prompt, **kwargs):
         raw_kwargs = kwargs
@@ -100,6 +112,25 @@ class HFModel(LM):
 
         return response
 
+    async def abasic_request(self, prompt, **kwargs):
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+        response = await self._agenerate(prompt, **kwargs)
+
+        history = {
+            "prompt": prompt,
+            "response": response,
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
+        return response
+
+    async def _agenerate(self, prompt, **kwargs):
+        """Asynchronous `_generate`. HTTP clients override this; local models generate on a worker thread."""
+        return await asyncio.to_thread(self._generate, prompt, **kwargs)
+
     def _generate(self, prompt, **kwargs):
         assert not self.is_client
         # TODO: Add caching
@@ -137,6 +168,42 @@ class HFModel(LM):
         response = self.request(prompt, **kwargs)
         return [c["text"] for c in response["choices"]]
 
+    def stream(self, prompt, **kwargs):
+        kwargs = {**kwargs, "n": 1}
+
+        if kwargs.get("temperature", 0.0) > 0.1:
+            kwargs["do_sample"] = True
+
+        raw_kwargs = kwargs
+        kwargs = {**self.kwargs, **kwargs}
+
+        text = ""
+        for chunk in self._stream(prompt, **kwargs):
+            text += chunk
+            yield chunk
+
+        history = {
+            "prompt": prompt,
+            "response": {"prompt": prompt, "choices": [{"text": text}]},
+            "kwargs": kwargs,
+            "raw_kwargs": raw_kwargs,
+        }
+        self.history.append(history)
+
+    def _stream(self, prompt, **kwargs):
+        """Streaming `_generate` for a single completion. HTTP clients override this."""
+        yield self._generate(prompt, **kwargs)["choices"][0]["text"]
+
+    async def acall(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        assert only_completed, "for now"
+        assert return_sorted is False, "for now"
+
+        if kwargs.get("n", 1) > 1 or kwargs.get("temperature", 0.0) > 0.1:
+            kwargs["do_sample"] = True
+
+        response = await self.arequest(prompt, **kwargs)
+        return [c["text"] for c in response["choices"]]
+
 
 # @functools.lru_cache(maxsize=None if cache_turn_on else 0)
 # @NotebookCacheMemory.cache
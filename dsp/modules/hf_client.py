@@ -1,9 +1,14 @@
+import asyncio
 import functools
+import json
 import os
-import random
 import requests
 from dsp.modules.hf import HFModel, openai_to_hf
-from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on
+from dsp.modules.batching import MicroBatcher
+from dsp.modules.load_balancer import LoadBalancer
+from dsp.modules.rate_limiter import throttle, athrottle, estimate_tokens
+from dsp.modules.cache_utils import CacheMemory, NotebookCacheMemory, cache_turn_on, Fingerprint, request_fingerprint
+from dsp.modules.http_pool import http_pool, import_aiohttp
 import os
 import subprocess
 import re
@@ -14,16 +19,38 @@ import time
 
 
 class HFClientTGI(HFModel):
-    def __init__(self, model, port, url="http://future-hgx-1", http_request_kwargs=None, **kwargs):
+    """Client for text-generation-inference servers listening on one or more `port`s of `url`.
+
+    Requests are spread over the ports by a `LoadBalancer` with the given `policy` ('least_outstanding', 'ewma',
+    'random' or a `LoadBalancingPolicy`). A port that fails `max_failures` times in a row is taken out of rotation
+    for `cooldown` seconds.
+
+    With `max_batch_size > 1`, concurrent calls (from threads or coroutines) that miss the cache are coalesced
+    for up to `batch_window` seconds and sent together from a single event loop, so that TGI's continuous
+    batching sees many sequences at once. TGI has no multi-prompt endpoint, so a batch is sent as
+    concurrent requests over pooled connections.
+    """
+
+    def __init__(self, model, port, url="http://future-hgx-1", http_request_kwargs=None,
+                 max_batch_size=1, batch_window=0.005, policy="least_outstanding", max_failures=3, cooldown=30.0,
+                 **kwargs):
         super().__init__(model=model, is_client=True)
 
         self.url = url
         self.ports = port if isinstance(port, list) else [port]
         self.http_request_kwargs = http_request_kwargs or {}
 
+        self.balancer = LoadBalancer([f"{url}:{p}" for p in self.ports], policy=policy,
+                                     max_failures=max_failures, cooldown=cooldown)
+
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = MicroBatcher(self._send_batch, max_batch_size=max_batch_size, window=batch_window)
+
         self.headers = {"Content-Type": "application/json"}
 
         self.kwargs = {
+            "model": model,
             "temperature": 0.01,
             "max_tokens": 75,
             "top_p": 0.97,
@@ -34,7 +61,7 @@ class HFClientTGI(HFModel):
 
         # print(self.kwargs)
 
-    def _generate(self, prompt, **kwargs):
+    def _payload(self, prompt, **kwargs):
         kwargs = {**self.kwargs, **kwargs}
 
         payload = {
@@ -57,61 +84,238 @@ class HFClientTGI(HFModel):
 
         # print(payload['parameters'])
 
+        return payload
+
+    def _parse(self, json_response):
+        # completions = json_response["generated_text"]
+
+        completions = [json_response["generated_text"]]
+
+        if (
+            "details" in json_response
+            and "best_of_sequences" in json_response["details"]
+        ):
+            completions += [
+                x["generated_text"]
+                for x in json_response["details"]["best_of_sequences"]
+            ]
+
+        return completions
+
+    def _generate(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+
         # response = requests.post(self.url + "/generate", json=payload, headers=self.headers)
 
-        response = send_hftgi_request_v01_wrapped(
-            f"{self.url}:{random.Random().choice(self.ports)}" + "/generate",
-            url=self.url,
-            ports=tuple(self.ports),
-            json=payload,
-            headers=self.headers,
-            **self.http_request_kwargs,
-        )
+        fingerprint = request_fingerprint(model=self.kwargs["model"], **payload)
+        completions = send_hftgi_request_v03_wrapped(fingerprint, self, payload)
+
+        return {"prompt": prompt, "choices": [{"text": c} for c in completions]}
+
+    async def _agenerate(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+
+        fingerprint = request_fingerprint(model=self.kwargs["model"], **payload)
+        completions = await asend_hftgi_request_v03_wrapped(fingerprint, self, payload)
+
+        return {"prompt": prompt, "choices": [{"text": c} for c in completions]}
+
+    def _stream(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+        fingerprint = request_fingerprint(model=self.kwargs["model"], **payload)
+
+        if send_hftgi_request_v03.check_call_in_cache(fingerprint, self, payload):
+            yield send_hftgi_request_v03(fingerprint, self, payload)[0]
+            return
+
+        text = ""
+        with throttle(self._tokens(payload)):
+            events = _stream_events(self.balancer, "/generate_stream", key=_prefix_key(payload["inputs"]),
+                                    json=payload, headers=self.headers, **self.http_request_kwargs)
+
+            for event in events:
+                if not event["token"].get("special"):
+                    text += event["token"]["text"]
+                    yield event["token"]["text"]
+
+        send_hftgi_request_v03.store([text], fingerprint, self, payload)
+
+    def _tokens(self, payload):
+        parameters = payload["parameters"]
+        return estimate_tokens(payload["inputs"], parameters.get("max_new_tokens"), parameters.get("best_of"))
+
+    def _send(self, payload):
+        with throttle(self._tokens(payload)):
+            if self.batcher is not None:
+                return self._parse(self.batcher(payload))
+
+            return self._parse(self._post(payload))
+
+    async def _asend(self, payload):
+        async with athrottle(self._tokens(payload)):
+            if self.batcher is not None:
+                return self._parse(await self.batcher.acall(payload))
 
+            return self._parse(await self._apost(payload))
+
+    def _post(self, payload):
+        return _post_balanced(self.balancer, "/generate", key=_prefix_key(payload["inputs"]), json=payload,
+                              headers=self.headers, **self.http_request_kwargs)
+
+    async def _apost(self, payload):
+        return await _apost_balanced(self.balancer, "/generate", key=_prefix_key(payload["inputs"]), json=payload,
+                                     headers=self.headers, **self.http_request_kwargs)
+
+    async def _send_batch(self, payloads):
+        return await asyncio.gather(*[self._apost(payload) for payload in payloads], return_exceptions=True)
+
+
+def _parse_json_response(response):
+    if response.status_code >= 500:
+        response.raise_for_status()
+
+    try:
+        return response.json()
+    except Exception:
+        print("Failed to parse JSON response:", response.text)
+        raise Exception("Received invalid JSON response from server")
+
+
+async def _apost_json(url, **kwargs):
+    """Asynchronous `requests.post(url, **kwargs).json()` on top of aiohttp."""
+    aiohttp = import_aiohttp()
+
+    timeout = kwargs.pop("timeout", None)
+    if isinstance(timeout, (int, float)):
+        kwargs["timeout"] = aiohttp.ClientTimeout(total=timeout)
+
+    async with http_pool.async_session().post(url, **kwargs) as response:
+        if response.status >= 500:
+            response.raise_for_status()
+
+        text = await response.text()
+
+    try:
+        return json.loads(text)
+    except Exception:
+        print("Failed to parse JSON response:", text)
+        raise Exception("Received invalid JSON response from server")
+
+
+def _prefix_key(prompt):
+    """The prefix `prompt` shares with the other prompts of its template, if marked (see `dsp.Prompt`)."""
+    prefix_length = getattr(prompt, "prefix_length", None)
+    return str(prompt[:prefix_length]) if prefix_length else None
+
+
+def _post_balanced(balancer, path, key=None, **kwargs):
+    """POSTs to `path` on a server picked by `balancer` and returns the decoded JSON body.
+
+    Server errors and invalid responses count against the server. Requests that could not connect at all are
+    retried on another server. `key` is the request's affinity key, e.g. its `_prefix_key`.
+    """
+    tried = set()
+
+    for attempt in range(len(balancer.endpoints)):
         try:
-            json_response = response.json()
-            # completions = json_response["generated_text"]
+            with balancer.endpoint(key, exclude=tried) as base_url:
+                tried.add(base_url)
+                return _parse_json_response(http_pool.post(base_url + path, **kwargs))
+        except requests.ConnectionError:
+            if attempt + 1 == len(balancer.endpoints):
+                raise
 
-            completions = [json_response["generated_text"]]
 
-            if (
-                "details" in json_response
-                and "best_of_sequences" in json_response["details"]
-            ):
-                completions += [
-                    x["generated_text"]
-                    for x in json_response["details"]["best_of_sequences"]
-                ]
+async def _apost_balanced(balancer, path, key=None, **kwargs):
+    """Asynchronous `_post_balanced`."""
+    aiohttp = import_aiohttp()
 
-            response = {"prompt": prompt, "choices": [{"text": c} for c in completions]}
-            return response
-        except Exception as e:
-            print("Failed to parse JSON response:", response.text)
-            raise Exception("Received invalid JSON response from server")
+    tried = set()
+
+    for attempt in range(len(balancer.endpoints)):
+        try:
+            async with balancer.aendpoint(key, exclude=tried) as base_url:
+                tried.add(base_url)
+                return await _apost_json(base_url + path, **kwargs)
+        except aiohttp.ClientConnectionError:
+            if attempt + 1 == len(balancer.endpoints):
+                raise
+
+
+def _stream_events(balancer, path, key=None, **kwargs):
+    """Yields the decoded events of a server-sent event stream from a server picked by `balancer`."""
+    with balancer.endpoint(key) as base_url:
+        with http_pool.post(base_url + path, stream=True, **kwargs) as response:
+            if response.status_code >= 500:
+                response.raise_for_status()
+
+            # Event streams are UTF-8, but requests would decode them as ISO-8859-1 unless the server names a charset.
+            for line in response.iter_lines():
+                line = line.decode("utf-8")
+
+                if not line.startswith("data:"):
+                    continue
+
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    break
 
+                yield json.loads(data)
 
-@CacheMemory.cache(ignore=['arg'])
-def send_hftgi_request_v01(arg, url, ports, **kwargs):
-    return requests.post(arg, **kwargs)
+
+# Only the parsed completions are cached, keyed on the fingerprint of the model and payload, so entries are
+# small and survive changes to the set of servers. The client is ignored: it only sends requests that miss.
+
+@CacheMemory.cache(ignore=['client', 'payload'])
+def send_hftgi_request_v03(fingerprint: Fingerprint, client, payload):
+    return client._send(payload)
 
 # @functools.lru_cache(maxsize=None if cache_turn_on else 0)
-@NotebookCacheMemory.cache(ignore=['arg'])
-def send_hftgi_request_v01_wrapped(arg, url, ports, **kwargs):
-    return send_hftgi_request_v01(arg, url, ports, **kwargs)
+@NotebookCacheMemory.cache(ignore=['client', 'payload'])
+def send_hftgi_request_v03_wrapped(fingerprint: Fingerprint, client, payload):
+    return send_hftgi_request_v03(fingerprint, client, payload)
+
+
+@CacheMemory.cache(ignore=['client', 'payload'], name='send_hftgi_request_v03')
+async def asend_hftgi_request_v03(fingerprint: Fingerprint, client, payload):
+    return await client._asend(payload)
+
+
+@NotebookCacheMemory.cache(ignore=['client', 'payload'], name='send_hftgi_request_v03_wrapped')
+async def asend_hftgi_request_v03_wrapped(fingerprint: Fingerprint, client, payload):
+    return await asend_hftgi_request_v03(fingerprint, client, payload)
 
 
 @CacheMemory.cache
 def send_hftgi_request_v00(arg, **kwargs):
-    return requests.post(arg, **kwargs)
+    return http_pool.post(arg, **kwargs)
 
 
 class HFClientVLLM(HFModel):
-    def __init__(self, model, port, url="http://localhost", **kwargs):
+    """Client for vLLM OpenAI-compatible servers listening on one or more `port`s of `url`.
+
+    Requests are spread over the ports as in `HFClientTGI`.
+
+    With `max_batch_size > 1`, concurrent calls that miss the cache and share generation parameters are
+    coalesced for up to `batch_window` seconds into a single `/v1/completions` request with a list of prompts.
+    """
+
+    def __init__(self, model, port, url="http://localhost", max_batch_size=1, batch_window=0.005,
+                 policy="least_outstanding", max_failures=3, cooldown=30.0, **kwargs):
         super().__init__(model=model, is_client=True)
-        self.url = f"{url}:{port}"
+        self.url = url
+        self.ports = port if isinstance(port, list) else [port]
         self.headers = {"Content-Type": "application/json"}
 
-    def _generate(self, prompt, **kwargs):
+        self.balancer = LoadBalancer([f"{url}:{p}" for p in self.ports], policy=policy,
+                                     max_failures=max_failures, cooldown=cooldown)
+
+        self.batcher = None
+        if max_batch_size > 1:
+            self.batcher = MicroBatcher(self._send_batch, key=self._batch_key,
+                                        max_batch_size=max_batch_size, window=batch_window)
+
+    def _payload(self, prompt, **kwargs):
         kwargs = {**self.kwargs, **kwargs}
 
         payload = {
@@ -121,29 +325,88 @@ class HFClientVLLM(HFModel):
             "temperature": kwargs["temperature"],
         }
 
-        response = send_hfvllm_request_v00(
-            f"{self.url}/v1/completions",
-            json=payload,
-            headers=self.headers,
-        )
+        return payload
 
-        try:
-            json_response = response.json()
-            completions = json_response["choices"]
-            response = {
-                "prompt": prompt,
-                "choices": [{"text": c["text"]} for c in completions],
-            }
-            return response
+    def _parse(self, json_response):
+        return [c["text"] for c in json_response["choices"]]
 
-        except Exception as e:
-            print("Failed to parse JSON response:", response.text)
-            raise Exception("Received invalid JSON response from server")
+    def _generate(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+        completions = send_hfvllm_request_v03(request_fingerprint(**payload), self, payload)
 
+        return {"prompt": prompt, "choices": [{"text": c} for c in completions]}
 
-@CacheMemory.cache
-def send_hfvllm_request_v00(arg, **kwargs):
-    return requests.post(arg, **kwargs)
+    async def _agenerate(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+        completions = await asend_hfvllm_request_v03(request_fingerprint(**payload), self, payload)
+
+        return {"prompt": prompt, "choices": [{"text": c} for c in completions]}
+
+    def _stream(self, prompt, **kwargs):
+        payload = self._payload(prompt, **kwargs)
+        fingerprint = request_fingerprint(**payload)
+
+        if send_hfvllm_request_v03.check_call_in_cache(fingerprint, self, payload):
+            yield send_hfvllm_request_v03(fingerprint, self, payload)[0]
+            return
+
+        text = ""
+        with throttle(self._tokens(payload)):
+            events = _stream_events(self.balancer, "/v1/completions", key=_prefix_key(payload["prompt"]),
+                                    json={**payload, "stream": True}, headers=self.headers)
+
+            for event in events:
+                text += event["choices"][0]["text"]
+                yield event["choices"][0]["text"]
+
+        send_hfvllm_request_v03.store([text], fingerprint, self, payload)
+
+    def _tokens(self, payload):
+        return estimate_tokens(payload["prompt"], payload["max_tokens"], payload.get("n"))
+
+    def _send(self, payload):
+        with throttle(self._tokens(payload)):
+            if self.batcher is not None:
+                return self._parse(self.batcher(payload))
+
+            json_response = _post_balanced(self.balancer, "/v1/completions", key=_prefix_key(payload["prompt"]),
+                                           json=payload, headers=self.headers)
+            return self._parse(json_response)
+
+    async def _asend(self, payload):
+        async with athrottle(self._tokens(payload)):
+            if self.batcher is not None:
+                return self._parse(await self.batcher.acall(payload))
+
+            json_response = await _apost_balanced(self.balancer, "/v1/completions", key=_prefix_key(payload["prompt"]),
+                                                  json=payload, headers=self.headers)
+            return self._parse(json_response)
+
+    def _batch_key(self, payload):
+        return json.dumps({k: v for k, v in payload.items() if k != "prompt"}, sort_keys=True)
+
+    async def _send_batch(self, payloads):
+        payload = {**payloads[0], "prompt": [p["prompt"] for p in payloads]}
+        key = _prefix_key(payloads[0]["prompt"])
+
+        json_response = await _apost_balanced(self.balancer, "/v1/completions", key=key, json=payload,
+                                              headers=self.headers)
+
+        # Choices for the i-th prompt are at indices [i * n, (i + 1) * n).
+        n = payload.get("n", 1)
+        choices = sorted(json_response["choices"], key=lambda c: c["index"])
+
+        return [{**json_response, "choices": choices[i * n:(i + 1) * n]} for i in range(len(payloads))]
+
+
+@CacheMemory.cache(ignore=['client', 'payload'])
+def send_hfvllm_request_v03(fingerprint: Fingerprint, client, payload):
+    return client._send(payload)
+
+
+@CacheMemory.cache(ignore=['client', 'payload'], name='send_hfvllm_request_v03')
+async def asend_hfvllm_request_v03(fingerprint: Fingerprint, client, payload):
+    return await client._asend(payload)
 
 
 class HFServerTGI:
@@ -197,7 +460,6 @@ class HFServerTGI:
 class Anyscale(HFModel):
     def __init__(self, model, **kwargs):
         super().__init__(model=model, is_client=True)
-        self.session = requests.Session()
         self.api_base = os.getenv("OPENAI_API_BASE")
         self.token = os.getenv("OPENAI_API_KEY")
         self.model = model
@@ -207,7 +469,7 @@ class Anyscale(HFModel):
             **kwargs
         }
 
-    def _generate(self, prompt, use_chat_api=False, **kwargs):
+    def _request_body(self, prompt, use_chat_api=False, **kwargs):
         url = f"{self.api_base}/completions"
         
         kwargs = {**self.kwargs, **kwargs}
@@ -235,17 +497,38 @@ class Anyscale(HFModel):
                 "max_tokens": max_tokens
             }
 
+        return url, body
+
+    def _parse(self, prompt, resp_json, use_chat_api=False):
+        if use_chat_api:
+            completions = [resp_json.get('choices', [])[0].get('message', {}).get('content', "")]
+        else:
+            completions = [resp_json.get('choices', [])[0].get('text', "")]
+        response = {"prompt": prompt, "choices": [{"text": c} for c in completions]}
+        return response
+
+    def _generate(self, prompt, use_chat_api=False, **kwargs):
+        url, body = self._request_body(prompt, use_chat_api, **kwargs)
+        headers = {"Authorization": f"Bearer {self.token}"}
+
+        try:
+            with throttle(estimate_tokens(prompt, body["max_tokens"])):
+                with http_pool.post(url, headers=headers, json=body) as resp:
+                    resp_json = resp.json()
+                    return self._parse(prompt, resp_json, use_chat_api)
+        except Exception as e:
+            print(f"Failed to parse JSON response: {e}")
+            raise Exception("Received invalid JSON response from server")
+
+    async def _agenerate(self, prompt, use_chat_api=False, **kwargs):
+        url, body = self._request_body(prompt, use_chat_api, **kwargs)
         headers = {"Authorization": f"Bearer {self.token}"}
 
+        async with athrottle(estimate_tokens(prompt, body["max_tokens"])):
+            resp_json = await _apost_json(url, headers=headers, json=body)
+
         try:
-            with self.session.post(url, headers=headers, json=body) as resp:
-                resp_json = resp.json()
-                if use_chat_api:
-                    completions = [resp_json.get('choices', [])[0].get('message', {}).get('content', "")]
-                else:
-                    completions = [resp_json.get('choices', [])[0].get('text', "")]
-                response = {"prompt": prompt, "choices": [{"text": c} for c in completions]}
-                return response
+            return self._parse(prompt, resp_json, use_chat_api)
         except Exception as e:
             print(f"Failed to parse JSON response: {e}")
             raise Exception("Received invalid JSON response from server")
@@ -0,0 +1,109 @@
+import os
+import asyncio
+import threading
+import weakref
+
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def import_aiohttp():
+    """Returns the aiohttp module, which the asynchronous clients (`acall`, `arequest`) need."""
+    try:
+        import aiohttp
+    except ImportError:
+        raise ImportError(
+            "The asynchronous LM clients need aiohttp. Install it with `pip install dspy-ai[async]`"
+        ) from None
+
+    return aiohttp
+
+
+class HTTPSessionPool:
+    """Keep-alive HTTP sessions shared by all HTTP-based LM and RM clients.
+
+    There is one `requests.Session` per scheme and host, each backed by a urllib3 pool of at most
+    `max_connections` connections that all threads share. With `block=True`, threads wait for a free
+    connection rather than opening more. Coroutines get one `aiohttp.ClientSession` per event loop,
+    limited in the same way.
+    """
+
+    def __init__(self, max_connections: int = 64, block: bool = True):
+        self.max_connections = max_connections
+        self.block = block
+
+        self._sessions = {}
+        self._async_sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def configure(self, max_connections: int = None, block: bool = None):
+        """Changes the pool limits. Sessions created from then on use the new limits."""
+        with self._lock:
+            self.max_connections = max_connections or self.max_connections
+            self.block = self.block if block is None else block
+
+            sessions, self._sessions = self._sessions, {}
+
+        for session in sessions.values():
+            session.close()
+
+    def session(self, url: str) -> requests.Session:
+        parts = urlsplit(url)
+        host = (parts.scheme, parts.netloc)
+
+        session = self._sessions.get(host)
+        if session is not None:
+            return session
+
+        with self._lock:
+            if host not in self._sessions:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections, pool_block=self.block)
+
+                session = requests.Session()
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+
+                self._sessions[host] = session
+
+            return self._sessions[host]
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.session(url).post(url, **kwargs)
+
+    def async_session(self):
+        """Returns the `aiohttp.ClientSession` bound to the running event loop, creating it if needed."""
+        aiohttp = import_aiohttp()
+
+        loop = asyncio.get_running_loop()
+        session = self._async_sessions.get(loop)
+
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections)
+            session = aiohttp.ClientSession(connector=connector)
+            self._async_sessions[loop] = session
+
+        return session
+
+    def _after_fork(self):
+        # A forked child must open its own connections rather than share the parent's sockets.
+        self._sessions = {}
+        self._async_sessions = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def close(self):
+        with self._lock:
+            sessions, self._sessions = self._sessions, {}
+
+        for session in sessions.values():
+            session.close()
+
+
+http_pool = HTTPSessionPool(max_connections=int(os.environ.get('DSP_HTTP_MAX_CONNECTIONS') or 64))
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=http_pool._after_fork)
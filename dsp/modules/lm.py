@@ -1,9 +1,88 @@
+import copy
+import asyncio
+import itertools
 from abc import ABC, abstractmethod
+from collections import deque
+
+from dsp.utils.settings import settings
+from dsp.modules.rate_limiter import estimate_tokens
+
+
+# Entries in metadata mode keep everything but these, plus the prompt's length and the kwargs minus the prompt.
+_HEAVY_KEYS = ("prompt", "response", "kwargs", "raw_kwargs", "completions", "topk")
+
+
+def _summarize(entry: dict) -> dict:
+    summary = {k: v for k, v in entry.items() if k not in _HEAVY_KEYS}
+
+    if "prompt" in entry:
+        summary["prompt_length"] = len(str(entry["prompt"]))
+
+    if "kwargs" in entry:
+        summary["kwargs"] = {k: v for k, v in entry["kwargs"].items() if k not in ("prompt", "messages")}
+
+    try:
+        summary["usage"] = dict(entry["response"]["usage"])
+    except (KeyError, TypeError):
+        pass
+
+    return summary
+
+
+class History(deque):
+    """An LM's request history: a ring buffer that keeps only the most recent `size` entries.
+
+    `mode` is 'full' (entries as given), 'metadata' (no prompts or responses) or 'off' (nothing is kept).
+    When `size` or `mode` is None, `dsp.settings.history_size` or `dsp.settings.history_mode` applies at each append.
+    Slicing returns a list, as it did when the history was one. Pickles leave the entries out, so that LMs sent to
+    other processes do not carry them along.
+    """
+
+    def __init__(self, entries=(), size: int = None, mode: str = None):
+        super().__init__()
+        self.size = size
+        self.mode = mode
+
+        for entry in entries:
+            self.append(entry)
+
+    def append(self, entry: dict):
+        mode = self.mode or settings.history_mode
+
+        if mode == "off":
+            return
+
+        if mode == "metadata":
+            entry = _summarize(entry)
+
+        super().append(entry)
+
+        size = self.size if self.size is not None else settings.history_size
+        while size is not None and len(self) > size:
+            self.popleft()
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return list(self)[index]
+
+        return super().__getitem__(index)
+
+    def __copy__(self):
+        return self.__class__(self, self.size, self.mode)
+
+    def __deepcopy__(self, memo):
+        return self.__class__(copy.deepcopy(list(self), memo), self.size, self.mode)
+
+    def __reduce__(self):
+        return self.__class__, ((), self.size, self.mode)
 
 
 class LM(ABC):
     """Abstract class for language models."""
 
+    # The model's context length in tokens, if known. Templates then fit their demos into what `max_tokens` leaves.
+    context_window = None
+
     def __init__(self, model):
         self.kwargs = {
             "model": model,
@@ -16,7 +95,7 @@ class LM(ABC):
         }
         self.provider = "default"
 
-        self.history = []
+        self.history = History()
 
     @abstractmethod
     def basic_request(self, prompt, **kwargs):
@@ -25,6 +104,17 @@ class LM(ABC):
     def request(self, prompt, **kwargs):
         return self.basic_request(prompt, **kwargs)
 
+    async def abasic_request(self, prompt, **kwargs):
+        """Asynchronous `basic_request`. Clients without a native implementation run the blocking one on a thread."""
+        return await asyncio.to_thread(self.basic_request, prompt, **kwargs)
+
+    async def arequest(self, prompt, **kwargs):
+        return await self.abasic_request(prompt, **kwargs)
+
+    def count_tokens(self, text: str) -> int:
+        """The number of tokens `text` takes up in a prompt. Estimated, unless the client knows its tokenizer."""
+        return estimate_tokens(text)
+
     def print_green(self, text: str, end: str = "\n"):
         print("\x1b[32m" + str(text) + "\x1b[0m", end=end)
 
@@ -41,7 +131,10 @@ class LM(ABC):
         printed = []
         n = n + skip
 
-        for x in reversed(self.history[-100:]):
+        for x in itertools.islice(reversed(self.history), 100):
+            if "prompt" not in x:
+                continue
+
             prompt = x["prompt"]
 
             if prompt != last_prompt:
@@ -83,6 +176,19 @@ class LM(ABC):
     def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
         pass
 
+    def stream(self, prompt, **kwargs):
+        """Yields the text of one completion of `prompt` in chunks, as it is generated.
+
+        Clients that cannot stream yield the whole completion at once.
+        """
+        yield from self(prompt, **{**kwargs, "n": 1})[:1]
+
+    async def acall(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        """Asynchronous `__call__`, sharing its cache and history. Overridden by the HTTP-based clients."""
+        return await asyncio.to_thread(
+            self.__call__, prompt, only_completed=only_completed, return_sorted=return_sorted, **kwargs
+        )
+
     def copy(self, **kwargs):
         """Returns a copy of the language model with the same parameters."""
         kwargs = {**self.kwargs, **kwargs}
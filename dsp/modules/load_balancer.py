@@ -0,0 +1,213 @@
+import time
+import random
+import hashlib
+import threading
+import contextlib
+
+
+class Endpoint:
+    """Book-keeping for one server behind a `LoadBalancer`."""
+
+    def __init__(self, url: str):
+        self.url = url
+
+        self.outstanding = 0
+        self.latency = None  # EWMA of successful request latencies, in seconds.
+
+        self.failures = 0  # Consecutive failures; reset by any success.
+        self.ejected_until = 0.0
+
+        self.num_requests = 0
+        self.num_failures = 0
+        self.num_ejections = 0
+
+    def __repr__(self):
+        return f"Endpoint({self.url!r}, outstanding={self.outstanding}, latency={self.latency}, failures={self.failures})"
+
+
+class LoadBalancingPolicy:
+    """Picks one of the currently healthy endpoints for the next request.
+
+    `key` is an optional affinity key for the request, e.g. the prefix its prompt shares with others.
+    """
+
+    def choose(self, endpoints: list[Endpoint], key: str = None) -> Endpoint:
+        raise NotImplementedError
+
+
+class RandomPolicy(LoadBalancingPolicy):
+    def choose(self, endpoints, key=None):
+        return random.choice(endpoints)
+
+
+class LeastOutstandingPolicy(LoadBalancingPolicy):
+    """Sends each request to the endpoint with the fewest requests in flight, breaking ties at random."""
+
+    def choose(self, endpoints, key=None):
+        fewest = min(e.outstanding for e in endpoints)
+        return random.choice([e for e in endpoints if e.outstanding == fewest])
+
+
+class EWMALatencyPolicy(LoadBalancingPolicy):
+    """Sends each request to the endpoint with the lowest expected wait, i.e. EWMA latency × (in flight + 1).
+
+    Endpoints with no latency measurement yet are tried first, so that new or recovered servers get probed.
+    """
+
+    def choose(self, endpoints, key=None):
+        def cost(e):
+            return (0.0 if e.latency is None else e.latency) * (e.outstanding + 1), random.random()
+
+        return min(endpoints, key=cost)
+
+
+class PrefixAffinityPolicy(LoadBalancingPolicy):
+    """Sends requests with the same key (their prompt prefix) to the same endpoint, so its prefix cache gets reused.
+
+    Endpoints are ranked per key by rendezvous hashing, so when one is ejected only its keys move elsewhere. An
+    endpoint with `max_skew` or more requests in flight beyond the least loaded one is passed over for the next in
+    rank. Requests without a key go to the least loaded endpoint.
+    """
+
+    def __init__(self, max_skew: int = 8):
+        self.max_skew = max_skew
+        self.fallback = LeastOutstandingPolicy()
+
+    def choose(self, endpoints, key=None):
+        if key is None:
+            return self.fallback.choose(endpoints)
+
+        digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+        def rank(e):
+            return hashlib.blake2b(e.url.encode("utf-8"), key=digest, digest_size=8).digest()
+
+        fewest = min(e.outstanding for e in endpoints)
+
+        for endpoint in sorted(endpoints, key=rank):
+            if endpoint.outstanding - fewest < self.max_skew:
+                return endpoint
+
+
+POLICIES = {
+    'random': RandomPolicy,
+    'least_outstanding': LeastOutstandingPolicy,
+    'ewma': EWMALatencyPolicy,
+    'prefix': PrefixAffinityPolicy,
+}
+
+
+class LoadBalancer:
+    """Spreads requests over several servers and passively tracks their health.
+
+    Every request is made inside `endpoint()` (or `aendpoint()` in coroutines), which yields the base URL chosen
+    by `policy` and records the outcome. After `max_failures` consecutive failures an endpoint is ejected for
+    `cooldown` seconds; once the cooldown is over it is sent traffic again, and a single further failure ejects it
+    anew. If every endpoint is ejected, all of them are used rather than failing outright.
+
+    `policy` is one of 'random', 'least_outstanding', 'ewma', 'prefix', or a `LoadBalancingPolicy`. Requests may
+    pass an affinity `key`, which only the 'prefix' policy uses.
+    """
+
+    def __init__(self, urls: list[str], policy='least_outstanding', max_failures: int = 3,
+                 cooldown: float = 30.0, alpha: float = 0.3):
+        assert len(urls) > 0, "A LoadBalancer needs at least one endpoint."
+
+        self.endpoints = [Endpoint(url) for url in urls]
+        self.policy = POLICIES[policy]() if isinstance(policy, str) else policy
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.alpha = alpha
+
+        self._lock = threading.Lock()
+
+    @property
+    def urls(self) -> list[str]:
+        return [e.url for e in self.endpoints]
+
+    def healthy(self) -> list[Endpoint]:
+        now = time.monotonic()
+        return [e for e in self.endpoints if e.ejected_until <= now] or self.endpoints
+
+    def acquire(self, key: str = None, exclude=()) -> Endpoint:
+        """Picks an endpoint for a request, other than those whose URL is in `exclude` if possible."""
+        with self._lock:
+            healthy = self.healthy()
+            endpoint = self.policy.choose([e for e in healthy if e.url not in exclude] or healthy, key)
+            endpoint.outstanding += 1
+            endpoint.num_requests += 1
+
+        return endpoint
+
+    def release(self, endpoint: Endpoint, latency: float = None, failed: bool = False):
+        """Records a request's outcome: a `latency` for successes, `failed` for failures, neither if it was cancelled."""
+        with self._lock:
+            endpoint.outstanding -= 1
+
+            if failed:
+                endpoint.failures += 1
+                endpoint.num_failures += 1
+
+                if endpoint.failures >= self.max_failures:
+                    endpoint.ejected_until = time.monotonic() + self.cooldown
+                    endpoint.num_ejections += 1
+
+            elif latency is not None:
+                endpoint.failures = 0
+
+                prev = endpoint.latency
+                endpoint.latency = latency if prev is None else self.alpha * latency + (1 - self.alpha) * prev
+
+    @contextlib.contextmanager
+    def endpoint(self, key: str = None, exclude=()):
+        endpoint = self.acquire(key, exclude)
+        start = time.monotonic()
+
+        try:
+            yield endpoint.url
+        except Exception:
+            self.release(endpoint, failed=True)
+            raise
+        except BaseException:
+            self.release(endpoint)
+            raise
+
+        self.release(endpoint, latency=time.monotonic() - start)
+
+    @contextlib.asynccontextmanager
+    async def aendpoint(self, key: str = None, exclude=()):
+        endpoint = self.acquire(key, exclude)
+        start = time.monotonic()
+
+        try:
+            yield endpoint.url
+        except Exception:
+            self.release(endpoint, failed=True)
+            raise
+        except BaseException:
+            self.release(endpoint)
+            raise
+
+        self.release(endpoint, latency=time.monotonic() - start)
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+
+        with self._lock:
+            return {e.url: dict(outstanding=e.outstanding, latency=e.latency, requests=e.num_requests,
+                                failures=e.num_failures, ejections=e.num_ejections,
+                                ejected=e.ejected_until > now)
+                    for e in self.endpoints}
+
+    def __deepcopy__(self, memo):
+        # Copies of a client share the health view of their servers.
+        return self
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_lock'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
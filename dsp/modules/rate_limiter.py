@@ -0,0 +1,256 @@
+import time
+import asyncio
+import threading
+import contextlib
+import collections
+
+from typing import Optional
+
+
+class TokenBucket:
+    """A bucket refilled at `per_minute` units per minute, holding at most one minute's worth.
+
+    `reserve` always succeeds: it takes the units right away, possibly driving the level below zero, and returns how
+    long the caller must wait for that debt to be repaid. Concurrent callers thus queue up behind each other instead
+    of retrying in lockstep.
+    """
+
+    def __init__(self, per_minute: float):
+        self.rate = per_minute / 60.0
+        self.capacity = per_minute
+        self.level = per_minute
+        self.updated = time.monotonic()
+
+        self._lock = threading.Lock()
+
+    def reserve(self, amount: float) -> float:
+        with self._lock:
+            now = time.monotonic()
+            self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+            self.updated = now
+
+            self.level -= amount
+            return max(0.0, -self.level / self.rate)
+
+    def refund(self, amount: float):
+        with self._lock:
+            self.level = min(self.capacity, self.level + amount)
+
+
+class Reservation:
+    """Capacity held by one request. Call `update` with the actual token usage once it is known."""
+
+    def __init__(self, limiter: Optional["RateLimiter"] = None, tokens: int = 0):
+        self.limiter = limiter
+        self.tokens = tokens
+
+    def update(self, tokens: int):
+        if self.limiter is not None and self.limiter.tokens is not None and tokens is not None:
+            self.limiter.tokens.refund(self.tokens - tokens)
+
+        self.tokens = tokens
+
+
+class RateLimiter:
+    """Makes callers wait for capacity before calling a provider, rather than backing off after being rate limited.
+
+    Limits are `rpm` requests per minute, `tpm` tokens per minute and `max_in_flight` concurrent requests. Each
+    may be None. A request first waits for an in-flight slot, then reserves its share of both buckets.
+    """
+
+    def __init__(self, rpm: float = None, tpm: float = None, max_in_flight: int = None):
+        self.rpm, self.tpm, self.max_in_flight = rpm, tpm, max_in_flight
+
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+        # `(loop, future)` of the coroutines waiting for an in-flight slot, woken in order as slots free up.
+        self._async_waiters = collections.deque()
+
+        self.num_requests = 0
+        self.num_delayed = 0
+        self.total_wait = 0.0
+
+    def _exit(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+            self._wake_async_waiter()
+
+    def _wake_async_waiter(self):
+        # Called with `_cond` held. Waiters whose loop has closed are skipped.
+        while self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+
+            try:
+                loop.call_soon_threadsafe(self._resolve, waiter)
+                return
+            except RuntimeError:
+                continue
+
+    def _resolve(self, waiter):
+        if waiter.done():
+            # Cancelled meanwhile: the slot goes to the next waiter instead.
+            with self._cond:
+                self._wake_async_waiter()
+        else:
+            waiter.set_result(None)
+
+    async def _aenter(self):
+        loop = asyncio.get_running_loop()
+
+        while True:
+            with self._cond:
+                if not (self.max_in_flight and self.in_flight >= self.max_in_flight):
+                    self.in_flight += 1
+                    return
+
+                waiter = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._cond:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    elif waiter.done() and not waiter.cancelled():
+                        # Woken, then cancelled before taking the slot: pass it on.
+                        self._cond.notify()
+                        self._wake_async_waiter()
+                raise
+
+    def _reserve(self, tokens: int) -> float:
+        wait = 0.0
+
+        if self.requests is not None:
+            wait = max(wait, self.requests.reserve(1))
+
+        if self.tokens is not None:
+            wait = max(wait, self.tokens.reserve(tokens))
+
+        return wait
+
+    def _record(self, start: float):
+        waited = time.monotonic() - start
+
+        with self._cond:
+            self.num_requests += 1
+            self.num_delayed += waited > 0.001
+            self.total_wait += waited
+
+    @contextlib.contextmanager
+    def limit(self, tokens: int = 0):
+        start = time.monotonic()
+
+        with self._cond:
+            while self.max_in_flight and self.in_flight >= self.max_in_flight:
+                self._cond.wait()
+
+            self.in_flight += 1
+
+        try:
+            time.sleep(self._reserve(tokens))
+            self._record(start)
+
+            yield Reservation(self, tokens)
+        finally:
+            self._exit()
+
+    @contextlib.asynccontextmanager
+    async def alimit(self, tokens: int = 0):
+        start = time.monotonic()
+
+        await self._aenter()
+
+        try:
+            await asyncio.sleep(self._reserve(tokens))
+            self._record(start)
+
+            yield Reservation(self, tokens)
+        finally:
+            self._exit()
+
+    def stats(self) -> dict:
+        return dict(rpm=self.rpm, tpm=self.tpm, max_in_flight=self.max_in_flight, in_flight=self.in_flight,
+                    requests=self.num_requests, delayed=self.num_delayed, total_wait=self.total_wait)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def rate_limiter() -> Optional[RateLimiter]:
+    """Returns the limiter configured as `dsp.settings.rate_limit`, if any.
+
+    The setting is either a `RateLimiter` or a dict of its arguments, e.g. `dict(rpm=3500, tpm=90000,
+    max_in_flight=16)`. Threads configured with equal dicts share one limiter.
+    """
+    from dsp.utils.settings import settings
+
+    limits = settings.rate_limit
+
+    if limits is None or isinstance(limits, RateLimiter):
+        return limits
+
+    key = tuple(sorted(limits.items()))
+
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(**limits)
+
+        return _limiters[key]
+
+
+def split_rate_limit(limits, parts: int) -> Optional[dict]:
+    """Returns the `rate_limit` setting that gives each of `parts` processes an equal share of `limits`.
+
+    Limiters do not span processes, so that processes together stay within `limits`.
+    """
+    if limits is None:
+        return None
+
+    if isinstance(limits, RateLimiter):
+        limits = dict(rpm=limits.rpm, tpm=limits.tpm, max_in_flight=limits.max_in_flight)
+
+    def share(name, value):
+        if not value:
+            return value
+
+        return max(1, value // parts) if name == "max_in_flight" else value / parts
+
+    return {name: share(name, value) for name, value in limits.items()}
+
+
+def estimate_tokens(text: str = "", max_tokens: int = 0, n: int = 1) -> int:
+    """A rough count of the tokens a request consumes: its prompt at ~4 characters per token plus its completions."""
+    return len(text) // 4 + (max_tokens or 0) * (n or 1)
+
+
+@contextlib.contextmanager
+def throttle(tokens: int = 0):
+    """Waits for capacity under `dsp.settings.rate_limit` and yields a `Reservation`. A no-op without a limit."""
+    limiter = rate_limiter()
+
+    if limiter is None:
+        yield Reservation()
+        return
+
+    with limiter.limit(tokens) as reservation:
+        yield reservation
+
+
+@contextlib.asynccontextmanager
+async def athrottle(tokens: int = 0):
+    """Asynchronous `throttle`."""
+    limiter = rate_limiter()
+
+    if limiter is None:
+        yield Reservation()
+        return
+
+    async with limiter.alimit(tokens) as reservation:
+        yield reservation
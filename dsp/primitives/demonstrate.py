@@ -22,6 +22,39 @@ class Example(dotdict):
 
         self.update(**kwargs)
 
+    # A counter bumped on every change, so that caches (e.g. of rendered demos, see `TemplateV2`) can key on
+    # `(id(example), version)` rather than re-serializing the contents.
+    def _changed(self):
+        self.__dict__["_version"] = self.__dict__.get("_version", 0) + 1
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self._changed()
+
+    def update(self, *args, **kwargs):
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def setdefault(self, key, default=None):
+        self._changed()
+        return super().setdefault(key, default)
+
+    def pop(self, *args):
+        self._changed()
+        return super().pop(*args)
+
+    def popitem(self):
+        self._changed()
+        return super().popitem()
+
+    def clear(self):
+        super().clear()
+        self._changed()
+
     def copy(self, **kwargs):
         the_copy = Example(**{**dict(self), **kwargs})
 
@@ -32,8 +65,12 @@ class Example(dotdict):
         keys = set(keys)
         return Example({k: v for k, v in self.items() if k not in keys})
 
-    def demos_at(self, fn):
-        """Returns a copy of the example with the demos stage transformed by the provided function"""
+    def demos_at(self, fn, key=None):
+        """Returns a copy of the example with the demos stage transformed by the provided function
+
+        If `key` identifies `fn` across calls (e.g. the stage it looks up), the copy remembers the demos it was made
+        from, so that templates can reuse what they rendered for them rather than key on the fresh copies.
+        """
 
         def at(example):
             try:
@@ -42,7 +79,12 @@ class Example(dotdict):
                 return {}
 
         demos = [example.copy(**at(example)) for example in self.demos]
-        return self.copy(demos=demos)
+        the_copy = self.copy(demos=demos)
+
+        if key is not None:
+            the_copy.__dict__["_demos_source"] = key, demos, tuple(self.demos)
+
+        return the_copy
 
 
 def annotate(*transformations):
@@ -1,12 +1,17 @@
+import threading
 from collections import Counter
+from concurrent.futures import Future
 from typing import Callable, Any, Optional
 
 import dsp
 from dsp.utils import zipstar, normalize_text
 from dsp.primitives.inspect import FuncInspector
 from dsp.utils.utils import dotdict
+from dsp.templates.template_v2 import Prompt
 from dsp.templates.template_v3 import Template
 from dsp.primitives.demonstrate import Example
+from dsp.modules.rate_limiter import estimate_tokens
+from dsp.modules.cache_backends import request_fingerprint
 
 
 class Completions:
@@ -45,6 +50,113 @@ class Completions:
         assert False, name
 
 
+# Extra LM calls made because no completion filled every field of the template. `prefix_tokens` counts the part
+# of continued prompts that repeats the previous request and its output (see `dsp.settings.continuation`).
+_fallback_stats = dotdict(round_trips=0, prompt_tokens=0, prefix_tokens=0, completion_tokens=0)
+_fallback_stats_lock = threading.Lock()
+
+
+def _record_fallback(prompt: str, completions: list[str], prefix_length: int = 0):
+    with _fallback_stats_lock:
+        _fallback_stats.round_trips += 1
+        _fallback_stats.prompt_tokens += estimate_tokens(prompt)
+        _fallback_stats.prefix_tokens += estimate_tokens(prompt[:prefix_length])
+        _fallback_stats.completion_tokens += sum(estimate_tokens(c) for c in completions)
+
+
+def fallback_stats() -> dotdict:
+    """Returns the round trips and (estimated) tokens spent completing partially filled completions."""
+    with _fallback_stats_lock:
+        return dotdict(_fallback_stats)
+
+
+def reset_fallback_stats():
+    with _fallback_stats_lock:
+        for key in _fallback_stats:
+            _fallback_stats[key] = 0
+
+
+# Token counts of the prompts rendered for generation, as reported by `Template.render` for each call.
+_prompt_stats = dotdict(prompts=0, prompt_tokens=0, prefix_tokens=0, demos=0, dropped_demos=0)
+_prompt_stats_lock = threading.Lock()
+
+
+def _record_prompt(counts: dotdict):
+    with _prompt_stats_lock:
+        _prompt_stats.prompts += 1
+        _prompt_stats.prompt_tokens += counts.prompt_tokens
+        _prompt_stats.prefix_tokens += counts.prefix_tokens
+        _prompt_stats.demos += counts.demos
+        _prompt_stats.dropped_demos += counts.dropped_demos
+
+
+def prompt_stats() -> dotdict:
+    """Returns the number of prompts rendered for generation, their tokens (also before the query), and their demos."""
+    with _prompt_stats_lock:
+        return dotdict(_prompt_stats)
+
+
+def reset_prompt_stats():
+    with _prompt_stats_lock:
+        for key in _prompt_stats:
+            _prompt_stats[key] = 0
+
+
+class Coalescer:
+    """Shares the completions of identical LM requests, e.g. among the items of `dspy.Module.batch`.
+
+    While one is configured as `dsp.settings.coalesce`, `dsp.generate` makes each distinct request (LM, prompt and
+    arguments) only once: concurrent duplicates wait for the first, later ones reuse its completions.
+    """
+
+    def __init__(self):
+        self._requests = {}
+        self._lock = threading.Lock()
+
+        self.num_requests = 0
+        self.num_coalesced = 0
+
+    def __call__(self, generator, prompt: str, **kwargs) -> list[str]:
+        try:
+            key = id(generator), request_fingerprint(prompt=str(prompt), **kwargs)
+        except TypeError:
+            return generator(prompt, **kwargs)
+
+        with self._lock:
+            self.num_requests += 1
+            future = self._requests.get(key)
+
+            if future is None:
+                future = self._requests[key] = Future()
+                owner = True
+            else:
+                self.num_coalesced += 1
+                owner = False
+
+        if not owner:
+            return list(future.result())
+
+        try:
+            completions = generator(prompt, **kwargs)
+        except BaseException as e:
+            # Let a later duplicate retry instead of failing with it.
+            with self._lock:
+                del self._requests[key]
+
+            future.set_exception(e)
+            raise
+
+        future.set_result(completions)
+        return list(completions)
+
+
+def _request(generator, prompt: str, **kwargs) -> list[str]:
+    if dsp.settings.coalesce is not None:
+        return dsp.settings.coalesce(generator, prompt, **kwargs)
+
+    return generator(prompt, **kwargs)
+
+
 def generate(template: Template, **kwargs) -> Callable:
     """Returns a callable function that generates completions for a given example using the provided template."""
     if hasattr(dsp.settings, "inspect"):
@@ -55,6 +167,15 @@ def generate(template: Template, **kwargs) -> Callable:
         return dsp.predict._generate(template, **kwargs)
 
 
+def generate_stream(template: Template, **kwargs) -> Callable:
+    """Returns a generator function that streams a single completion for a given example using the provided template.
+
+    It yields `(partial, None)` each time another output field is complete, where `partial` is the example with the
+    output fields completed so far, and finally the `(example, completions)` pair that `generate` would return.
+    """
+    return _generate(template, **kwargs).stream
+
+
 def _generate(template: Template, **kwargs) -> Callable:
     """Returns a callable function that generates completions for a given example using the provided template."""
     if not dsp.settings.lm:
@@ -67,16 +188,65 @@ def _generate(template: Template, **kwargs) -> Callable:
     ):
         if not dsp.settings.lm:
             raise AssertionError("No LM is loaded.")
+        example_ = example
         original_example = original_example or example
         assert stage is not None
 
         # Look up the appropriate fields in each demonstration.
-        example = example.demos_at(lambda d: d[stage])
+        example = example.demos_at(lambda d: d[stage], key=stage)
 
         # Generate and extract the fields.
-        prompt = template(example)
-        completions: list[dict[str, Any]] = generator(prompt, **kwargs)
-        completions: list[Example] = [template.extract(example, p) for p in completions]
+        prompt, counts = template.render(example)
+        _record_prompt(counts)
+
+        completions: list[dict[str, Any]] = _request(generator, prompt, **kwargs)
+
+        # Only the recursive calls made to complete a partial completion pass an original example.
+        if original_example is not example_:
+            _record_fallback(prompt, completions)
+
+        return finish(example, prompt, completions, stage, max_depth, original_example)
+
+    def do_stream(
+        example: Example, stage: str, max_depth: int = 2, original_example=None
+    ):
+        if not dsp.settings.lm:
+            raise AssertionError("No LM is loaded.")
+        original_example = original_example or example
+        assert stage is not None
+
+        example = example.demos_at(lambda d: d[stage], key=stage)
+        prompt, counts = template.render(example)
+        _record_prompt(counts)
+
+        outputs = [
+            field.output_variable
+            for field in template.fields
+            if field.input_variable not in example or example[field.input_variable] is None
+        ]
+        lookback = max(len(field.name) for field in template.fields) + 1
+
+        text, num_completed = "", 0
+        for chunk in generator.stream(prompt, **kwargs):
+            text += chunk
+
+            # A field is complete once the name of the next one starts a line.
+            if "\n" not in text[-(len(chunk) + lookback):]:
+                continue
+
+            partial = template.extract(example, text)
+            completed = [key for key in outputs if key in partial][:-1]
+
+            if len(completed) > num_completed:
+                num_completed = len(completed)
+                yield example.copy(**{key: partial[key] for key in completed}), None
+
+        yield finish(example, prompt, [text], stage, max_depth, original_example)
+
+    def finish(example, prompt, completions, stage, max_depth, original_example):
+        raw_completions = completions
+        completions: list[Example] = template.extract_all(example, raw_completions)
+        raw_by_id = {id(c): p for c, p in zip(completions, raw_completions)}
 
         # Find the completions that are most complete.
         field_names: list[str] = [field.input_variable for field in template.fields]
@@ -109,6 +279,30 @@ def _generate(template: Template, **kwargs) -> Callable:
             }
 
             assert max_depth > 0
+
+            if dsp.settings.continuation:
+                # Continue the LM's own output from the next field on, so the new prompt extends the previous
+                # request and its completion, and only the missing fields are generated.
+                partial = raw_by_id[id(completion)].rstrip()
+                # Chat models leave out the space after the field name the prompt ends with.
+                if partial and not partial[0].isspace():
+                    partial = " " + partial
+                prefix = partial + "\n" + template.fields[last_field_idx].name
+                # Keep the template's prefix marked, so the request goes where the previous one did.
+                continued_prompt = Prompt(prompt + prefix, getattr(prompt, "prefix_length", 0))
+
+                continuations = _request(generator, continued_prompt, **new_kwargs)
+                _record_fallback(continued_prompt, continuations, prefix_length=len(prompt) + len(partial))
+
+                return finish(
+                    example,
+                    prompt,
+                    [prefix + c for c in continuations],
+                    stage,
+                    max_depth - 1,
+                    original_example,
+                )
+
             return generate(template, **new_kwargs)(
                 completion,
                 stage=stage,
@@ -151,6 +345,8 @@ def _generate(template: Template, **kwargs) -> Callable:
 
         return example, completions
 
+    do_generate.stream = do_stream
+
     return do_generate
 
 
@@ -179,9 +375,10 @@ def extract_final_answer(example, completions, extract=None):
         ]
 
     # TODO: make thread-safe?
-    dsp.settings.lm.history.append(
-        {**dsp.settings.lm.history[-1], "completions": completions}
-    )
+    if dsp.settings.lm.history:
+        dsp.settings.lm.history.append(
+            {**dsp.settings.lm.history[-1], "completions": completions}
+        )
 
     return completions
 
@@ -230,8 +427,9 @@ def majority_vote_(completions: Completions, normalize: bool, prediction_field:
     if normalize:
         pred = normalized_to_original[pred]
 
-    dsp.settings.lm.history.append(
-        {**dsp.settings.lm.history[-1], "topk": topk, "completions": [pred]}
-    )
+    if dsp.settings.lm.history:
+        dsp.settings.lm.history.append(
+            {**dsp.settings.lm.history[-1], "topk": topk, "completions": [pred]}
+        )
 
     return [pred]
@@ -1,12 +1,82 @@
 from collections import namedtuple
 import re
+import pickle
+import functools
+import hashlib
 from typing import Union, Any
 import dsp
 from dsp.primitives.demonstrate import Example
+from dsp.modules.rate_limiter import estimate_tokens
+from dsp.utils.utils import dotdict
 from .utils import passages2text, format_answers
 
 Field = namedtuple("Field", "name separator input_variable output_variable description")
 
+_NON_SPACE = re.compile(r"\S")
+_FIELD_WITH_DESCRIPTION = re.compile("(.*)(\s){(.*)}\s(.*\${.*})")
+_FIELD = re.compile("(.*)(\s){(.*)}")
+_VARIABLES = re.compile("(.*) -> (.*)")
+
+
+@functools.lru_cache(maxsize=1024)
+def _parse_template(template: str) -> tuple[str, tuple[Field, ...]]:
+    """Parses a template string into its instructions and fields. Templates are parsed once per distinct string."""
+    template = template.strip()
+
+    instructions = re.search("(.*)\n", template).group(1)
+    template = template[len(instructions) :].strip()
+
+    fields = []
+    while len(template) > 0:
+        match = _FIELD_WITH_DESCRIPTION.search(template)
+        if match is not None:
+            name = match.group(1)
+            separator = match.group(2)
+            variable = match.group(3)
+            description = match.group(4)
+        else:
+            match = _FIELD.search(template)
+            if match is not None:
+                name = match.group(1)
+                separator = match.group(2)
+                variable = match.group(3)
+                description = None
+            else:
+                raise ValueError(f"Could not parse template")
+
+        var_match = _VARIABLES.match(variable)
+        if var_match is not None:
+            input_variable = var_match.group(1)
+            output_variable = var_match.group(2)
+        else:
+            input_variable = variable
+            output_variable = variable
+
+        fields.append(
+            Field(
+                name=name,
+                separator=separator,
+                input_variable=input_variable,
+                output_variable=output_variable,
+                description=description,
+            )
+        )
+
+        template = template[len(match.group(0)) :].strip()
+
+    return instructions, tuple(fields)
+
+
+class Prompt(str):
+    """A rendered prompt that knows its `prefix_length`: everything before the query, shared by the other prompts
+    of its template and demos. LM clients use it to let servers reuse the prefix's KV cache."""
+
+    def __new__(cls, text: str, prefix_length: int = 0):
+        prompt = super().__new__(cls, text)
+        prompt.prefix_length = prefix_length
+        return prompt
+
+
 # TODO: de-duplicate with dsp/templates/template.py
 
 
@@ -23,48 +93,8 @@ class TemplateV2:
     ):
         self.format_handlers = format_handlers
 
-        template = template.strip()
-
-        self.instructions = re.search("(.*)\n", template).group(1)
-        template = template[len(self.instructions) :].strip()
-
-        self.fields = []
-        while len(template) > 0:
-            match = re.search("(.*)(\s){(.*)}\s(.*\${.*})", template)
-            if match is not None:
-                name = match.group(1)
-                separator = match.group(2)
-                variable = match.group(3)
-                description = match.group(4)
-            else:
-                match = re.search("(.*)(\s){(.*)}", template)
-                if match is not None:
-                    name = match.group(1)
-                    separator = match.group(2)
-                    variable = match.group(3)
-                    description = None
-                else:
-                    raise ValueError(f"Could not parse template")
-
-            var_match = re.match("(.*) -> (.*)", variable)
-            if var_match is not None:
-                input_variable = var_match.group(1)
-                output_variable = var_match.group(2)
-            else:
-                input_variable = variable
-                output_variable = variable
-
-            self.fields.append(
-                Field(
-                    name=name,
-                    separator=separator,
-                    input_variable=input_variable,
-                    output_variable=output_variable,
-                    description=description,
-                )
-            )
-
-            template = template[len(match.group(0)) :].strip()
+        self.instructions, fields = _parse_template(template)
+        self.fields = list(fields)
 
     def query(self, example: Example, is_demo: bool = False) -> str:
         """Retrieves the input variables from the example and formats them into a query string."""
@@ -129,6 +159,29 @@ class TemplateV2:
             ("\n" in field.separator) or ('\n' in field.description) for field in self.fields
         )
 
+    def _boundaries(self):
+        """The output variable of each field and the line prefix that ends the previous field, built once per fields."""
+        key = tuple(self.fields)
+        cached = self.__dict__.get("_boundaries_cache")
+
+        if cached is None or cached[0] != key:
+            boundaries = [("\n" + field.name, field.output_variable) for field in self.fields]
+            cached = self.__dict__["_boundaries_cache"] = (key, boundaries)
+
+        return cached[1]
+
+    def _first_output(self, example) -> int:
+        idx = 0
+        while idx < len(self.fields):
+            if (
+                self.fields[idx].input_variable not in example
+                or example[self.fields[idx].input_variable] is None
+            ):
+                break
+            idx += 1
+
+        return min(idx, len(self.fields) - 1)
+
     def extract(
         self, example: Union[Example, dict[str, Any]], raw_pred: str
     ) -> Example:
@@ -141,67 +194,107 @@ class TemplateV2:
         Returns:
             Example: The example with the output variables filled in
         """
+        return self.extract_all(example, [raw_pred])[0]
+
+    def extract_all(
+        self, example: Union[Example, dict[str, Any]], raw_preds: list[str]
+    ) -> list[Example]:
+        """Extracts the output variables from each of `raw_preds`, as `extract` would, returning one example per."""
+        import dspy
+
         example = dsp.Example(example)
+        boundaries = self._boundaries()
+        idx = self._first_output(example)
+        trim = dspy.settings.release >= 20231003
 
-        raw_pred = raw_pred.strip()
+        return [self._parse(dsp.Example(example), raw_pred.strip(), idx, boundaries, trim) for raw_pred in raw_preds]
 
-        idx = 0
-        while idx < len(self.fields):
-            if (
-                self.fields[idx].input_variable not in example
-                or example[self.fields[idx].input_variable] is None
-            ):
+    @staticmethod
+    def _parse(example, text, idx, boundaries, trim):
+        """Splits `text` on the name of each next field, in a single pass over it.
+
+        The remainder still to be parsed is `text[start:end]`, stripped (and, if `trim`, stripped of trailing dashes)
+        after every field just like the slices it replaces.
+        """
+        start, end = 0, len(text)
+
+        while start < end:
+            output_variable = boundaries[idx][1]
+            offset = text.find(boundaries[idx + 1][0], start, end) if idx + 1 < len(boundaries) else -1
+
+            if offset < 0:
+                value = text[start:end].strip()
+                example[output_variable] = value.rstrip("-").strip() if trim else value
                 break
-            idx += 1
 
-        import dspy
+            value = text[start:offset].strip()
+            example[output_variable] = value.rstrip("-").strip() if trim else value
 
-        idx = min(idx, len(self.fields) - 1)
-        while raw_pred != "" and idx < len(self.fields):
-            if idx < len(self.fields) - 1:
-                next_field_name = "\n" + self.fields[idx + 1].name
-                offset = raw_pred.find(next_field_name)
-
-                if offset >= 0:
-                    if dspy.settings.release >= 20231003:
-                        example[self.fields[idx].output_variable] = raw_pred[:offset].strip().rstrip('---').strip()
-                        raw_pred = raw_pred[offset + len(next_field_name) :].strip().rstrip('---').strip()
-                    else:
-                        example[self.fields[idx].output_variable] = raw_pred[:offset].strip()
-                        raw_pred = raw_pred[offset + len(next_field_name) :].strip()
-
-                    idx += 1
-                else:
-                    if dspy.settings.release >= 20231003:
-                        example[self.fields[idx].output_variable] = raw_pred.strip().rstrip('---').strip()
-                    else:
-                        example[self.fields[idx].output_variable] = raw_pred.strip()
+            match = _NON_SPACE.search(text, offset + len(boundaries[idx + 1][0]), end)
+            start = match.start() if match else end
 
-                    raw_pred = ""
-                    idx += 1
-                    break
+            while end > start and text[end - 1].isspace():
+                end -= 1
 
-            else:
-                assert idx == len(self.fields) - 1, (idx, len(self.fields))
+            if trim:
+                while end > start and text[end - 1] == "-":
+                    end -= 1
 
-                if dspy.settings.release >= 20231003:
-                    example[self.fields[idx].output_variable] = raw_pred.strip().rstrip('---').strip()
-                else:
-                    example[self.fields[idx].output_variable] = raw_pred.strip()
+                while end > start and text[end - 1].isspace():
+                    end -= 1
 
-                break
+            idx += 1
 
         return example
 
-    def __call__(self, example, show_guidelines=True) -> str:
-        example = dsp.Example(example)
+    def _render_key(self, example, show_guidelines):
+        """Everything the demo blocks and guidelines depend on, and the demos that identify them.
 
-        if hasattr(dsp.settings, 'query_only') and dsp.settings.query_only:
-            return self.query(example)
+        Returns `(None, None)` if the demos cannot be fingerprinted.
+        """
+        import dspy
 
-        # The training data should not contain the output variable
-        if self.fields[-1].input_variable in example:
-            del example[self.fields[-1].input_variable]
+        stage, demos = None, example.demos
+
+        # `demos_at` copies the demos on every call: those copies are identified by the stage and the demos they
+        # were made from, unless the example got other demos since.
+        source = getattr(example, "__dict__", {}).get("_demos_source")
+
+        if source is not None and source[1] is example.demos:
+            stage, _, demos = source
+
+        # Examples count their changes, so they are told apart by identity and version. Demos that do not (e.g.
+        # plain dicts) are fingerprinted by their contents.
+        try:
+            demos_key = stage, tuple((id(demo), vars(demo).get("_version", 0)) for demo in demos)
+        except TypeError:
+            try:
+                demos_key = hashlib.sha1(pickle.dumps(example.demos, protocol=5), usedforsecurity=False).digest()
+            except Exception:
+                return None, None
+
+            demos = ()
+
+        return (
+            self.instructions,
+            tuple(self.fields),
+            tuple((key, id(handler)) for key, handler in self.format_handlers.items()),
+            tuple(field.input_variable in example for field in self.fields),
+            show_guidelines and getattr(dsp.settings, "show_guidelines", True),
+            dspy.settings.release >= 20230928,
+            demos_key,
+        ), tuple(demos)
+
+    def _render_demos(self, example, show_guidelines):
+        """Returns the rendered (rdemos, ademos, guidelines) for the demos of `example`. Do not modify the lists.
+
+        These only change when the demos or the template do, so they are cached on the template, keyed by both.
+        """
+        key, demos = self._render_key(example, show_guidelines)
+        cache = self.__dict__.setdefault("_render_cache", {})
+
+        if key is not None and key in cache:
+            return cache[key][1]
 
         rdemos = [
             self.query(demo, is_demo=True)
@@ -242,43 +335,56 @@ class TemplateV2:
         ademos = new_ademos + ademos
         rdemos = rdemos_
 
+        rendered = rdemos, ademos, self.guidelines(show_guidelines)
 
-        long_query = self._has_augmented_guidelines()
+        if key is not None:
+            if len(cache) >= 64:
+                cache.clear()
 
-        if long_query:
-            example["augmented"] = True
+            # The demos are kept alive along with their entry, so that their ids are not reused meanwhile.
+            cache[key] = demos, rendered
 
-        query = self.query(example)
+        return rendered
 
-        # if it has more lines than fields
-        if len(query.split('\n')) > len(self.fields):
-            long_query = True
+    def _count_tokens(self, lm, text: str, remember: bool = True) -> int:
+        """Counts the tokens of `text` for `lm`, keeping the count if `remember` (for demos and other repeated text)."""
+        if getattr(lm, "count_tokens", None) is None:
+            return estimate_tokens(text)
 
-            if "augmented" not in example or not example.augmented:
-                example["augmented"] = True
-                query = self.query(example)
+        if not remember:
+            return lm.count_tokens(text)
 
-        rdemos = "\n\n".join(rdemos)
-        
+        key = (type(lm), lm.kwargs.get("model"), text)
+        cache = self.__dict__.setdefault("_token_cache", {})
+
+        if key not in cache:
+            if len(cache) >= 4096:
+                cache.clear()
+
+            cache[key] = lm.count_tokens(text)
+
+        return cache[key]
+
+    def _assemble(self, rdemos, ademos, guidelines, query, long_query) -> str:
         if len(rdemos) >= 1 and len(ademos) == 0 and not long_query:
-            rdemos_and_query = "\n\n".join([rdemos, query])
+            rdemos_and_query = "\n\n".join([*rdemos, query])
             parts = [
                 self.instructions,
-                self.guidelines(show_guidelines),
+                guidelines,
                 rdemos_and_query,
             ]
         elif len(rdemos) == 0:
             parts = [
                 self.instructions,
-                self.guidelines(show_guidelines),
+                guidelines,
                 *ademos,
                 query,
             ]
         else:
             parts = [
                 self.instructions,
-                rdemos,
-                self.guidelines(show_guidelines),
+                "\n\n".join(rdemos),
+                guidelines,
                 *ademos,
                 query,
             ]
@@ -286,3 +392,116 @@ class TemplateV2:
         prompt = "\n\n---\n\n".join([p.strip() for p in parts if p])
 
         return prompt.strip()
+
+    def _pack(self, lm, budget, rdemos, ademos, guidelines, query, long_query, prefix_stable=False):
+        """Keeps the demos that fit into `budget` tokens, preferring ademos, then rdemos.
+
+        Demos are added greedily by their own token counts, so a demo too long to fit does not keep out the shorter
+        ones after it. Since counts of the parts need not add up exactly, the least preferred demos are then dropped
+        until the assembled prompt fits. With `prefix_stable`, demos are instead kept in the order they appear in the
+        prompt, up to the first that does not fit, so that prompts with longer queries only lose trailing demos.
+        """
+        separator = self._count_tokens(lm, "\n\n---\n\n")
+        total = self._count_tokens(lm, self._assemble([], [], guidelines, query, long_query), remember=False)
+
+        ademos_ = [("a", i, d) for i, d in enumerate(ademos)]
+        rdemos_ = [("r", i, d) for i, d in enumerate(rdemos)]
+        candidates = rdemos_ + ademos_ if prefix_stable else ademos_ + rdemos_
+        kept = []
+
+        for candidate in candidates:
+            cost = self._count_tokens(lm, candidate[2]) + separator
+
+            if total + cost <= budget:
+                kept.append(candidate)
+                total += cost
+            elif prefix_stable:
+                break
+
+        while True:
+            kept_ = set((kind, i) for kind, i, _ in kept)
+            ademos_ = [d for i, d in enumerate(ademos) if ("a", i) in kept_]
+            rdemos_ = [d for i, d in enumerate(rdemos) if ("r", i) in kept_]
+            prompt = self._assemble(rdemos_, ademos_, guidelines, query, long_query)
+            prompt_tokens = self._count_tokens(lm, prompt, remember=False)
+
+            if prompt_tokens <= budget or not kept:
+                return prompt, prompt_tokens, len(kept)
+
+            kept.pop()
+
+    def __call__(self, example, show_guidelines=True) -> str:
+        return self.render(example, show_guidelines)[0]
+
+    def render(self, example, show_guidelines=True) -> tuple[Prompt, dotdict]:
+        """Returns the prompt for `example` along with its token counts, as counted by `dsp.settings.lm`.
+
+        When `dsp.settings.max_prompt_tokens` is set, or else the LM's `context_window` is known, only the demos that
+        fit into that many tokens (minus the LM's `max_tokens`) are included. The counts are `prompt_tokens`,
+        `prefix_tokens` (those before the query), `demos` (included), `dropped_demos` and `budget` (None if unbounded).
+
+        With `dsp.settings.prefix_stable`, the layout no longer depends on the query, so that every prompt of the
+        template and demos is byte-identical up to the query, which comes last.
+        """
+        source = getattr(example, "__dict__", {}).get("_demos_source")
+        example = dsp.Example(example)
+        lm = dsp.settings.lm
+
+        if source is not None:
+            # See `_render_key`.
+            example.__dict__["_demos_source"] = source
+
+        if hasattr(dsp.settings, 'query_only') and dsp.settings.query_only:
+            prompt = Prompt(self.query(example))
+            prompt_tokens = self._count_tokens(lm, prompt, remember=False)
+
+            return prompt, dotdict(prompt_tokens=prompt_tokens, prefix_tokens=0, demos=0, dropped_demos=0, budget=None)
+
+        # The training data should not contain the output variable
+        if self.fields[-1].input_variable in example:
+            del example[self.fields[-1].input_variable]
+
+        rdemos, ademos, guidelines = self._render_demos(example, show_guidelines)
+
+        long_query = self._has_augmented_guidelines()
+        prefix_stable = dsp.settings.prefix_stable
+
+        if long_query:
+            example["augmented"] = True
+
+        query = self.query(example)
+
+        # if it has more lines than fields
+        if len(query.split('\n')) > len(self.fields):
+            long_query = long_query or not prefix_stable
+
+            if "augmented" not in example or not example.augmented:
+                example["augmented"] = True
+                query = self.query(example)
+
+        budget = dsp.settings.max_prompt_tokens
+
+        if budget is None and getattr(lm, "context_window", None):
+            budget = lm.context_window - lm.kwargs.get("max_tokens", 0)
+
+        num_demos = len(rdemos) + len(ademos)
+
+        if budget is None:
+            prompt = self._assemble(rdemos, ademos, guidelines, query, long_query)
+            prompt_tokens, kept = self._count_tokens(lm, prompt, remember=False), num_demos
+        else:
+            prompt, prompt_tokens, kept = self._pack(
+                lm, budget, rdemos, ademos, guidelines, query, long_query, prefix_stable
+            )
+
+        query = query.strip()
+        prefix_length = len(prompt) - len(query) if query and prompt.endswith(query) else 0
+        prompt = Prompt(prompt, prefix_length)
+
+        return prompt, dotdict(
+            prompt_tokens=prompt_tokens,
+            prefix_tokens=self._count_tokens(lm, prompt[:prefix_length]),
+            demos=kept,
+            dropped_demos=num_demos - kept,
+            budget=budget,
+        )
@@ -1,10 +1,42 @@
 from contextlib import contextmanager
 from dsp.utils.utils import dotdict
+import contextvars
+import functools
 import threading
 
 
+class Config(dotdict):
+    """An immutable snapshot of the DSP configuration. Derive a new one with `configure` or `context`."""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("DSP settings are immutable, use `dsp.settings.configure(...)` or `dsp.settings.context(...)`.")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+
+    def __setattr__(self, key, value):
+        self._immutable()
+
+    def __delattr__(self, key):
+        self._immutable()
+
+    def __reduce__(self):
+        return Config, (dict(self),)
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+# The configuration of the current context, when it differs from the process-wide `Settings.main_config`.
+_config = contextvars.ContextVar("dsp_config", default=None)
+
+
 class Settings(object):
-    """DSP configuration settings."""
+    """DSP configuration settings.
+
+    `configure` outside of any `context` sets the configuration of the whole process when called from the main thread,
+    and of the calling thread otherwise. `context` overrides it until the block exits, for the current thread and
+    asyncio task and for the work it hands off through `with_context`.
+    """
 
     _instance = None
 
@@ -15,17 +47,11 @@ class Settings(object):
 
         if cls._instance is None:
             cls._instance = super().__new__(cls)
-            cls._instance.main_tid = threading.get_ident()
-            cls._instance.main_stack = []
-            cls._instance.stack_by_thread = {}
-            cls._instance.stack_by_thread[
-                threading.get_ident()
-            ] = cls._instance.main_stack
 
             #  TODO: remove first-class support for re-ranker and potentially combine with RM to form a pipeline of sorts
             #  eg: RetrieveThenRerankPipeline(RetrievalModel, Reranker)
             #  downstream operations like dsp.retrieve would use configs from the defined pipeline.
-            config = dotdict(
+            cls._instance.main_config = Config(
                 lm=None,
                 rm=None,
                 branch_idx=0,
@@ -38,37 +64,35 @@ class Settings(object):
                 release=0,
                 bypass_assert=False,
                 bypass_suggest=False,
+                rate_limit=None,
+                history_mode="full",
+                history_size=1000,
+                continuation=False,
+                max_prompt_tokens=None,
+                prefix_stable=False,
+                coalesce=None,
             )
-            cls._instance.__append(config)
 
         return cls._instance
 
     @property
-    def config(self):
-        thread_id = threading.get_ident()
-        if thread_id not in self.stack_by_thread:
-            self.stack_by_thread[thread_id] = [self.main_stack[-1].copy()]
-        return self.stack_by_thread[thread_id][-1]
-
-    def __getattr__(self, name):
-        if hasattr(self.config, name):
-            return getattr(self.config, name)
-
-        if name in self.config:
-            return self.config[name]
+    def config(self) -> Config:
+        return _config.get() or self.main_config
 
-        super().__getattr__(name)
+    @property
+    def cache_stats(self):
+        """Hits, misses, evictions and bytes of the in-memory LM/RM cache tier and of the persistent cache."""
+        from dsp.modules.cache_utils import cache_stats
+        return cache_stats()
 
-    def __append(self, config):
-        thread_id = threading.get_ident()
-        if thread_id not in self.stack_by_thread:
-            self.stack_by_thread[thread_id] = [self.main_stack[-1].copy()]
-        self.stack_by_thread[thread_id].append(config)
+    def __getattr__(self, name):
+        try:
+            return (_config.get() or self.main_config)[name]
+        except KeyError:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'") from None
 
-    def __pop(self):
-        thread_id = threading.get_ident()
-        if thread_id in self.stack_by_thread:
-            self.stack_by_thread[thread_id].pop()
+    def _derive(self, inherit_config, kwargs) -> Config:
+        return Config({**self.config, **kwargs} if inherit_config else kwargs)
 
     def configure(self, inherit_config: bool = True, **kwargs):
         """Set configuration settings.
@@ -76,24 +100,39 @@ class Settings(object):
         Args:
             inherit_config (bool, optional): Set configurations for the given, and use existing configurations for the rest. Defaults to True.
         """
-        if inherit_config:
-            config = {**self.config, **kwargs}
-        else:
-            config = {**kwargs}
+        config = self._derive(inherit_config, kwargs)
 
-        self.__append(config)
+        if _config.get() is None and threading.current_thread() is threading.main_thread():
+            self.main_config = config
+        else:
+            _config.set(config)
 
     @contextmanager
     def context(self, inherit_config=True, **kwargs):
-        self.configure(inherit_config=inherit_config, **kwargs)
+        token = _config.set(self._derive(inherit_config, kwargs))
 
         try:
             yield
         finally:
-            self.__pop()
+            _config.reset(token)
 
     def __repr__(self) -> str:
         return repr(self.config)
 
 
+def with_context(fn):
+    """Returns `fn` bound to the caller's settings, for running on another thread (e.g. by a thread pool).
+
+    Threads start from the process-wide configuration otherwise, without the caller's `context` overrides.
+    """
+    ctx = contextvars.copy_context()
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        # A context can only be entered by one thread at a time, so each call runs in its own copy.
+        return ctx.copy().run(fn, *args, **kwargs)
+
+    return wrapper
+
+
 settings = Settings()
@@ -1,13 +1,21 @@
+import os
 import dsp
+import math
+import pickle
+import itertools
+import multiprocessing
 import tqdm
 import threading
 import pandas as pd
 
 from IPython.display import display as ipython_display, HTML
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-from dsp.utils import EM
+from dsp.utils import EM, dotdict, with_context
+from dsp.modules.rate_limiter import split_rate_limit
+from dsp.modules.gpt3 import openai_client_settings, configure_openai_client
 from dsp.evaluation.utils import *
+from dspy.evaluate.sinks import open_sink, result_record
 
 """
 TODO: Counting failures and having a max_failure count. When that is exceeded (also just at the end),
@@ -15,9 +23,77 @@ we print the number of failures, the first N examples that failed, and the first
 """
 
 
+# The program and metric of an `executor="process"` worker, set once by `_init_worker`.
+_worker_state = None
+
+
+def _init_worker(payload, client_settings):
+    global _worker_state
+
+    # The client settings hold credentials, so they come apart from the program, whose pickles may be saved.
+    configure_openai_client(client_settings)
+
+    program, metric, config = pickle.loads(payload)
+    dsp.settings.configure(inherit_config=False, **config)
+    _worker_state = program, metric
+
+
+def _run_in_worker(example_idx, example):
+    program, metric = _worker_state
+
+    try:
+        prediction = program(**example.inputs())
+        return example_idx, example, prediction, metric(example, prediction), None
+    except Exception as e:
+        return example_idx, example, None, None, e
+
+
+class RunningScore:
+    """Count, sum, mean and variance of the scores seen so far, updated in O(1) per score (Welford's method)."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.mean = 0.0
+        self._m2 = 0.0
+
+    def add(self, score):
+        self.count += 1
+        self.total += score
+
+        delta = score - self.mean
+        self.mean += delta / self.count
+        self._m2 += delta * (score - self.mean)
+
+    @property
+    def variance(self) -> float:
+        return self._m2 / (self.count - 1) if self.count > 1 else 0.0
+
+    def upper_bound(self, population: int, z: float = 2.58) -> float:
+        """An upper confidence bound on the mean score over `population` examples, of which these are a prefix.
+
+        Assumes scores in [0, 1]. The variance is floored at that of a smoothed Bernoulli, so that a run of identical
+        scores at the start does not make the bound overconfident.
+        """
+        remaining = population - self.count
+
+        if remaining <= 0:
+            return self.mean
+
+        # Even if every remaining example scored 1.
+        best_case = (self.total + remaining) / population
+
+        p = (self.total + 1) / (self.count + 2)
+        variance = max(self.variance, p * (1 - p))
+        finite_population = remaining / (population - 1)
+
+        return min(best_case, self.mean + z * math.sqrt(variance / self.count * finite_population))
+
+
 class Evaluate:
     def __init__(self, *, devset, metric=None, num_threads=1, display_progress=False,
-                 display_table=False, display=True, max_errors=5):
+                 display_table=False, display=True, max_errors=5, sink=None, max_inflight=None,
+                 executor="thread", mp_context="spawn"):
         self.devset = devset
         self.metric = metric
         self.num_threads = num_threads
@@ -25,140 +101,247 @@ class Evaluate:
         self.display_table = display_table
         self.display = display
         self.max_errors = max_errors
+        self.sink = sink
+        self.max_inflight = max_inflight
+        self.executor = executor
+        self.mp_context = mp_context
         self.error_count = 0
         self.error_lock = threading.Lock()
 
-    def _execute_single_thread(self, wrapped_program, devset, display_progress):
-        ncorrect = 0
-        ntotal = 0
-        reordered_devset = []
-        
-        pbar = tqdm.tqdm(total=len(devset), dynamic_ncols=True, disable=not display_progress)
+    def _execute_single_thread(self, wrapped_program, devset):
         for idx, arg in devset:
-            example_idx, example, prediction, score = wrapped_program(idx, arg)
-            reordered_devset.append((example_idx, example, prediction, score))
-            ncorrect += score
-            ntotal += 1
-            self._update_progress(pbar, ncorrect, ntotal)
-        pbar.close()
-        
-        return reordered_devset, ncorrect, ntotal
-
-    def _execute_multi_thread(self, wrapped_program, devset, num_threads, display_progress):
-        ncorrect = 0
-        ntotal = 0
-        reordered_devset = []
-        
-        with ThreadPoolExecutor(max_workers=num_threads) as executor:
-            futures = {executor.submit(wrapped_program, idx, arg) for idx, arg in devset}
-            pbar = tqdm.tqdm(total=len(devset), dynamic_ncols=True, disable=not display_progress)
-
-            for future in as_completed(futures):
-                example_idx, example, prediction, score = future.result()
-                reordered_devset.append((example_idx, example, prediction, score))
-                ncorrect += score
-                ntotal += 1
-                self._update_progress(pbar, ncorrect, ntotal)
-            pbar.close()
+            yield wrapped_program(idx, arg)
+
+    def _execute_pool(self, executor, fn, devset, num_workers):
+        # At most `max_inflight` examples are submitted and not yet consumed, so memory stays bounded however
+        # long `devset` is, and stopping early (an error past `max_errors`, or the caller closing the stream)
+        # cancels the queued rest instead of letting it run.
+        max_inflight = self.max_inflight or 2 * num_workers
+        pending = set()
+
+        def submit():
+            for idx, arg in itertools.islice(devset, max_inflight - len(pending)):
+                pending.add(executor.submit(fn, idx, arg))
+
+        try:
+            submit()
 
-        return reordered_devset, ncorrect, ntotal
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    pending.remove(future)
+                    yield future.result()
+
+                submit()
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def _execute_multi_thread(self, wrapped_program, devset, num_threads):
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            yield from self._execute_pool(executor, with_context(wrapped_program), devset, num_threads)
+
+    def _execute_multi_process(self, program, metric, wrapped_program, devset, num_processes):
+        # The program, metric and settings are pickled once here, and unpickled once by each worker. The workers
+        # share the persistent LM/RM cache with this process through DSP_CACHEDIR, but not the in-memory tier, and
+        # split the rate limit between them. Each evaluation starts its own pool, which takes a few seconds per
+        # worker with "spawn": this pays off when the program or metric spends much longer than that on CPU.
+        config = {**dsp.settings.config, "coalesce": None,
+                  "rate_limit": split_rate_limit(dsp.settings.rate_limit, num_processes)}
+
+        try:
+            payload = pickle.dumps((program, metric, config))
+        except Exception as e:
+            print(f"Evaluating with threads instead of processes: executor='process' needs the program, the metric "
+                  f"and the settings (including the LM and RM) to be picklable, e.g. a metric defined at module "
+                  f"level rather than a lambda. ({type(e).__name__}: {e})")
+
+            yield from self._execute_multi_thread(wrapped_program, devset, num_processes)
+            return
+
+        context = multiprocessing.get_context(self.mp_context)
+
+        with ProcessPoolExecutor(max_workers=num_processes, mp_context=context, initializer=_init_worker,
+                                 initargs=(payload, openai_client_settings())) as executor:
+            for example_idx, example, prediction, score, error in self._execute_pool(executor, _run_in_worker,
+                                                                                       devset, num_processes):
+                if error is not None:
+                    prediction, score = self._on_error(error)
+
+                yield example_idx, example, prediction, score
+
+    def _on_error(self, e):
+        with self.error_lock:
+            self.error_count += 1
+            current_error_count = self.error_count
+        if current_error_count >= self.max_errors:
+            raise e
+        print(f"Error for example in dev set: \t\t {e}")
+        return dict(), 0.0
 
     def _update_progress(self, pbar, ncorrect, ntotal):
         pbar.set_description(f"Average Metric: {ncorrect} / {ntotal}  ({round(100 * ncorrect / ntotal, 1)})")
         pbar.update()
 
+    def stream(self, program, metric=None, devset=None, num_threads=None):
+        """Evaluates `program`, yielding `(example_idx, example, prediction, score)` as each example finishes.
+
+        With several threads, results arrive in completion order; `example_idx` is the position in `devset`, which
+        may be any iterable and is consumed as the evaluation progresses. With `executor="process"`, the program and
+        the metric run in `num_threads` worker processes instead, for when they are CPU-bound (falling back to
+        threads if they cannot be pickled).
+        """
+        metric = metric if metric is not None else self.metric
+        devset = devset if devset is not None else self.devset
+        num_threads = num_threads if num_threads is not None else self.num_threads
+
+        def wrapped_program(example_idx, example):
+            try:
+                prediction = program(**example.inputs())
+                score = metric(example, prediction)  # FIXME: TODO: What's the right order? Maybe force name-based kwargs!
+                return example_idx, example, prediction, score
+            except Exception as e:
+                return (example_idx, example, *self._on_error(e))
+
+        devset = enumerate(devset)
+
+        if self.executor == "process":
+            yield from self._execute_multi_process(program, metric, wrapped_program, devset, num_threads)
+        elif num_threads == 1:
+            yield from self._execute_single_thread(wrapped_program, devset)
+        else:
+            yield from self._execute_multi_thread(wrapped_program, devset, num_threads)
+
     def __call__(self, program, metric=None, devset=None, num_threads=None,
                  display_progress=None, display_table=None, display=None,
-                 return_all_scores=False):
+                 return_all_scores=False, sink=None):
         metric = metric if metric is not None else self.metric
         devset = devset if devset is not None else self.devset
-        num_threads = num_threads if num_threads is not None else self.num_threads
         display_progress = display_progress if display_progress is not None else self.display_progress
         display_table = display_table if display_table is not None else self.display_table
+        sink = sink if sink is not None else self.sink
 
         display = self.display if display is None else display
         display_progress = display_progress and display
         display_table = display_table if display else False
 
-        def wrapped_program(example_idx, example):
-            # NOTE: TODO: Won't work if threads create threads!
-            creating_new_thread = threading.get_ident() not in dsp.settings.stack_by_thread
-            if creating_new_thread:
-                dsp.settings.stack_by_thread[threading.get_ident()] = list(dsp.settings.main_stack)
-                # print(threading.get_ident(), dsp.settings.stack_by_thread[threading.get_ident()])
+        # Only the rows to display are kept: all of them for `display_table=True`, else the first `display_table`.
+        num_rows = float("inf") if display_table is True else int(display_table)
+        stats, rows, scores = RunningScore(), {}, {}
 
-            # print(type(example), example)
+        owns_sink = isinstance(sink, (str, os.PathLike))
+        sink = open_sink(sink) if sink is not None else None
 
-            try:
-                prediction = program(**example.inputs())
-                score = metric(example, prediction)  # FIXME: TODO: What's the right order? Maybe force name-based kwargs!
-                return example_idx, example, prediction, score
-            except Exception as e:
-                with self.error_lock:
-                    self.error_count += 1
-                    current_error_count = self.error_count
-                if current_error_count >= self.max_errors:
-                    raise e
-                print(f"Error for example in dev set: \t\t {e}")
-                return example_idx, example, dict(), 0.0
-            finally:
-                if creating_new_thread:
-                    del dsp.settings.stack_by_thread[threading.get_ident()]
-
-        devset = list(enumerate(devset))
-
-        if num_threads == 1:
-            reordered_devset, ncorrect, ntotal = self._execute_single_thread(wrapped_program, devset, display_progress)
-        else:
-            reordered_devset, ncorrect, ntotal = self._execute_multi_thread(wrapped_program, devset, num_threads, display_progress)
+        total = len(devset) if hasattr(devset, "__len__") else None
+        pbar = tqdm.tqdm(total=total, dynamic_ncols=True, disable=not display_progress)
+
+        try:
+            for example_idx, example, prediction, score in self.stream(program, metric, devset, num_threads):
+                stats.add(score)
+                self._update_progress(pbar, stats.total, stats.count)
+
+                if return_all_scores:
+                    scores[example_idx] = score
+
+                if example_idx < num_rows:
+                    rows[example_idx] = merge_dicts(example, prediction) | {'correct': score}
+
+                if sink is not None:
+                    sink.write(result_record(example_idx, example, prediction, score))
+        finally:
+            pbar.close()
+
+            if owns_sink:
+                sink.close()
+
+        ncorrect, ntotal = stats.total, stats.count
 
         if display:
             print(f"Average Metric: {ncorrect} / {ntotal}  ({round(100 * ncorrect / ntotal, 1)}%)")
 
-        predicted_devset = sorted(reordered_devset)
+        if display_table:
+            self._display_table([rows[idx] for idx in sorted(rows)], metric.__name__, truncated_rows=ntotal - len(rows))
 
-        # data = [{**example, **prediction, 'correct': score} for example, prediction, score in zip(reordered_devset, preds, scores)]
-        data = [merge_dicts(example, prediction) | {'correct': score} for _, example, prediction, score in predicted_devset]
+        if return_all_scores:
+            return round(100 * ncorrect / ntotal, 2), [scores[idx] for idx in sorted(scores)]
 
+        return round(100 * ncorrect / ntotal, 2)
+
+    def race(self, program, best_score=None, metric=None, devset=None, num_threads=None, display_progress=None,
+             display=None, min_samples=16, z=2.58):
+        """Scores `program` like `__call__`, but gives up as soon as it is unlikely to beat `best_score`.
+
+        The score is checked on growing prefixes of `devset` (after `min_samples` examples, then twice as many, and
+        so on), and the evaluation is abandoned once its upper confidence bound (see `RunningScore.upper_bound`) falls
+        below `best_score`, a percentage as returned by `__call__`. For comparing candidates in optimizers.
+
+        Returns a dotdict with the `score` (estimated on the evaluated examples if `abandoned`), the `scores` of the
+        evaluated examples in devset order, and `num_evaluated`.
+        """
+        devset = list(devset if devset is not None else self.devset)
+        display_progress = display_progress if display_progress is not None else self.display_progress
+        display = self.display if display is None else display
+
+        stats, scores = RunningScore(), {}
+        checkpoint, abandoned = min_samples, False
+
+        results = self.stream(program, metric, devset, num_threads)
+        pbar = tqdm.tqdm(total=len(devset), dynamic_ncols=True, disable=not (display_progress and display))
+
+        try:
+            for example_idx, _, _, score in results:
+                stats.add(score)
+                scores[example_idx] = score
+                self._update_progress(pbar, stats.total, stats.count)
+
+                if best_score is not None and stats.count >= checkpoint:
+                    checkpoint *= 2
+
+                    if 100 * stats.upper_bound(len(devset), z) < best_score:
+                        abandoned = True
+                        break
+        finally:
+            results.close()
+            pbar.close()
+
+        score = round(100 * stats.mean, 2)
+
+        if display and abandoned:
+            print(f"Abandoned after {stats.count} / {len(devset)} examples: {score}% so far, "
+                  f"unlikely to beat {best_score}%.")
+        elif display:
+            print(f"Average Metric: {stats.total} / {stats.count}  ({round(100 * stats.mean, 1)}%)")
+
+        return dotdict(score=score, scores=[scores[idx] for idx in sorted(scores)], num_evaluated=stats.count,
+                       abandoned=abandoned)
+
+    def _display_table(self, data, metric_name, truncated_rows=0):
         df = pd.DataFrame(data)
 
         # Truncate every cell in the DataFrame
         df = df.applymap(truncate_cell)
 
         # Rename the 'correct' column to the name of the metric function
-        metric_name = metric.__name__
         df.rename(columns={'correct': metric_name}, inplace=True)
 
-        if display_table:
-            if isinstance(display_table, int):
-                df_to_display = df.head(display_table).copy()
-                truncated_rows = len(df) - display_table
-            else:
-                df_to_display = df.copy()
-                truncated_rows = 0
-
-            styled_df = configure_dataframe_display(df_to_display, metric_name)
-            
-            ipython_display(styled_df)
-
-            if truncated_rows > 0:
-                # Simplified message about the truncated rows
-                message = f"""
-                <div style='
-                    text-align: center; 
-                    font-size: 16px; 
-                    font-weight: bold; 
-                    color: #555; 
-                    margin: 10px 0;'>
-                    ... {truncated_rows} more rows not displayed ...
-                </div>
-                """
-                ipython_display(HTML(message))
-                
-        if return_all_scores:
-            return round(100 * ncorrect / ntotal, 2), [score for *_, score in predicted_devset]
-
-        return round(100 * ncorrect / ntotal, 2)
+        styled_df = configure_dataframe_display(df, metric_name)
+
+        ipython_display(styled_df)
+
+        if truncated_rows > 0:
+            # Simplified message about the truncated rows
+            message = f"""
+            <div style='
+                text-align: center; 
+                font-size: 16px; 
+                font-weight: bold; 
+                color: #555; 
+                margin: 10px 0;'>
+                ... {truncated_rows} more rows not displayed ...
+            </div>
+            """
+            ipython_display(HTML(message))
 
 
 def merge_dicts(d1, d2):
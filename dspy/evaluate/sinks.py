@@ -0,0 +1,83 @@
+import os
+import json
+
+
+def _as_dict(obj) -> dict:
+    return dict(obj.items()) if hasattr(obj, "items") else dict(obj)
+
+
+def result_record(example_idx, example, prediction, score) -> dict:
+    """The record an evaluation sink receives for one example."""
+    return dict(example_idx=example_idx, score=score, example=_as_dict(example), prediction=_as_dict(prediction))
+
+
+class JSONLSink:
+    """Appends one JSON object per evaluated example to a file, flushing as results arrive.
+
+    Values that are not JSON-serializable are written as their `str`.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write(self, record: dict):
+        self.file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink:
+    """Writes the evaluated examples to a Parquet file in row groups of `batch_size`. Requires `pyarrow`.
+
+    `example` and `prediction` are stored as JSON strings, so that the schema does not depend on their fields.
+    """
+
+    def __init__(self, path, batch_size: int = 1000):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("Writing evaluation results to Parquet requires `pyarrow`. "
+                              "Install it with `pip install pyarrow`, or use a .jsonl sink.")
+
+        self.pa = pa
+        self.schema = pa.schema([("example_idx", pa.int64()), ("score", pa.float64()),
+                                 ("example", pa.string()), ("prediction", pa.string())])
+        self.writer = pq.ParquetWriter(path, self.schema)
+        self.batch_size = batch_size
+        self.rows = []
+
+    def write(self, record: dict):
+        self.rows.append(dict(record, score=float(record["score"]),
+                              example=json.dumps(record["example"], ensure_ascii=False, default=str),
+                              prediction=json.dumps(record["prediction"], ensure_ascii=False, default=str)))
+
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(self.pa.Table.from_pylist(self.rows, schema=self.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def open_sink(sink):
+    """Returns a sink for `sink`: a path ending in .jsonl or .parquet, or an object with `write(record)`."""
+    if not isinstance(sink, (str, os.PathLike)):
+        return sink
+
+    extension = os.path.splitext(os.fspath(sink))[1].lower()
+
+    if extension in (".jsonl", ".json"):
+        return JSONLSink(sink)
+
+    if extension in (".parquet", ".pq"):
+        return ParquetSink(sink)
+
+    raise ValueError(f"Cannot tell the format of the evaluation sink {sink!r}, use a .jsonl or .parquet path.")
@@ -53,6 +53,12 @@ class ChainOfThought(Predict):
         )
 
     def forward(self, **kwargs):
+        return super().forward(**self._with_signature(kwargs))
+
+    def stream(self, **kwargs):
+        return super().stream(**self._with_signature(kwargs))
+
+    def _with_signature(self, kwargs):
         signature_kwargs = kwargs.pop("signature", None)
         if signature_kwargs is None:
             if self.activated is True or (
@@ -63,7 +69,7 @@ class ChainOfThought(Predict):
                 signature = self.signature
         else:
             signature = dsp.Template(self.signature.instructions, **signature_kwargs)
-        return super().forward(signature=signature, **kwargs)
+        return dict(signature=signature, **kwargs)
 
 
 """
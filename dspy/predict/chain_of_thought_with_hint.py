@@ -32,6 +32,12 @@ class ChainOfThoughtWithHint(Predict):
         self.extended_signature2 = dsp.Template(signature.instructions, **extended_kwargs2)
     
     def forward(self, **kwargs):
+        return super().forward(**self._with_signature(kwargs))
+
+    def stream(self, **kwargs):
+        return super().stream(**self._with_signature(kwargs))
+
+    def _with_signature(self, kwargs):
         signature = self.signature
 
         if self.activated is True or (self.activated is None and isinstance(dsp.settings.lm, dsp.GPT3)):
@@ -40,7 +46,7 @@ class ChainOfThoughtWithHint(Predict):
             else:
                 signature = self.extended_signature1
         
-        return super().forward(signature=signature, **kwargs)
+        return dict(signature=signature, **kwargs)
 
 
 """
@@ -4,7 +4,7 @@ import random
 from dspy.predict.parameter import Parameter
 from dspy.primitives.prediction import Prediction
 from dspy.signatures.field import InputField, OutputField
-from dspy.signatures.signature import infer_prefix
+from dspy.signatures.signature import infer_prefix, parse_signature
 
 
 class Predict(Parameter):
@@ -16,16 +16,7 @@ class Predict(Parameter):
 
         # if the signature is a string
         if isinstance(signature, str):
-            inputs, outputs = signature.split("->")
-            inputs, outputs = inputs.split(","), outputs.split(",")
-            inputs, outputs = [field.strip() for field in inputs], [field.strip() for field in outputs]
-
-            assert all(len(field.split()) == 1 for field in (inputs + outputs))
-
-            inputs_ = ', '.join([f"`{field}`" for field in inputs])
-            outputs_ = ', '.join([f"`{field}`" for field in outputs])
-
-            instructions = f"""Given the fields {inputs_}, produce the fields {outputs_}."""
+            instructions, inputs, outputs = parse_signature(signature)
 
             inputs = {k: InputField() for k in inputs}
             outputs = {k: OutputField() for k in outputs}
@@ -60,6 +51,55 @@ class Predict(Parameter):
         return self.forward(**kwargs)
     
     def forward(self, **kwargs):
+        signature, config, x = self._prepare(kwargs)
+
+        if self.lm is None:
+            x, C = dsp.generate(signature, **config)(x, stage=self.stage)
+        else:
+            with dsp.settings.context(lm=self.lm, query_only=True):
+                # print(f"using lm = {self.lm} !")
+                x, C = dsp.generate(signature, **config)(x, stage=self.stage)
+
+        return self._predict(signature, kwargs, C)
+
+    def batch(self, inputs, num_threads=8, return_exceptions=True):
+        """Calls the predictor on each of `inputs` concurrently, returning results in order. See `Module.batch`."""
+        from dspy.primitives.batch import run_batch
+
+        return run_batch(self, inputs, num_threads=num_threads, return_exceptions=return_exceptions)
+
+    def stream(self, **kwargs):
+        """Like `forward`, but generates a single completion and streams it.
+
+        Yields a partial `Prediction` with the output fields completed so far each time another field is complete,
+        then the final `Prediction`, which is the one traced.
+        """
+        signature, config, x = self._prepare(kwargs)
+
+        if self.lm is None:
+            stream = dsp.generate_stream(signature, **config)(x, stage=self.stage)
+            step = lambda: next(stream)
+        else:
+            with dsp.settings.context(lm=self.lm, query_only=True):
+                stream = dsp.generate_stream(signature, **config)(x, stage=self.stage)
+
+            def step():
+                with dsp.settings.context(lm=self.lm, query_only=True):
+                    return next(stream)
+
+        while True:
+            try:
+                x, C = step()
+            except StopIteration:
+                return
+
+            if C is None:
+                outputs = [f.output_variable for f in signature.fields if f.output_variable not in kwargs]
+                yield Prediction(**{key: x[key] for key in outputs if key in x})
+            else:
+                yield self._predict(signature, kwargs, C)
+
+    def _prepare(self, kwargs):
         # Extract the three privileged keyword arguments.
         signature = kwargs.pop("signature", self.signature)
         demos = kwargs.pop("demos", self.demos)
@@ -83,13 +123,9 @@ class Predict(Parameter):
 
         x = dsp.Example(demos=demos, **kwargs)
 
-        if self.lm is None:
-            x, C = dsp.generate(signature, **config)(x, stage=self.stage)
-        else:
-            with dsp.settings.context(lm=self.lm, query_only=True):
-                # print(f"using lm = {self.lm} !")
-                x, C = dsp.generate(signature, **config)(x, stage=self.stage)
+        return signature, config, x
 
+    def _predict(self, signature, kwargs, C):
         completions = []
 
         for c in C:
@@ -0,0 +1,59 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import dsp
+from dsp.modules.cache_backends import request_fingerprint
+from dsp.primitives.predict import Coalescer
+from dsp.utils.settings import with_context
+
+
+def _as_kwargs(item) -> dict:
+    # Examples with designated inputs pass only those, as in `Evaluate`.
+    if getattr(item, "_input_keys", None) is not None:
+        return dict(item.inputs())
+
+    return dict(item)
+
+
+def _dedup_key(kwargs: dict):
+    try:
+        return request_fingerprint(**kwargs)
+    except TypeError:
+        return None
+
+
+def run_batch(program, inputs: list, num_threads: int = 8, return_exceptions: bool = True) -> list:
+    """Calls `program(**item)` for each of `inputs` on `num_threads` threads, returning the results in order.
+
+    Items with identical inputs are run once and share their result. All items share a `Coalescer`, so identical
+    LM requests made by any of them go out once, and clients that micro-batch can group the concurrent rest. The
+    threads run with the caller's settings. With `return_exceptions`, an item that raised has its exception in
+    place of a result; otherwise the first error is raised once the items already started have finished.
+    """
+    inputs = [_as_kwargs(item) for item in inputs]
+
+    # The index of the item each item shares its result with: the first with the same inputs.
+    owners, first = [], {}
+    for idx, kwargs in enumerate(inputs):
+        key = _dedup_key(kwargs)
+        owners.append(idx if key is None else first.setdefault(key, idx))
+
+    jobs = sorted(set(owners))
+
+    with dsp.settings.context(coalesce=Coalescer()):
+        run = with_context(program)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=num_threads) as executor:
+        futures = {idx: executor.submit(run, **inputs[idx]) for idx in jobs}
+
+        for idx, future in futures.items():
+            try:
+                results[idx] = future.result()
+            except Exception as e:
+                if not return_exceptions:
+                    executor.shutdown(cancel_futures=True)
+                    raise
+
+                results[idx] = e
+
+    return [results[owner] for owner in owners]
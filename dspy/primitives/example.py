@@ -61,6 +61,12 @@ class Example:
             super().__setattr__(key, value)
         else:
             self._store[key] = value
+            self._changed()
+
+    def _changed(self):
+        # A counter bumped on every change of the fields, so that caches (e.g. of rendered demos) can key on
+        # `(id(example), version)` rather than re-serializing the contents.
+        self.__dict__["_version"] = self.__dict__.get("_version", 0) + 1
     
     def __getitem__(self, key):
         """
@@ -83,6 +89,7 @@ class Example:
             value (Any): The value to set the item to.
         """
         self._store[key] = value
+        self._changed()
 
     def __delitem__(self, key):
         """
@@ -92,6 +99,7 @@ class Example:
             key (str): The key of the item.
         """
         del self._store[key]
+        self._changed()
 
     def __contains__(self, key):
         """
@@ -51,6 +51,25 @@ class Module(BaseModule, metaclass=ProgramMeta):
         """
         return self.forward(*args, **kwargs)
 
+    def batch(self, inputs, num_threads=8, return_exceptions=True):
+        """
+        Call the Module instance on each of a list of inputs, concurrently.
+
+        Identical inputs are run once, and identical LM requests made while running them are sent once.
+
+        Args:
+            inputs (list): Dicts of keyword arguments, or Examples whose inputs are passed.
+            num_threads (int): The number of inputs run at a time.
+            return_exceptions (bool): Whether to return the exception an input raised in place of its result,
+                rather than raising it.
+
+        Returns:
+            list: The results, in the order of the inputs.
+        """
+        from dspy.primitives.batch import run_batch
+
+        return run_batch(self, inputs, num_threads=num_threads, return_exceptions=return_exceptions)
+
     def named_predictors(self):
         """
         Get the named predictors of the Module instance.
@@ -130,14 +149,6 @@ def set_attribute_by_name(obj, name, value):
     list_pattern = re.compile(r"^([^\[]+)\[([0-9]+)\]$")
     dict_pattern = re.compile(r"^([^\[]+)\['([^']+)'\]$")
 
-    # Match for module.attribute pattern
-    module_match = module_pattern.match(name)
-    if module_match:
-    # Regular expressions for different patterns
-    module_pattern = re.compile(r"^([^.]+)\.(.+)$")
-    list_pattern = re.compile(r"^([^\[]+)\[([0-9]+)\]$")
-    dict_pattern = re.compile(r"^([^\[]+)\['([^']+)'\]$")
-
     # Match for module.attribute pattern
     module_match = module_pattern.match(name)
     if module_match:
@@ -1,6 +1,7 @@
 import dspy
 import os
-import requests
+
+from dsp.modules.http_pool import http_pool
 
 from typing import Union, List
 
@@ -32,7 +33,7 @@ class YouRM(dspy.Retrieve):
         docs = []
         for query in queries:
             headers = {"X-API-Key": self.ydc_api_key}
-            results = requests.get(
+            results = http_pool.get(
                 f"https://api.ydc-index.io/search?query={query}",
                 headers=headers,
             ).json()
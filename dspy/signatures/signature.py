@@ -1,5 +1,6 @@
 import re
 import dsp
+import functools
 
 from .field import Field, InputField, OutputField
 import threading
@@ -143,6 +144,24 @@ class Signature(metaclass=SignatureMeta):
 
 
 
+@functools.lru_cache(maxsize=1024)
+def parse_signature(signature: str) -> tuple[str, tuple[str, ...], tuple[str, ...]]:
+    """Splits a string signature like "context, question -> answer" into default instructions and field names."""
+    inputs, outputs = signature.split("->")
+    inputs, outputs = inputs.split(","), outputs.split(",")
+    inputs, outputs = [field.strip() for field in inputs], [field.strip() for field in outputs]
+
+    assert all(len(field.split()) == 1 for field in (inputs + outputs))
+
+    inputs_ = ', '.join([f"`{field}`" for field in inputs])
+    outputs_ = ', '.join([f"`{field}`" for field in outputs])
+
+    instructions = f"""Given the fields {inputs_}, produce the fields {outputs_}."""
+
+    return instructions, tuple(inputs), tuple(outputs)
+
+
+@functools.lru_cache(maxsize=1024)
 def infer_prefix(attribute_name: str) -> str:
     """Infers a prefix from an attribute name."""
     
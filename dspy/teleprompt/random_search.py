@@ -28,13 +28,15 @@ from dspy.evaluate.evaluate import Evaluate
 
 
 class BootstrapFewShotWithRandomSearch(Teleprompter):
-    def __init__(self, metric, teacher_settings={}, max_bootstrapped_demos=4, max_labeled_demos=16, max_rounds=1, num_candidate_programs=16, num_threads=6, stop_at_score=None):
+    def __init__(self, metric, teacher_settings={}, max_bootstrapped_demos=4, max_labeled_demos=16, max_rounds=1, num_candidate_programs=16, num_threads=6, stop_at_score=None, early_stopping=False, executor="thread"):
         self.metric = metric
         self.teacher_settings = teacher_settings
         self.max_rounds = max_rounds
 
         self.num_threads = num_threads
         self.stop_at_score = stop_at_score
+        self.early_stopping = early_stopping
+        self.executor = executor
         self.min_num_samples = 1
         self.max_num_samples = max_bootstrapped_demos
         self.num_candidate_sets = num_candidate_programs
@@ -48,6 +50,10 @@ class BootstrapFewShotWithRandomSearch(Teleprompter):
         # print("Going to sample", self.max_num_traces, "traces in total.")
         print("Will attempt to train", self.num_candidate_sets, "candidate sets.")
 
+    def _complete(self, data):
+        # Candidates dropped by early stopping were only scored on part of the valset.
+        return len(data[1]) == len(self.valset)
+
     def compile(self, student, *, teacher=None, trainset, valset=None, restrict=None):
         self.trainset = trainset
         self.valset = valset or trainset  # TODO: FIXME: Note this choice.
@@ -93,14 +99,24 @@ class BootstrapFewShotWithRandomSearch(Teleprompter):
                 program2 = teleprompter.compile(student, teacher=teacher, trainset=trainset2)
 
             evaluate = Evaluate(devset=self.valset, metric=self.metric, num_threads=self.num_threads,
-                                display_table=False, display_progress=True)
+                                display_table=False, display_progress=True, executor=self.executor)
+
+            # With early stopping, a candidate is dropped as soon as it is unlikely to beat the best so far. Its score
+            # and subscores are then those of the examples it was evaluated on, and it ranks after the others.
+            best_score = max(scores) if self.early_stopping and scores else None
+            result = evaluate.race(program2, best_score)
+            score, subscores = result.score, result.scores
+
+            if result.abandoned:
+                print('Dropped set:', [len(predictor.demos) for predictor in program2.predictors()],
+                      f'after {result.num_evaluated} examples, with score', score)
+                score_data.append((score, subscores, seed, program2))
+                continue
 
-            score, subscores = evaluate(program2, return_all_scores=True)
+            print('Score:', score, 'for set:', [len(predictor.demos) for predictor in program2.predictors()])
 
             all_subscores.append(subscores)
 
-            print('Score:', score, 'for set:', [len(predictor.demos) for predictor in program2.predictors()])
-
             if len(scores) == 0 or score > max(scores):
                 print('New best score:', score, 'for seed', seed)
                 best_program = program2
@@ -112,9 +128,12 @@ class BootstrapFewShotWithRandomSearch(Teleprompter):
 
             score_data.append((score, subscores, seed, program2))
 
-            if len(score_data) > 2:  # We check if there are at least 3 scores to consider
+            # Only the candidates evaluated on the whole valset
+            complete_score_data = [data for data in score_data if self._complete(data)]
+
+            if len(complete_score_data) > 2:  # We check if there are at least 3 scores to consider
                 for k in [1, 2, 3, 5, 8, 9999]:
-                    top_3_scores = sorted(score_data, key=lambda x: x[0], reverse=True)[:k]
+                    top_3_scores = sorted(complete_score_data, key=lambda x: x[0], reverse=True)[:k]
 
                     # Transpose the subscores to get max per entry and then calculate their average
                     transposed_subscores = zip(*[subscores for _, subscores, *_ in top_3_scores if subscores])
@@ -128,7 +147,8 @@ class BootstrapFewShotWithRandomSearch(Teleprompter):
 
         # To best program, attach all program candidates in decreasing average score
         best_program.candidate_programs = score_data
-        best_program.candidate_programs = sorted(best_program.candidate_programs, key=lambda x: x[0], reverse=True)
+        best_program.candidate_programs = sorted(best_program.candidate_programs, key=lambda x: (self._complete(x), x[0]),
+                                                 reverse=True)
 
         print(len(best_program.candidate_programs), "candidate programs found.")
 
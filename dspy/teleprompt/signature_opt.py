@@ -10,7 +10,7 @@ USAGE SUGGESTIONS:
 The following code can be used to compile a optimized signature teleprompter, and evaluate it on an end task:
 
 teleprompter = SignatureOptimizer(metric=metric, breadth=BREADTH, depth=DEPTH, init_temperature=INIT_TEMPERATURE, prompt_model=prompt_model, output_dir=optimizedV1_output_dir)
-kwargs = dict(num_threads=NUM_THREADS, display_progress=True, display_table=0)
+kwargs = dict(num_threads=NUM_THREADS, display_progress=True, display_table=0)  # add executor="process" for CPU-bound metrics
 compiled_prompt_opt = teleprompter.compile(program.deepcopy(), devset=devset[:DEV_NUM], eval_kwargs=kwargs)
 eval_score = evaluate(compiled_prompt_opt, devset=evalset[:EVAL_NUM], **kwargs)
 
@@ -22,6 +22,7 @@ Note that this teleprompter takes in the following parameters:
 * init_temperature: The temperature used to generate new prompts. Higher roughly equals more creative. Default=1.4.
 * prompt_model: The model used for prompt generation.
 * verbose: Tells the method whether or not to print intermediate steps.
+* early_stopping: Stop evaluating a candidate once it is unlikely to beat the best one so far. Default=False.
 
 """
 class BasicGenerateInstruction(Signature):
@@ -39,13 +40,14 @@ class GenerateInstructionGivenAttempts(Signature):
         proposed_prefix_for_output_field = dspy.OutputField(desc="The string at the end of the prompt, which will help the model start solving the task")
 
 class SignatureOptimizer(Teleprompter):
-    def __init__(self, metric=None, breadth=10, depth=3, init_temperature=1.4, prompt_model="gpt-3.5-turbo-1106", verbose=False):
+    def __init__(self, metric=None, breadth=10, depth=3, init_temperature=1.4, prompt_model="gpt-3.5-turbo-1106", verbose=False, early_stopping=False):
         self.metric = metric
         self.breadth = breadth
         self.depth = depth
         self.init_temperature = init_temperature
         self.prompt_model = prompt_model
         self.verbose = verbose
+        self.early_stopping = early_stopping
 
     def _check_candidates_equal(self, candidate1, candidate2):
         for p1, p2 in zip(candidate1["program"].predictors(), candidate2["program"].predictors()):
@@ -55,6 +57,10 @@ class SignatureOptimizer(Teleprompter):
                 return False
         return True
 
+    def _rank(self, candidate):
+        # Candidates dropped by early stopping were only scored on part of the devset: they rank below the rest.
+        return (not candidate['abandoned'], candidate['score'])
+
     def _drop_duplicates(self, candidates):
         final_candidates = []
         last_batch = []
@@ -131,7 +137,12 @@ class SignatureOptimizer(Teleprompter):
                             print(f"i: {predictor.extended_signature.instructions}")
                             print(f"p: {predictor.extended_signature.fields[-1].name}")
                             print()
-                    score = evaluate(module_clone, devset=devset, **eval_kwargs)
+                    # With early stopping, candidates unlikely to beat this predictor's best so far are dropped
+                    # partway, scored on the examples they were evaluated on.
+                    scores = [c["score"] for c in evaluated_candidates[id(p_old)] if not c["abandoned"]]
+                    best_score = max(scores) if self.early_stopping and scores else None
+                    result = evaluate.race(module_clone, best_score, devset=devset)
+                    score = result.score
                     total_calls += 1
                     if (self.verbose):
                         print(f"----------------")
@@ -142,12 +153,13 @@ class SignatureOptimizer(Teleprompter):
                         "program": module_clone.deepcopy(),
                         "instruction": instruction,
                         "prefix": prefix,
-                        "depth": d
+                        "depth": d,
+                        "abandoned": result.abandoned,
                     })
                 
                 # Now that we've evaluated the candidates, set this predictor to the best performing version
                 # to ensure the next round of scores reflect the best possible version
-                best_candidate = max(evaluated_candidates[id(p_old)], key=lambda candidate: candidate['score'])
+                best_candidate = max(evaluated_candidates[id(p_old)], key=self._rank)
                 p_new.extended_signature.instructions = best_candidate["instruction"]
                 p_new.extended_signature.fields[-1] = p_new.extended_signature.fields[-1]._replace(name=best_candidate["prefix"])
                 if (self.verbose):
@@ -160,23 +172,24 @@ class SignatureOptimizer(Teleprompter):
                         print()
 
             for predictor_candidate_list in evaluated_candidates.values():
-                predictor_candidate_list.sort(key=lambda x: x['score'], reverse=True)
+                predictor_candidate_list.sort(key=self._rank, reverse=True)
 
             if d == self.depth-1:
                 break
 
-            # Build Few-Shot Example of Optimized Prompts
+            # Build Few-Shot Example of Optimized Prompts, from the candidates scored on the whole devset only
+            completed_candidates = {id(p): [c for c in evaluated_candidates[id(p)] if not c["abandoned"]] for p in module.predictors()}
             attempts = {}
             shortest_len = self.breadth
             for p in module.predictors():
                 attempts[id(p)] = [] # Initialize as empty list
-                shortest_len = min(len(evaluated_candidates[id(p)]),shortest_len)
+                shortest_len = min(len(completed_candidates[id(p)]),shortest_len)
                 
             for i in range(shortest_len-1,-1,-1):
                 for p_base in module.predictors():
-                    attempts[id(p_base)].append(f'Instruction #{shortest_len-i}: {evaluated_candidates[id(p_base)][i]["instruction"]}')
-                    attempts[id(p_base)].append(f'Prefix #{shortest_len-i}: {evaluated_candidates[id(p_base)][i]["prefix"]}')
-                    attempts[id(p_base)].append(f'Resulting Score #{shortest_len-i}: {evaluated_candidates[id(p_base)][i]["score"]}')
+                    attempts[id(p_base)].append(f'Instruction #{shortest_len-i}: {completed_candidates[id(p_base)][i]["instruction"]}')
+                    attempts[id(p_base)].append(f'Prefix #{shortest_len-i}: {completed_candidates[id(p_base)][i]["prefix"]}')
+                    attempts[id(p_base)].append(f'Resulting Score #{shortest_len-i}: {completed_candidates[id(p_base)][i]["score"]}')
             
             # Generate next batch of potential prompts to optimize, with previous attempts as input
             new_candidates = {}
@@ -193,7 +206,7 @@ class SignatureOptimizer(Teleprompter):
             latest_candidates = new_candidates
 
         for candidate_list in evaluated_candidates.values():
-            candidate_list.sort(key=lambda x: x['score'], reverse=True)
+            candidate_list.sort(key=self._rank, reverse=True)
 
         best_program = evaluated_candidates[id(p_old)][0]["program"] # Uses python loose scoping to get the best candidate from the last round
 
@@ -201,7 +214,7 @@ class SignatureOptimizer(Teleprompter):
         for predictor in module.predictors():
             candidates.extend(evaluated_candidates[id(predictor)])
 
-        candidates.sort(key=lambda x: x['score'], reverse=True)
+        candidates.sort(key=self._rank, reverse=True)
         candidates = self._drop_duplicates(candidates)
 
         best_program.candidate_programs = candidates
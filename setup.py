@@ -25,7 +25,8 @@ setup(
         "pinecone": ["pinecone-client~=2.2.4"],
         "qdrant": ["qdrant-client~=1.6.2", "fastembed~=0.1.0"],
         "chromadb": ["chromadb~=0.4.14"],
-        "marqo": ["marqo"]
+        "marqo": ["marqo"],
+        "async": ["aiohttp~=3.8"]
     },
     classifiers=[
         "Development Status :: 3 - Alpha",
@@ -0,0 +1,120 @@
+import os
+import json
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+# The caches are created when `dsp` is first imported: keep them out of the home directory.
+os.environ.setdefault("DSP_CACHEDIR", tempfile.mkdtemp(prefix="dsp-test-cache-"))
+
+from dsp.modules.lm import LM  # noqa: E402
+
+
+class DummyLM(LM):
+    """Answers every prompt with `answer(prompt, **kwargs)`, a string, or the next string of a list, and records the
+    prompts it was given."""
+
+    def __init__(self, answer="", model="dummy"):
+        super().__init__(model)
+        self.answer = answer
+        self.prompts = []
+
+    def basic_request(self, prompt, **kwargs):
+        self.prompts.append(prompt)
+
+        if callable(self.answer):
+            text = self.answer(prompt, **kwargs)
+        elif isinstance(self.answer, list):
+            text = self.answer.pop(0)
+        else:
+            text = self.answer
+
+        response = dict(prompt=prompt, choices=[dict(text=text)] * kwargs.get("n", 1))
+        self.history.append(dict(prompt=prompt, response=response, kwargs=kwargs))
+
+        return response
+
+    def __call__(self, prompt, only_completed=True, return_sorted=False, **kwargs):
+        return [choice["text"] for choice in self.basic_request(prompt, **{**self.kwargs, **kwargs})["choices"]]
+
+
+@pytest.fixture
+def dummy_lm():
+    return DummyLM
+
+
+class FakeServer(ThreadingHTTPServer):
+    """A TGI and vLLM look-alike that records the requests it gets.
+
+    `/generate` answers `completion(prompt)`, `/v1/completions` does so for each of its prompts, and the streaming
+    endpoints send `events`. Responses carry `content_type`, or no Content-Type if it is None.
+    """
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeHandler)
+
+        self.requests = []
+        self.connections = set()
+        self.completion = lambda prompt: f"completion of {prompt}"
+        self.events = []
+        self.content_type = "application/json"
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def reply(self, path, body):
+        if path == "/generate":
+            return {"generated_text": self.completion(body["inputs"])}
+
+        if path == "/v1/completions":
+            prompts = body["prompt"] if isinstance(body["prompt"], list) else [body["prompt"]]
+            return {"choices": [{"index": i, "text": self.completion(p)} for i, p in enumerate(prompts)]}
+
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.requests.append((self.path, body))
+        self.server.connections.add(self.client_address)
+
+        if self.path == "/generate_stream" or body.get("stream"):
+            events = "".join(f"data: {json.dumps(event, ensure_ascii=False)}\n\n" for event in self.server.events)
+            data = (events + "data: [DONE]\n\n").encode("utf-8")
+            content_type = self.server.content_type and "text/event-stream"
+        else:
+            data = json.dumps(self.server.reply(self.path, body)).encode("utf-8")
+            content_type = self.server.content_type
+
+        self.send_response(200)
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def make_server():
+    servers = []
+
+    def make_server():
+        server = FakeServer()
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield make_server
+
+    for server in servers:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,107 @@
+import threading
+
+import pytest
+
+import dsp
+import dspy
+
+
+def echo_lm(dummy_lm):
+    """Answers each question with its upper-cased text."""
+    return dummy_lm(lambda prompt, **kwargs: prompt.rsplit("Question: ", 1)[1].split("\n")[0].upper())
+
+
+class Shout(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.predict = dspy.Predict("question -> answer")
+
+    def forward(self, question):
+        if question == "fail":
+            raise ValueError(question)
+
+        return self.predict(question=question)
+
+
+def test_batch_returns_results_in_order_and_runs_duplicates_once(dummy_lm):
+    lm = echo_lm(dummy_lm)
+    questions = ["a", "b", "a", "c", "b", "a", "d"]
+
+    with dsp.settings.context(lm=lm):
+        predictions = dspy.Predict("question -> answer").batch([dict(question=q) for q in questions], num_threads=4)
+
+    assert [p.answer for p in predictions] == [q.upper() for q in questions]
+    assert len(lm.prompts) == 4
+
+
+def test_batch_returns_or_raises_the_errors_of_items(dummy_lm):
+    inputs = [dict(question="a"), dict(question="fail"), dict(question="b")]
+
+    with dsp.settings.context(lm=echo_lm(dummy_lm)):
+        a, error, b = Shout().batch(inputs)
+
+        assert (a.answer, b.answer) == ("A", "B")
+        assert isinstance(error, ValueError)
+
+        with pytest.raises(ValueError):
+            Shout().batch(inputs, return_exceptions=False)
+
+
+def test_batch_passes_only_the_inputs_of_examples(dummy_lm):
+    examples = [dspy.Example(question="a", answer="gold").with_inputs("question")]
+
+    with dsp.settings.context(lm=echo_lm(dummy_lm)):
+        assert Shout().batch(examples)[0].answer == "A"
+
+
+def test_batch_runs_with_the_callers_settings(dummy_lm):
+    lm, results = echo_lm(dummy_lm), []
+
+    def caller():
+        with dsp.settings.context(lm=lm):
+            results.extend(dspy.Predict("question -> answer").batch([dict(question="a"), dict(question="b")]))
+
+    thread = threading.Thread(target=caller)
+    thread.start()
+    thread.join()
+
+    assert [p.answer for p in results] == ["A", "B"]
+    assert dsp.settings.lm is None
+
+
+def test_identical_requests_of_different_items_are_sent_once(dummy_lm):
+    class TwoStages(dspy.Module):
+        def __init__(self):
+            super().__init__()
+            self.first = dspy.Predict("question -> answer")
+            self.second = dspy.Predict("topic -> answer")
+
+        def forward(self, question):
+            return self.first(question=question), self.second(topic="the same for all")
+
+    lm = dummy_lm("an answer")
+
+    with dsp.settings.context(lm=lm):
+        TwoStages().batch([dict(question=f"q{i}") for i in range(10)])
+
+    assert len(lm.prompts) == 11
+
+
+def test_coalescer_lets_duplicates_retry_after_a_failure():
+    coalescer, calls = dsp.Coalescer(), []
+
+    def generator(prompt, **kwargs):
+        calls.append(prompt)
+        if len(calls) == 1:
+            raise ConnectionError(prompt)
+        return ["completion"]
+
+    with pytest.raises(ConnectionError):
+        coalescer(generator, "prompt", temperature=0.0)
+
+    assert coalescer(generator, "prompt", temperature=0.0) == ["completion"]
+    assert coalescer(generator, "prompt", temperature=0.0) == ["completion"]
+    assert coalescer(generator, "prompt", temperature=0.7) == ["completion"]
+
+    assert len(calls) == 3
+    assert (coalescer.num_requests, coalescer.num_coalesced) == (4, 1)
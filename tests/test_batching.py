@@ -0,0 +1,94 @@
+import gc
+import time
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dsp.modules.batching import MicroBatcher
+
+
+def recording_batcher(**kwargs):
+    batches = []
+
+    async def batch_fn(items):
+        batches.append(list(items))
+        await asyncio.sleep(0.01)
+        return [item * 10 for item in items]
+
+    return MicroBatcher(batch_fn, **kwargs), batches
+
+
+def test_concurrent_calls_from_threads_are_batched():
+    batcher, batches = recording_batcher(max_batch_size=8, window=0.05)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(batcher, range(8)))
+
+    assert results == [i * 10 for i in range(8)]
+    assert sorted(len(batch) for batch in batches) == [8]
+    assert (batcher.num_items, batcher.num_batches) == (8, 1)
+
+
+def test_batches_are_split_by_size_and_key():
+    batcher, batches = recording_batcher(max_batch_size=3, window=0.05, key=lambda item: item % 2)
+
+    futures = [batcher.submit(i) for i in range(10)]
+
+    assert [future.result() for future in futures] == [i * 10 for i in range(10)]
+    assert all(len(batch) <= 3 and len({item % 2 for item in batch}) == 1 for batch in batches)
+    assert sorted(item for batch in batches for item in batch) == list(range(10))
+
+
+def test_coroutines_are_batched():
+    batcher, batches = recording_batcher(max_batch_size=16, window=0.05)
+
+    async def main():
+        return await asyncio.gather(*[batcher.acall(i) for i in range(5)])
+
+    assert asyncio.run(main()) == [0, 10, 20, 30, 40]
+    assert batches == [[0, 1, 2, 3, 4]]
+
+
+def test_errors_reach_only_their_callers():
+    async def batch_fn(items):
+        return [ValueError(item) if item == 1 else item for item in items]
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=3, window=0.05)
+    futures = [batcher.submit(i) for i in range(3)]
+
+    assert futures[0].result() == 0 and futures[2].result() == 2
+    with pytest.raises(ValueError):
+        futures[1].result()
+
+
+def test_a_failed_batch_fails_all_its_callers():
+    async def batch_fn(items):
+        raise RuntimeError("server down")
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=2, window=0.05)
+    futures = [batcher.submit(i) for i in range(2)]
+
+    for future in futures:
+        with pytest.raises(RuntimeError):
+            future.result(timeout=5)
+
+
+def test_dispatches_in_flight_survive_garbage_collection():
+    release = threading.Event()
+
+    async def batch_fn(items):
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+        return items
+
+    batcher = MicroBatcher(batch_fn, max_batch_size=1)
+    future = batcher.submit("item")
+
+    while not batcher._tasks:
+        time.sleep(0.001)
+
+    gc.collect()
+    release.set()
+
+    assert future.result(timeout=5) == "item"
@@ -0,0 +1,290 @@
+import os
+import time
+import asyncio
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dsp.modules.cache_backends import JoblibCache, MemoryCache, ShardedSQLiteCache
+from dsp.modules.cache_utils import create_cache_memory
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_forked_child_does_not_wait_for_parent_flights():
+    cache = MemoryCache()
+    started, release = threading.Event(), threading.Event()
+
+    @cache.cache
+    def slow(x):
+        started.set()
+        release.wait()
+        return x
+
+    leader = threading.Thread(target=slow, args=(1,))
+    leader.start()
+    started.wait()
+
+    pid = os.fork()
+
+    if pid == 0:
+        # The leader of this key did not survive the fork: the child must make the call itself.
+        signal.alarm(5)
+        release.set()
+        os._exit(0 if slow(1) == 1 else 1)
+
+    _, status = os.waitpid(pid, 0)
+    release.set()
+    leader.join()
+
+    assert os.WIFEXITED(status) and os.WEXITSTATUS(status) == 0
+
+
+def test_sqlite_cache_round_trips_across_instances(tmp_path):
+    cache = ShardedSQLiteCache(str(tmp_path), num_shards=2)
+
+    assert cache.get("ns", "ab12") == (False, None)
+    cache.set("ns", "ab12", {"text": "hi"})
+    assert cache.get("ns", "ab12") == (True, {"text": "hi"})
+
+    reopened = ShardedSQLiteCache(str(tmp_path), num_shards=2)
+    assert reopened.get("ns", "ab12") == (True, {"text": "hi"})
+    assert reopened.get("other", "ab12") == (False, None)
+    assert sorted(reopened.items()) == [("ns", "ab12", {"text": "hi"})]
+
+
+def test_sqlite_cache_evicts_least_recently_used(tmp_path):
+    cache = ShardedSQLiteCache(str(tmp_path), num_shards=1, max_entries=10)
+
+    for i in range(10):
+        cache.set("ns", f"{i:08x}", i)
+
+    assert cache.get("ns", f"{0:08x}")[0]  # now the most recently used
+    cache.set("ns", f"{10:08x}", 10)
+
+    stats = cache.stats()
+    assert stats.evictions == 2 and stats.entries == 9
+    assert cache.get("ns", f"{0:08x}")[0]
+    assert not cache.get("ns", f"{1:08x}")[0] and not cache.get("ns", f"{2:08x}")[0]
+    assert cache.get("ns", f"{10:08x}")[0]
+
+
+def test_sqlite_cache_expires_entries_after_ttl(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(time, "time", lambda: now[0])
+
+    cache = ShardedSQLiteCache(str(tmp_path), num_shards=1, ttl=60)
+    cache.set("ns", "ab12", 1)
+
+    now[0] += 59
+    assert cache.get("ns", "ab12") == (True, 1)
+
+    now[0] += 2
+    assert cache.get("ns", "ab12") == (False, None)
+    assert cache.stats().expirations == 1
+
+
+def test_joblib_cache_round_trips_and_lists_entries(tmp_path):
+    cache = JoblibCache(str(tmp_path))
+
+    cache.set("dsp/modules/gpt3/request", "ab12", [1, 2])
+
+    assert cache.get("dsp/modules/gpt3/request", "ab12") == (True, [1, 2])
+    assert cache.get("dsp/modules/gpt3/request", "cd34") == (False, None)
+    assert list(JoblibCache(str(tmp_path)).items()) == [("dsp/modules/gpt3/request", "ab12", [1, 2])]
+
+
+@pytest.mark.parametrize("backend", ["joblib", "sqlite"])
+def test_cached_functions_call_through_once(tmp_path, backend):
+    cache = create_cache_memory(str(tmp_path), backend=backend)
+    calls = []
+
+    @cache.cache(ignore=["client"])
+    def request(prompt, client, temperature=0.0):
+        calls.append(prompt)
+        return prompt.upper()
+
+    assert request("hi", object()) == request("hi", object()) == "HI"
+    assert request("hi", object(), temperature=0.5) == "HI"
+    assert calls == ["hi", "hi"]
+
+    request.store("stored", "ho", None)
+    assert request.check_call_in_cache("ho", None)
+    assert request("ho", None) == "stored"
+
+
+def test_create_cache_memory_rejects_unknown_backends(tmp_path):
+    with pytest.raises(ValueError):
+        create_cache_memory(str(tmp_path), backend="redis")
+
+
+def test_memory_cache_evicts_least_recently_used_entries():
+    cache = MemoryCache(max_entries=2)
+
+    cache.set("ns", "a", 1)
+    cache.set("ns", "b", 2)
+    assert cache.get("ns", "a") == (True, 1)
+    cache.set("ns", "c", 3)
+
+    assert cache.get("ns", "b") == (False, None)
+    assert cache.get("ns", "a") == (True, 1) and cache.get("ns", "c") == (True, 3)
+
+    stats = cache.stats()
+    assert (stats.hits, stats.misses, stats.evictions, stats.entries) == (3, 1, 1, 2)
+
+
+def test_memory_cache_is_bounded_by_pickled_size():
+    cache = MemoryCache(max_bytes=3000)
+
+    for i in range(10):
+        cache.set("ns", str(i), "x" * 1000)
+
+    assert cache.stats().bytes <= 3000
+    assert cache.get("ns", "9")[0] and not cache.get("ns", "0")[0]
+
+    cache.set("ns", "huge", "x" * 10_000)
+    assert not cache.get("ns", "huge")[0]
+
+
+def test_memory_cache_resize_evicts_right_away():
+    cache = MemoryCache()
+
+    for i in range(5):
+        cache.set("ns", str(i), i)
+
+    cache.resize(max_entries=2)
+
+    assert [key for _, key, _ in cache.items()] == ["3", "4"]
+
+
+def test_memo_tier_serves_repeated_calls_without_the_persistent_tier(tmp_path):
+    disk = create_cache_memory(str(tmp_path), backend="sqlite")
+    memo = MemoryCache(max_entries=100)
+
+    @disk.cache
+    def request(prompt):
+        return prompt.upper()
+
+    @memo.cache
+    def request_wrapped(prompt):
+        return request(prompt)
+
+    assert request_wrapped("hi") == request_wrapped("hi") == "HI"
+    assert (memo.stats().hits, disk.stats().hits, disk.stats().misses) == (1, 0, 1)
+
+
+def test_settings_expose_cache_stats():
+    import dsp
+
+    stats = dsp.settings.cache_stats
+
+    assert {"memory", "disk"} <= set(stats)
+    assert {"hits", "misses", "evictions", "coalesced"} <= set(stats.memory)
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.001)
+
+
+def test_concurrent_identical_calls_are_made_once():
+    cache, calls, release = MemoryCache(), [], threading.Event()
+
+    @cache.cache
+    def request(prompt):
+        calls.append(prompt)
+        release.wait()
+        return prompt.upper()
+
+    with ThreadPoolExecutor(8) as pool:
+        futures = [pool.submit(request, "hi") for _ in range(8)]
+        wait_for(lambda: cache.flights.num_coalesced == 7)
+        release.set()
+
+        assert [future.result() for future in futures] == ["HI"] * 8
+
+    assert calls == ["hi"]
+
+
+def test_followers_get_the_leaders_error_and_later_calls_retry():
+    cache, calls, release = MemoryCache(), [], threading.Event()
+
+    @cache.cache
+    def request(prompt):
+        calls.append(prompt)
+        release.wait()
+        raise ConnectionError(prompt)
+
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(request, "hi") for _ in range(4)]
+        wait_for(lambda: cache.flights.num_coalesced == 3)
+        release.set()
+
+        for future in futures:
+            with pytest.raises(ConnectionError):
+                future.result()
+
+    with pytest.raises(ConnectionError):
+        request("hi")
+
+    assert calls == ["hi", "hi"]
+
+
+def test_async_twins_share_calls_in_flight():
+    cache, calls, release = MemoryCache(), [], threading.Event()
+
+    @cache.cache(name="request")
+    def request(prompt):
+        calls.append("sync")
+        release.wait()
+        return prompt.upper()
+
+    @cache.cache(name="request")
+    async def arequest(prompt):
+        calls.append("async")
+        return prompt.upper()
+
+    async def main():
+        with ThreadPoolExecutor(1) as pool:
+            leader = asyncio.get_running_loop().run_in_executor(pool, request, "hi")
+            await asyncio.to_thread(wait_for, lambda: calls == ["sync"])
+
+            follower = asyncio.create_task(arequest("hi"))
+            await asyncio.to_thread(wait_for, lambda: cache.flights.num_coalesced == 1)
+            release.set()
+
+            return await leader, await follower
+
+    assert asyncio.run(main()) == ("HI", "HI")
+    assert calls == ["sync"]
+
+
+def test_a_follower_takes_over_when_the_leader_is_cancelled():
+    cache, calls = MemoryCache(), []
+
+    @cache.cache(name="request")
+    def request(prompt):
+        calls.append("sync")
+        return prompt.upper()
+
+    @cache.cache(name="request")
+    async def arequest(prompt):
+        calls.append("async")
+        await asyncio.sleep(10)
+
+    async def main():
+        leader = asyncio.create_task(arequest("hi"))
+        await asyncio.sleep(0)
+
+        follower = asyncio.get_running_loop().run_in_executor(None, request, "hi")
+        await asyncio.to_thread(wait_for, lambda: cache.flights.num_coalesced == 1)
+        leader.cancel()
+
+        return await follower
+
+    assert asyncio.run(main()) == "HI"
+    assert calls == ["async", "sync"]
+    assert request("hi") == "HI" and len(calls) == 2
@@ -0,0 +1,120 @@
+import gzip
+import pickle
+
+import pytest
+
+from dsp.modules.cache_bundle import (
+    cache_bundle_info, export_cache_bundle, import_cache_bundle, merge_cache_bundles, read_cache_bundle, record_cache,
+)
+from dsp.modules.cache_utils import CacheMemory, MemoCache, cache_tiers
+
+
+calls = []
+
+
+@CacheMemory.cache
+def request(prompt):
+    calls.append(prompt)
+    return prompt.upper()
+
+
+@MemoCache.cache
+def request_wrapped(prompt):
+    return request(prompt)
+
+
+def forget_everything():
+    for tier in cache_tiers().values():
+        tier.clear()
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    calls.clear()
+    forget_everything()
+
+
+def test_recorded_entries_can_be_imported_elsewhere(tmp_path):
+    bundle = str(tmp_path / "run.dspcache")
+    request_wrapped("unrelated")
+    request_wrapped("hi")
+
+    # The in-memory tier already holds "hi", yet the persistent entry behind it is recorded.
+    with record_cache() as recorder:
+        assert request_wrapped("hi") == "HI"
+
+    assert export_cache_bundle(bundle, recorder) == dict(entries=1, tiers=dict(disk=1))
+    assert [entry[::3] for entry in read_cache_bundle(bundle)] == [("disk", "HI")]
+
+    forget_everything()
+
+    assert import_cache_bundle(bundle) == dict(imported=1, existing=0, skipped=0)
+    assert request_wrapped("hi") == "HI"
+    assert calls == ["unrelated", "hi"]
+
+    assert import_cache_bundle(bundle) == dict(imported=0, existing=1, skipped=0)
+    assert import_cache_bundle(bundle, overwrite=True) == dict(imported=1, existing=0, skipped=0)
+
+
+def test_exports_everything_without_a_recorder(tmp_path):
+    bundle = str(tmp_path / "all.dspcache")
+
+    for prompt in ["a", "b", "c"]:
+        request_wrapped(prompt)
+
+    assert export_cache_bundle(bundle).entries == 3
+    assert cache_bundle_info(bundle).entries == 3
+
+
+def test_merged_bundles_prefer_later_ones(tmp_path):
+    first, second, merged = (str(tmp_path / name) for name in ["first", "second", "merged"])
+
+    request("a"), request("b")
+    export_cache_bundle(first)
+
+    forget_everything()
+    request.store("B from elsewhere", "b")
+    export_cache_bundle(second)
+
+    assert merge_cache_bundles(merged, first, second).entries == 2
+
+    forget_everything()
+    import_cache_bundle(merged)
+
+    assert (request("a"), request("b")) == ("A", "B from elsewhere")
+
+    info = cache_bundle_info(merged)
+    assert info.format == "dsp-cache-bundle" and info.entries == 2 and list(info.namespaces.values()) == [2]
+
+
+def test_entries_of_tiers_not_enabled_here_are_skipped(tmp_path):
+    bundle = str(tmp_path / "bundle")
+
+    with gzip.open(bundle, "wb") as f:
+        pickle.dump(dict(format="dsp-cache-bundle", version=1), f)
+        pickle.dump(("notebook", "ns", "ab12", 1), f)
+        pickle.dump(("memory", "ns", "ab12", 1), f)
+        pickle.dump("end", f)
+
+    assert import_cache_bundle(bundle) == dict(imported=0, existing=0, skipped=2)
+
+
+def test_invalid_bundles_are_rejected(tmp_path):
+    bundle = str(tmp_path / "bundle")
+    request("a")
+    export_cache_bundle(bundle)
+
+    with open(bundle, "rb") as f:
+        data = gzip.decompress(f.read())
+
+    with gzip.open(bundle, "wb") as f:
+        f.write(data[:-10])
+
+    with pytest.raises(ValueError, match="truncated"):
+        list(read_cache_bundle(bundle))
+
+    with gzip.open(bundle, "wb") as f:
+        pickle.dump(dict(format="something else"), f)
+
+    with pytest.raises(ValueError, match="not a cache bundle"):
+        import_cache_bundle(bundle)
@@ -0,0 +1,218 @@
+import json
+import random
+import statistics
+import time
+
+import pytest
+
+import dsp
+import dspy
+from dspy.evaluate.evaluate import Evaluate, RunningScore
+
+
+def shout(question):
+    return dspy.Prediction(answer=question.upper())
+
+
+def exact_match(example, prediction):
+    return float(example.answer == prediction.answer)
+
+
+def make_devset(n, wrong=()):
+    return [
+        dspy.Example(question=f"q{i}", answer=f"Q{i}" if i not in wrong else "wrong").with_inputs("question")
+        for i in range(n)
+    ]
+
+
+def test_stream_yields_each_example_with_its_position():
+    devset = make_devset(20, wrong={3})
+
+    def slow_shout(question):
+        time.sleep(random.random() / 100)
+        return shout(question)
+
+    results = list(Evaluate(devset=devset, metric=exact_match, num_threads=4).stream(slow_shout))
+
+    assert sorted(idx for idx, *_ in results) == list(range(20))
+    assert all(example is devset[idx] and prediction.answer == example.question.upper()
+               for idx, example, prediction, _ in results)
+    assert {idx: score for idx, _, _, score in results} == {i: float(i != 3) for i in range(20)}
+
+
+@pytest.mark.parametrize("num_threads", [1, 4])
+def test_call_returns_all_scores_in_devset_order(num_threads):
+    evaluate = Evaluate(devset=make_devset(10, wrong={0, 5}), metric=exact_match, num_threads=num_threads,
+                        display=False)
+
+    score, scores = evaluate(shout, return_all_scores=True)
+
+    assert score == 80.0
+    assert scores == [float(i not in (0, 5)) for i in range(10)]
+
+
+def test_results_are_written_to_a_jsonl_sink(tmp_path):
+    path = tmp_path / "results.jsonl"
+    Evaluate(devset=make_devset(5, wrong={2}), metric=exact_match, num_threads=2, display=False)(shout, sink=str(path))
+
+    records = sorted((json.loads(line) for line in path.read_text().splitlines()), key=lambda r: r["example_idx"])
+
+    assert [r["score"] for r in records] == [1.0, 1.0, 0.0, 1.0, 1.0]
+    assert records[2]["example"] == dict(question="q2", answer="wrong")
+    assert records[2]["prediction"] == dict(answer="Q2")
+
+
+def test_only_the_displayed_rows_are_kept(monkeypatch):
+    tables = []
+    monkeypatch.setattr(Evaluate, "_display_table", lambda self, data, *args, **kwargs: tables.append((data, kwargs)))
+
+    Evaluate(devset=make_devset(10), metric=exact_match, display_table=3)(shout)
+
+    data, kwargs = tables[0]
+    assert [row["question"] for row in data] == ["q0", "q1", "q2"]
+    assert kwargs == dict(truncated_rows=7)
+
+
+def test_running_score_matches_the_batch_statistics():
+    values = [random.random() for _ in range(100)]
+    stats = RunningScore()
+
+    for value in values:
+        stats.add(value)
+
+    assert stats.count == 100 and stats.total == pytest.approx(sum(values))
+    assert stats.mean == pytest.approx(statistics.mean(values))
+    assert stats.variance == pytest.approx(statistics.variance(values))
+
+
+class CountingDevset:
+    """An iterator over `n` examples that counts those taken from it."""
+
+    def __init__(self, n):
+        self.examples = iter(make_devset(n))
+        self.taken = 0
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        example = next(self.examples)
+        self.taken += 1
+        return example
+
+
+def test_at_most_max_inflight_examples_are_taken_ahead():
+    devset = CountingDevset(50)
+    evaluate = Evaluate(devset=devset, metric=exact_match, num_threads=2, max_inflight=4)
+
+    for consumed, _ in enumerate(evaluate.stream(shout), start=1):
+        assert devset.taken - consumed <= 4
+
+    assert devset.taken == consumed == 50
+
+
+def test_iterator_devsets_are_evaluated(capsys):
+    assert Evaluate(devset=iter(make_devset(10, wrong={1})), metric=exact_match, num_threads=3)(shout) == 90.0
+    assert "9.0 / 10" in capsys.readouterr().out
+
+
+def test_queued_examples_are_cancelled_once_there_are_too_many_errors():
+    calls = []
+
+    def fail(question):
+        calls.append(question)
+        raise ValueError(question)
+
+    with pytest.raises(ValueError):
+        Evaluate(devset=make_devset(100), metric=exact_match, num_threads=2, max_errors=3, display=False)(fail)
+
+    assert len(calls) < 10
+
+
+def test_closing_the_stream_cancels_the_queued_examples():
+    calls = []
+
+    def slow_shout(question):
+        calls.append(question)
+        time.sleep(0.01)
+        return shout(question)
+
+    stream = Evaluate(devset=make_devset(100), metric=exact_match, num_threads=2, max_inflight=4).stream(slow_shout)
+    next(stream), next(stream)
+    stream.close()
+
+    assert len(calls) <= 6
+
+
+def test_upper_bound_shrinks_towards_the_mean():
+    stats, bounds = RunningScore(), []
+
+    for i in range(100):
+        stats.add(float(i % 4 == 0))
+
+        if i + 1 in (16, 32, 64):
+            bounds.append(stats.upper_bound(200))
+            assert stats.mean < bounds[-1] <= (stats.total + 200 - stats.count) / 200
+
+    assert bounds == sorted(bounds, reverse=True)
+    assert stats.upper_bound(100) == stats.mean
+
+
+def test_upper_bound_is_not_overconfident_after_identical_scores():
+    stats = RunningScore()
+
+    for _ in range(16):
+        stats.add(0.0)
+
+    assert stats.variance == 0.0 and stats.upper_bound(1000) > 0.1
+
+
+def test_race_abandons_candidates_unlikely_to_beat_the_best():
+    devset = make_devset(200, wrong=set(range(0, 200, 2)))
+    evaluate = Evaluate(devset=devset, metric=exact_match, display=False)
+
+    raced = evaluate.race(shout, best_score=90.0)
+
+    assert raced.abandoned and raced.num_evaluated < 200
+    assert raced.scores == [float(i % 2 == 1) for i in range(raced.num_evaluated)]
+    assert raced.score == 50.0
+
+    assert evaluate.race(shout, best_score=40.0) == dict(
+        score=50.0, scores=[float(i % 2 == 1) for i in range(200)], num_evaluated=200, abandoned=False,
+    )
+    assert evaluate.race(shout).num_evaluated == 200
+
+
+def fail_on_q1(question):
+    if question == "q1":
+        raise ValueError(question)
+
+    return dspy.Prediction(answer=question.upper(), rate_limit=dsp.settings.rate_limit)
+
+
+class ListSink(list):
+    write = list.append
+
+
+def test_process_workers_evaluate_like_threads():
+    evaluate = Evaluate(devset=make_devset(8, wrong={2}), metric=exact_match, num_threads=2, executor="process",
+                        display=False)
+    sink = ListSink()
+
+    with dsp.settings.context(rate_limit=dict(rpm=100, max_in_flight=4)):
+        score, scores = evaluate(fail_on_q1, return_all_scores=True, sink=sink)
+
+    assert (score, scores) == (75.0, [1.0, 0.0, 0.0, 1.0, 1.0, 1.0, 1.0, 1.0])
+    assert evaluate.error_count == 1
+
+    # The workers share the rate limit.
+    rate_limits = [record["prediction"].get("rate_limit") for record in sink if record["example_idx"] != 1]
+    assert rate_limits == [dict(rpm=50.0, max_in_flight=2)] * 7
+
+
+def test_unpicklable_programs_are_evaluated_with_threads(capsys):
+    evaluate = Evaluate(devset=make_devset(4), metric=lambda example, prediction: 1.0, num_threads=2,
+                        executor="process", display=False)
+
+    assert evaluate(shout) == 100.0
+    assert "Evaluating with threads instead of processes" in capsys.readouterr().out
@@ -0,0 +1,127 @@
+import asyncio
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from dsp.modules.cache_utils import cache_tiers, request_fingerprint
+from dsp.modules.hf_client import HFClientTGI, HFClientVLLM, _apost_balanced, _post_balanced, _stream_events, \
+    send_hftgi_request_v03
+from dsp.modules.load_balancer import LoadBalancer
+
+
+# The clients are `HFModel`s, which need transformers and torch even when they only talk to a server.
+needs_transformers = pytest.mark.skipif(
+    importlib.util.find_spec("transformers") is None or importlib.util.find_spec("torch") is None,
+    reason="needs transformers and torch",
+)
+
+
+@pytest.fixture(autouse=True)
+def empty_caches():
+    for tier in cache_tiers().values():
+        tier.clear()
+
+
+@pytest.mark.parametrize("content_type", ["text/event-stream", None])
+def test_stream_events_decodes_utf8(make_server, content_type):
+    server = make_server()
+    server.content_type = content_type
+    server.events = [{"token": {"text": "hé"}}, {"token": {"text": " 日本"}}]
+
+    balancer = LoadBalancer([f"http://127.0.0.1:{server.port}"])
+    events = list(_stream_events(balancer, "/generate_stream", json={}))
+
+    assert [event["token"]["text"] for event in events] == ["hé", " 日本"]
+
+
+@needs_transformers
+def test_tgi_acall_matches_call_and_shares_its_cache(make_server):
+    server = make_server()
+    lm = HFClientTGI(model="m", port=server.port, url="http://127.0.0.1")
+
+    async def main():
+        return await asyncio.gather(*[lm.acall(f"prompt {i}") for i in range(4)])
+
+    assert asyncio.run(main()) == [[f"completion of prompt {i}"] for i in range(4)]
+    assert lm("prompt 0") == ["completion of prompt 0"]
+    assert len(server.requests) == 4
+    assert len(lm.history) == 5
+
+
+@needs_transformers
+def test_vllm_acall_matches_call(make_server):
+    server = make_server()
+    lm = HFClientVLLM(model="m", port=server.port, url="http://127.0.0.1")
+
+    assert asyncio.run(lm.acall("prompt")) == lm("prompt") == ["completion of prompt"]
+    assert len(server.requests) == 1
+
+
+def test_async_posts_match_blocking_ones(make_server):
+    server = make_server()
+    balancer = LoadBalancer([f"http://127.0.0.1:{server.port}"])
+    payload = {"inputs": "prompt", "parameters": {}}
+
+    response = _post_balanced(balancer, "/generate", json=payload)
+
+    assert asyncio.run(_apost_balanced(balancer, "/generate", json=payload)) == response
+    assert response == {"generated_text": "completion of prompt"}
+
+
+@needs_transformers
+def test_vllm_batches_concurrent_calls_into_one_request(make_server):
+    server = make_server()
+    lm = HFClientVLLM(model="m", port=server.port, url="http://127.0.0.1", max_batch_size=4, batch_window=0.5)
+
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(lm, [f"prompt {i}" for i in range(4)]))
+
+    assert results == [[f"completion of prompt {i}"] for i in range(4)]
+    assert len(server.requests) == 1
+    assert sorted(server.requests[0][1]["prompt"]) == [f"prompt {i}" for i in range(4)]
+
+
+class FakeClient:
+    def __init__(self, completions):
+        self.completions = completions
+        self.payloads = []
+
+    def _send(self, payload):
+        self.payloads.append(payload)
+        return self.completions
+
+
+def test_cached_requests_store_only_the_completions_and_ignore_the_client():
+    payload = {"inputs": "prompt", "parameters": {"max_new_tokens": 10}}
+    fingerprint = request_fingerprint(model="m", **payload)
+    first, second = FakeClient(["a completion"]), FakeClient(["another completion"])
+
+    assert send_hftgi_request_v03(fingerprint, first, payload) == ["a completion"]
+    assert send_hftgi_request_v03(fingerprint, second, payload) == ["a completion"]
+    assert len(first.payloads) == 1 and second.payloads == []
+
+    other = request_fingerprint(model="m", **dict(payload, parameters={"max_new_tokens": 20}))
+    assert send_hftgi_request_v03(other, second, payload) == ["another completion"]
+
+
+@needs_transformers
+def test_tgi_cache_survives_a_change_of_servers(make_server):
+    old, new = make_server(), make_server()
+    lm = HFClientTGI(model="m", port=old.port, url="http://127.0.0.1")
+    resharded = HFClientTGI(model="m", port=[new.port, old.port], url="http://127.0.0.1")
+
+    assert lm("prompt") == resharded("prompt") == ["completion of prompt"]
+    assert len(old.requests) == 1 and new.requests == []
+
+    assert HFClientTGI(model="other", port=new.port, url="http://127.0.0.1")("prompt") == ["completion of prompt"]
+    assert len(new.requests) == 1
+
+
+@needs_transformers
+def test_vllm_cache_survives_a_change_of_servers(make_server):
+    old, new = make_server(), make_server()
+
+    assert HFClientVLLM(model="m", port=old.port, url="http://127.0.0.1")("prompt") == ["completion of prompt"]
+    assert HFClientVLLM(model="m", port=new.port, url="http://127.0.0.1")("prompt") == ["completion of prompt"]
+    assert len(old.requests) == 1 and new.requests == []
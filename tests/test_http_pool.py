@@ -0,0 +1,75 @@
+import asyncio
+import builtins
+
+import pytest
+
+from dsp.modules.http_pool import HTTPSessionPool
+
+
+def test_async_session_without_aiohttp_says_how_to_install_it(monkeypatch):
+    real_import = builtins.__import__
+
+    def import_(name, *args, **kwargs):
+        if name == "aiohttp":
+            raise ImportError("No module named 'aiohttp'")
+        return real_import(name, *args, **kwargs)
+
+    monkeypatch.setattr(builtins, "__import__", import_)
+
+    async def main():
+        return HTTPSessionPool().async_session()
+
+    with pytest.raises(ImportError, match=r"pip install dspy-ai\[async\]"):
+        asyncio.run(main())
+
+
+def test_sessions_are_shared_per_host():
+    pool = HTTPSessionPool()
+
+    assert pool.session("http://a:1/x") is pool.session("http://a:1/y")
+    assert pool.session("http://a:1/x") is not pool.session("http://a:2/x")
+    assert pool.session("http://a:1/x") is not pool.session("https://a:1/x")
+
+
+def test_requests_reuse_kept_alive_connections(make_server):
+    server = make_server()
+    pool = HTTPSessionPool()
+
+    for i in range(5):
+        pool.post(f"http://127.0.0.1:{server.port}/generate", json={"inputs": str(i)}).json()
+
+    assert len(server.requests) == 5
+    assert len(server.connections) == 1
+
+
+def test_configure_replaces_the_sessions():
+    pool = HTTPSessionPool(max_connections=4)
+    session = pool.session("http://a:1")
+
+    pool.configure(max_connections=8, block=False)
+
+    assert pool.session("http://a:1") is not session
+    assert pool.session("http://a:1").get_adapter("http://a:1")._pool_maxsize == 8
+
+
+def test_async_sessions_are_shared_per_event_loop(make_server):
+    server = make_server()
+    pool = HTTPSessionPool()
+
+    async def main():
+        session = pool.async_session()
+
+        for i in range(3):
+            async with pool.async_session().post(f"http://127.0.0.1:{server.port}/generate",
+                                                 json={"inputs": str(i)}) as response:
+                await response.json()
+
+        assert pool.async_session() is session
+        await session.close()
+
+        return session
+
+    first, second = asyncio.run(main()), asyncio.run(main())
+
+    assert first is not second
+    assert len(server.connections) == 2
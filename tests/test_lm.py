@@ -0,0 +1,106 @@
+import copy
+import pickle
+
+import openai
+
+import dsp
+
+from dsp.modules.gpt3 import GPT3
+from dsp.modules.lm import History
+from dspy.evaluate import evaluate
+
+
+def test_pickled_gpt3_leaves_out_credentials_and_history(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", None)
+
+    lm = GPT3(api_key="sk-test")
+    lm.history.append(dict(prompt="hello", response="world"))
+
+    data = pickle.dumps(lm)
+
+    assert b"sk-test" not in data
+    assert len(pickle.loads(data).history) == 0
+    assert list(copy.deepcopy(lm).history) == list(lm.history)
+
+
+def test_history_pickle_keeps_size_and_mode():
+    history = pickle.loads(pickle.dumps(History([dict(prompt="a")], size=3, mode="full")))
+
+    assert (len(history), history.size, history.mode) == (0, 3, "full")
+
+
+def test_process_workers_get_the_client_settings(monkeypatch):
+    monkeypatch.setattr(openai, "api_key", "sk-parent")
+    client_settings = evaluate.openai_client_settings()
+    payload = pickle.dumps((GPT3(), None, dict(dsp.settings.config)))
+
+    monkeypatch.setattr(openai, "api_key", None)
+    evaluate._init_worker(payload, client_settings)
+
+    assert openai.api_key == "sk-parent"
+
+
+def test_acall_runs_clients_without_a_native_implementation_on_a_thread(dummy_lm):
+    import asyncio
+
+    lm = dummy_lm(lambda prompt, **kwargs: prompt.upper())
+
+    async def main():
+        return await asyncio.gather(lm.acall("a"), lm.acall("b"), lm.arequest("c"))
+
+    a, b, c = asyncio.run(main())
+
+    assert (a, b, c["choices"][0]["text"]) == (["A"], ["B"], "C")
+    assert len(lm.history) == 3
+
+
+def test_history_keeps_only_the_most_recent_entries():
+    history = History(size=3)
+
+    for i in range(5):
+        history.append(dict(prompt=f"prompt {i}"))
+
+    assert [entry["prompt"] for entry in history] == ["prompt 2", "prompt 3", "prompt 4"]
+    assert history[-2:] == [dict(prompt="prompt 3"), dict(prompt="prompt 4")]
+    assert history[0] == dict(prompt="prompt 2")
+
+
+def test_history_follows_the_settings_at_each_append():
+    history = History()
+
+    with dsp.settings.context(history_size=2):
+        for i in range(4):
+            history.append(dict(prompt=f"prompt {i}"))
+
+    assert len(history) == 2
+
+    with dsp.settings.context(history_mode="off"):
+        history.append(dict(prompt="ignored"))
+
+    assert history[-1] == dict(prompt="prompt 3")
+
+
+def test_history_metadata_mode_drops_prompts_and_responses():
+    history = History(mode="metadata")
+    history.append(dict(
+        prompt="a long prompt",
+        response={"choices": [{"text": "an answer"}], "usage": {"total_tokens": 7}},
+        kwargs={"prompt": "a long prompt", "temperature": 0.0},
+        raw_kwargs={"temperature": 0.0},
+        timestamp="now",
+    ))
+
+    assert history[0] == dict(
+        timestamp="now", prompt_length=len("a long prompt"), kwargs={"temperature": 0.0}, usage={"total_tokens": 7},
+    )
+
+
+def test_lm_history_is_bounded(dummy_lm):
+    lm = dummy_lm("answer")
+
+    with dsp.settings.context(history_size=5):
+        for i in range(20):
+            lm(f"prompt {i}")
+
+    assert len(lm.history) == 5
+    assert lm.history[-1]["prompt"] == "prompt 19"
@@ -0,0 +1,99 @@
+import socket
+
+import pytest
+
+from dsp.modules import load_balancer
+from dsp.modules.hf_client import _post_balanced
+from dsp.modules.load_balancer import LoadBalancer, PrefixAffinityPolicy
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(load_balancer.time, "monotonic", lambda: now[0])
+    return now
+
+
+def fail(balancer, times, key=None):
+    for _ in range(times):
+        with pytest.raises(ConnectionError):
+            with balancer.endpoint(key):
+                raise ConnectionError
+
+
+def test_endpoints_are_ejected_after_consecutive_failures_until_the_cooldown_ends(clock):
+    balancer = LoadBalancer(["a", "b"], policy=PrefixAffinityPolicy(), max_failures=2, cooldown=30)
+    key = next(k for k in map(str, range(100)) if balancer.acquire(k).url == "a")
+
+    fail(balancer, 2, key)
+
+    assert [e.url for e in balancer.healthy()] == ["b"]
+    with balancer.endpoint(key) as url:
+        assert url == "b"
+
+    clock[0] += 31
+    assert [e.url for e in balancer.healthy()] == ["a", "b"]
+    assert balancer.stats()["a"]["ejections"] == 1
+
+
+def test_a_success_resets_the_failure_count():
+    balancer = LoadBalancer(["a"], max_failures=2)
+
+    fail(balancer, 1)
+    with balancer.endpoint():
+        pass
+    fail(balancer, 1)
+
+    assert balancer.stats()["a"]["ejections"] == 0
+
+
+def test_all_endpoints_are_used_when_all_are_ejected(clock):
+    balancer = LoadBalancer(["a"], max_failures=1)
+
+    fail(balancer, 1)
+
+    with balancer.endpoint() as url:
+        assert url == "a"
+
+
+def test_least_outstanding_spreads_concurrent_requests():
+    balancer = LoadBalancer(["a", "b", "c"])
+
+    assert sorted(balancer.acquire().url for _ in range(3)) == ["a", "b", "c"]
+
+
+def test_prefix_affinity_keeps_keys_on_one_endpoint_and_moves_only_ejected_ones(clock):
+    balancer = LoadBalancer(["a", "b", "c"], policy="prefix", max_failures=1)
+    keys = [f"prefix {i}" for i in range(30)]
+
+    def route():
+        routes = {}
+        for key in keys:
+            with balancer.endpoint(key) as url:
+                routes[key] = url
+        return routes
+
+    before = route()
+    assert route() == before and len(set(before.values())) > 1
+
+    fail(balancer, 1, key=next(key for key in keys if before[key] == "a"))
+    after = route()
+
+    assert all(after[key] == before[key] for key in keys if before[key] != "a")
+    assert "a" not in after.values()
+
+
+def test_requests_that_cannot_connect_are_retried_on_another_server(make_server):
+    server = make_server()
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        dead = f"http://127.0.0.1:{s.getsockname()[1]}"
+
+    balancer = LoadBalancer([dead, f"http://127.0.0.1:{server.port}"], policy="random")
+
+    for _ in range(5):
+        assert _post_balanced(balancer, "/generate", json={"inputs": "x"}) == {"generated_text": "completion of x"}
+
+    assert len(server.requests) == 5
+    assert balancer.stats()[dead]["requests"] == balancer.stats()[dead]["failures"] > 0
@@ -0,0 +1,99 @@
+import dsp
+import dspy
+from dspy.signatures.signature import parse_signature
+
+
+def test_stream_yields_completed_fields_then_the_prediction(dummy_lm):
+    lm = dummy_lm("Paris")
+
+    with dsp.settings.context(lm=lm):
+        predictions = list(dspy.Predict("question -> answer").stream(question="capital of France?"))
+
+    assert predictions[-1].answer == "Paris"
+
+
+def test_chain_of_thought_streams_with_its_rationale(dummy_lm):
+    lm = dummy_lm("find the capital. We know it is Paris.\n\nAnswer: Paris")
+    cot = dspy.ChainOfThought("question -> answer")
+
+    with dsp.settings.context(lm=lm):
+        streamed = list(cot.stream(question="capital of France?"))[-1]
+        called = cot(question="capital of France?")
+
+    assert "Reasoning: Let's think step by step" in lm.prompts[0]
+    assert streamed.rationale == called.rationale == "find the capital. We know it is Paris."
+    assert streamed.answer == called.answer == "Paris"
+
+
+def test_continuation_separates_the_partial_completion_from_the_prompt(dummy_lm):
+    lm = dummy_lm(["we reason about it.", "Paris"])
+    cot = dspy.ChainOfThought("question -> answer")
+
+    with dsp.settings.context(lm=lm, continuation=True):
+        prediction = cot(question="capital of France?")
+
+    assert lm.prompts[1] == lm.prompts[0] + " we reason about it.\nAnswer:"
+    assert prediction.rationale == "we reason about it."
+    assert prediction.answer == "Paris"
+
+
+def test_stream_yields_each_field_once_it_is_complete(dummy_lm):
+    class StreamingLM(dummy_lm):
+        def stream(self, prompt, **kwargs):
+            text = self(prompt, **kwargs)[0]
+            yield from (text[i:i + 3] for i in range(0, len(text), 3))
+
+    lm = StreamingLM("we know it is Paris.\n\nAnswer: Paris")
+
+    with dsp.settings.context(lm=lm):
+        predictions = list(dspy.ChainOfThought("question -> answer").stream(question="capital of France?"))
+
+    assert len(predictions) == 2
+    assert dict(predictions[0]) == dict(rationale="we know it is Paris.")
+    assert (predictions[1].rationale, predictions[1].answer) == ("we know it is Paris.", "Paris")
+
+
+def test_clients_that_cannot_stream_yield_the_whole_completion(dummy_lm):
+    assert list(dummy_lm("Paris").stream("prompt", n=3)) == ["Paris"]
+
+
+def test_fallback_stats_count_the_extra_round_trips(dummy_lm):
+    for continuation in (False, True):
+        lm = dummy_lm(["we reason about it.", "Paris"])
+        dsp.reset_fallback_stats()
+
+        with dsp.settings.context(lm=lm, continuation=continuation):
+            prediction = dspy.ChainOfThought("question -> answer")(question="capital of France?")
+
+        stats = dsp.fallback_stats()
+
+        assert prediction.answer == "Paris" and len(lm.prompts) == 2
+        assert stats.round_trips == 1 and stats.prompt_tokens > 0 and stats.completion_tokens > 0
+        assert (stats.prefix_tokens > 0) == continuation
+
+
+def test_continuation_completes_one_of_several_partial_completions(dummy_lm):
+    lm = dummy_lm(["we reason about it.", "Paris"])
+
+    with dsp.settings.context(lm=lm, continuation=True):
+        prediction = dspy.ChainOfThought("question -> answer", n=3)(question="capital of France?")
+
+    assert len(lm.prompts) == 2 and lm.history[-1]["kwargs"]["n"] == 1
+    assert prediction.answer == "Paris"
+
+
+def test_string_signatures_are_parsed_once():
+    parse_signature.cache_clear()
+
+    first, second = dspy.Predict("context, question -> answer"), dspy.Predict("context, question -> answer")
+
+    assert parse_signature.cache_info().misses == 1 and parse_signature.cache_info().hits == 1
+    assert parse_signature("context, question -> answer") == (
+        "Given the fields `context`, `question`, produce the fields `answer`.", ("context", "question"), ("answer",)
+    )
+    assert [field.name for field in first.signature.fields] == ["Context:", "Question:", "Answer:"]
+
+    first.signature.instructions = "Other instructions."
+    first.signature.fields[-1] = first.signature.fields[-1]._replace(name="Reply:")
+    assert second.signature.instructions.startswith("Given the fields")
+    assert second.signature.fields[-1].name == "Answer:"
@@ -0,0 +1,159 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+import dsp
+from dsp.modules.rate_limiter import RateLimiter, Reservation, TokenBucket, rate_limiter, split_rate_limit, throttle
+
+
+class Peak:
+    """Counts the requests inside the limiter and the most that were inside at once."""
+
+    def __init__(self):
+        self.current = self.peak = 0
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        with self.lock:
+            self.current += 1
+            self.peak = max(self.peak, self.current)
+
+    def __exit__(self, *exc):
+        with self.lock:
+            self.current -= 1
+
+
+def test_token_bucket_makes_callers_queue_for_their_debt():
+    bucket = TokenBucket(per_minute=600)
+
+    assert bucket.reserve(600) == 0.0
+    assert bucket.reserve(1) == pytest.approx(0.1, abs=0.01)
+    assert bucket.reserve(1) == pytest.approx(0.2, abs=0.01)
+
+
+def test_requests_wait_for_the_request_bucket():
+    limiter = RateLimiter(rpm=600)
+    limiter.requests.level = 0
+
+    start = time.monotonic()
+    with limiter.limit():
+        pass
+
+    assert time.monotonic() - start >= 0.09
+    assert limiter.stats()["requests"] == limiter.stats()["delayed"] == 1
+
+
+def test_reservations_refund_the_tokens_they_did_not_use():
+    limiter = RateLimiter(tpm=600)
+
+    with limiter.limit(500) as reservation:
+        assert limiter.tokens.level == pytest.approx(100, abs=1)
+        reservation.update(100)
+
+    assert limiter.tokens.level == pytest.approx(500, abs=1)
+    assert reservation.tokens == 100
+
+
+def test_threads_wait_for_an_in_flight_slot():
+    limiter, peak = RateLimiter(max_in_flight=2), Peak()
+
+    def request():
+        with limiter.limit(), peak:
+            time.sleep(0.02)
+
+    threads = [threading.Thread(target=request) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert peak.peak == 2
+    assert limiter.stats()["requests"] == 8 and limiter.in_flight == 0
+
+
+def test_coroutines_wait_for_an_in_flight_slot():
+    limiter, peak = RateLimiter(max_in_flight=2), Peak()
+
+    async def request():
+        async with limiter.alimit():
+            with peak:
+                await asyncio.sleep(0.02)
+
+    async def main():
+        await asyncio.gather(*[request() for _ in range(8)])
+
+    asyncio.run(main())
+
+    assert peak.peak == 2
+    assert limiter.stats()["requests"] == 8 and limiter.in_flight == 0
+
+
+def test_cancelled_coroutines_do_not_keep_a_slot():
+    limiter = RateLimiter(max_in_flight=1)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def hold():
+            async with limiter.alimit():
+                await release.wait()
+
+        async def request():
+            async with limiter.alimit():
+                return "done"
+
+        holder = asyncio.create_task(hold())
+        await asyncio.sleep(0)
+
+        cancelled, waiting = asyncio.create_task(request()), asyncio.create_task(request())
+        await asyncio.sleep(0)
+
+        cancelled.cancel()
+        release.set()
+
+        assert await asyncio.wait_for(waiting, timeout=1) == "done"
+        await holder
+
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+    asyncio.run(main())
+
+    assert limiter.in_flight == 0
+
+
+def test_split_rate_limit_gives_each_process_an_equal_share():
+    limits = dict(rpm=100, tpm=1000, max_in_flight=3)
+
+    assert split_rate_limit(limits, 4) == dict(rpm=25, tpm=250, max_in_flight=1)
+    assert split_rate_limit(RateLimiter(rpm=100), 4) == dict(rpm=25, tpm=None, max_in_flight=None)
+    assert split_rate_limit(None, 4) is None
+
+
+def test_throttle_is_a_no_op_without_a_limit():
+    with throttle(100) as reservation:
+        assert isinstance(reservation, Reservation) and reservation.limiter is None
+
+    reservation.update(10)
+
+
+def test_threads_configured_with_equal_limits_share_one_limiter():
+    limiters = []
+
+    def request():
+        with dsp.settings.context(rate_limit=dict(rpm=1000, max_in_flight=4)):
+            limiters.append(rate_limiter())
+
+            with throttle(10) as reservation:
+                assert reservation.limiter is limiters[-1]
+
+    threads = [threading.Thread(target=request) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert len(set(map(id, limiters))) == 1
+    assert limiters[0].stats()["requests"] >= 4
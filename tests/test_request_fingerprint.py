@@ -0,0 +1,60 @@
+import pytest
+
+from dsp.modules.cache_backends import Fingerprint, MemoryCache, request_fingerprint
+
+
+def test_fingerprint_ignores_keyword_order():
+    assert request_fingerprint(prompt="hi", temperature=0.7, n=1) == request_fingerprint(n=1, temperature=0.7, prompt="hi")
+    assert request_fingerprint(stop={"a": 1, "b": 2}) == request_fingerprint(stop={"b": 2, "a": 1})
+
+
+def test_fingerprint_normalizes_floats_but_hashes_ints_exactly():
+    assert request_fingerprint(temperature=1.0) == request_fingerprint(temperature=1)
+    assert request_fingerprint(temperature=0.7000000000000001) == request_fingerprint(temperature=0.7)
+
+    assert request_fingerprint(seed=10**15) != request_fingerprint(seed=10**15 + 1)
+    assert request_fingerprint(seed=12345678901234567) != request_fingerprint(seed=12345678901234568)
+
+
+@pytest.mark.parametrize("a, b", [
+    ({"stop": {1: "x"}}, {"stop": {"1": "x"}}),
+    ({"stop": ["a", "b"]}, {"stop": ["ab"]}),
+    ({"x": None}, {"x": "None"}),
+    ({"x": True}, {"x": 1}),
+    ({"x": "1"}, {"x": 1}),
+])
+def test_fingerprint_tells_types_and_boundaries_apart(a, b):
+    assert request_fingerprint(**a) != request_fingerprint(**b)
+
+
+def test_fingerprint_rejects_unknown_types():
+    with pytest.raises(TypeError):
+        request_fingerprint(x=object())
+
+
+def test_precomputed_fingerprints_are_used_as_keys():
+    cache = MemoryCache()
+
+    @cache.cache(ignore=["request"])
+    def send(fingerprint, request):
+        return request["prompt"]
+
+    fingerprint = request_fingerprint(prompt="hi")
+    send(fingerprint, dict(prompt="hi"))
+
+    assert isinstance(fingerprint, Fingerprint)
+    assert [key for _, key, _ in cache.items()] == [fingerprint]
+
+
+def test_arguments_that_cannot_be_fingerprinted_fall_back_to_joblib_hashing():
+    cache = MemoryCache()
+    calls = []
+
+    @cache.cache
+    def send(value):
+        calls.append(value)
+        return value
+
+    value = frozenset([1, 2])
+    assert send(value) == send(value) == value
+    assert calls == [value]
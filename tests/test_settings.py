@@ -0,0 +1,91 @@
+import asyncio
+import pickle
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import dsp
+from dsp.utils.settings import Config, with_context
+
+
+def in_thread(fn):
+    results = []
+    thread = threading.Thread(target=lambda: results.append(fn()))
+    thread.start()
+    thread.join()
+    return results[0]
+
+
+def test_contexts_do_not_leak_into_other_threads():
+    barrier = threading.Barrier(4)
+
+    def run(i):
+        with dsp.settings.context(branch_idx=i):
+            barrier.wait()
+            return dsp.settings.branch_idx
+
+    with ThreadPoolExecutor(4) as pool:
+        assert list(pool.map(run, range(4))) == [0, 1, 2, 3]
+
+    assert dsp.settings.branch_idx == 0
+
+
+def test_contexts_do_not_leak_into_other_tasks():
+    async def run(i):
+        with dsp.settings.context(branch_idx=i):
+            await asyncio.sleep(0.01)
+            return dsp.settings.branch_idx
+
+    async def main():
+        return await asyncio.gather(*[run(i) for i in range(4)])
+
+    assert asyncio.run(main()) == [0, 1, 2, 3]
+
+
+def test_with_context_hands_the_callers_settings_to_other_threads():
+    with dsp.settings.context(branch_idx=7):
+        assert in_thread(lambda: dsp.settings.branch_idx) == 0
+        assert in_thread(with_context(lambda: dsp.settings.branch_idx)) == 7
+
+        bound = with_context(lambda: dsp.settings.branch_idx)
+
+    assert bound() == 7 and dsp.settings.branch_idx == 0
+
+
+def test_configure_from_other_threads_stays_in_that_thread(monkeypatch):
+    monkeypatch.setattr(dsp.settings, "main_config", dsp.settings.main_config)
+
+    def configure():
+        dsp.settings.configure(branch_idx=3)
+        return dsp.settings.branch_idx
+
+    assert in_thread(configure) == 3
+    assert dsp.settings.branch_idx == 0
+
+    dsp.settings.configure(branch_idx=5)
+    assert in_thread(lambda: dsp.settings.branch_idx) == 5
+
+
+def test_configurations_are_immutable_snapshots():
+    config = dsp.settings.config
+
+    with pytest.raises(TypeError):
+        config.lm = "lm"
+    with pytest.raises(TypeError):
+        config["lm"] = "lm"
+    with pytest.raises(TypeError):
+        config.update(lm="lm")
+
+    with dsp.settings.context(branch_idx=2):
+        assert dsp.settings.config is not config and config.branch_idx == 0
+
+    assert pickle.loads(pickle.dumps(config)) == config
+    assert isinstance(pickle.loads(pickle.dumps(config)), Config)
+
+
+def test_unknown_settings_raise_attribute_errors():
+    with pytest.raises(AttributeError):
+        dsp.settings.no_such_setting
+
+    assert getattr(dsp.settings, "no_such_setting", None) is None
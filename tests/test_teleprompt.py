@@ -0,0 +1,69 @@
+import dspy
+from dsp.utils import dotdict
+from dspy.evaluate.evaluate import Evaluate
+from dspy.teleprompt.random_search import BootstrapFewShotWithRandomSearch
+from dspy.teleprompt.signature_opt import SignatureOptimizer
+
+
+class QA(dspy.Module):
+    def __init__(self):
+        super().__init__()
+        self.predict = dspy.Predict("question -> answer")
+
+    def forward(self, question):
+        return self.predict(question=question)
+
+
+def scripted_race(monkeypatch, results):
+    """Makes `Evaluate.race` return `results` in turn, recording the `best_score` of each call."""
+    best_scores = []
+
+    def race(self, program, best_score=None, *args, **kwargs):
+        best_scores.append(best_score)
+        return results.pop(0)
+
+    monkeypatch.setattr(Evaluate, "race", race)
+    return best_scores
+
+
+def test_random_search_ranks_abandoned_candidates_last(monkeypatch):
+    trainset = [dspy.Example(question=f"q{i}?", answer=f"a{i}").with_inputs("question") for i in range(4)]
+    best_scores = scripted_race(monkeypatch, [
+        dotdict(score=50.0, scores=[1, 0, 1, 0], num_evaluated=4, abandoned=False),
+        dotdict(score=100.0, scores=[1], num_evaluated=1, abandoned=True),
+    ])
+
+    optimizer = BootstrapFewShotWithRandomSearch(metric=None, num_candidate_programs=0, early_stopping=True)
+    best = optimizer.compile(QA(), trainset=trainset, restrict=[-3, -2])
+
+    assert best_scores == [None, 50.0]
+    assert [score for score, *_ in best.candidate_programs] == [50.0, 100.0]
+    assert best.predictors()[0].demos == []
+
+
+def test_random_search_evaluates_every_candidate_fully_by_default(monkeypatch):
+    trainset = [dspy.Example(question=f"q{i}?", answer=f"a{i}").with_inputs("question") for i in range(4)]
+    best_scores = scripted_race(monkeypatch, [
+        dotdict(score=50.0, scores=[1, 0, 1, 0], num_evaluated=4, abandoned=False),
+        dotdict(score=75.0, scores=[1, 1, 1, 0], num_evaluated=4, abandoned=False),
+    ])
+
+    optimizer = BootstrapFewShotWithRandomSearch(metric=None, num_candidate_programs=0)
+    best = optimizer.compile(QA(), trainset=trainset, restrict=[-3, -2])
+
+    assert best_scores == [None, None]
+    assert [score for score, *_ in best.candidate_programs] == [75.0, 50.0]
+
+
+def test_signature_optimizer_ranks_abandoned_candidates_last():
+    candidates = [
+        dict(instruction="a", score=40.0, abandoned=False),
+        dict(instruction="b", score=90.0, abandoned=True),
+        dict(instruction="c", score=60.0, abandoned=False),
+    ]
+
+    optimizer = SignatureOptimizer()
+    candidates.sort(key=optimizer._rank, reverse=True)
+
+    assert [c["instruction"] for c in candidates] == ["c", "a", "b"]
+    assert optimizer.early_stopping is False
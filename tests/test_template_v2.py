@@ -0,0 +1,211 @@
+import pytest
+
+import dsp
+import dspy
+from dsp.modules.hf_client import _prefix_key
+from dsp.templates.template_v2 import Prompt, TemplateV2, _parse_template
+
+
+def count_demo_renders(monkeypatch):
+    renders = []
+    query = TemplateV2.query
+
+    def counting_query(self, example, is_demo=False):
+        if is_demo:
+            renders.append(example)
+        return query(self, example, is_demo)
+
+    monkeypatch.setattr(TemplateV2, "query", counting_query)
+    return renders
+
+
+def test_predict_renders_its_demos_once(monkeypatch, dummy_lm):
+    renders = count_demo_renders(monkeypatch)
+    predict = dspy.Predict("question -> answer")
+    predict.demos = [dspy.Example(question=f"q{i}?", answer=f"a{i}") for i in range(4)]
+    lm = dummy_lm("Paris")
+
+    with dsp.settings.context(lm=lm):
+        for _ in range(10):
+            assert predict(question="capital of France?").answer == "Paris"
+
+    assert len(renders) == 4
+    assert all(f"q{i}?" in lm.prompts[-1] for i in range(4))
+
+
+def test_changed_demos_are_rendered_again(monkeypatch, dummy_lm):
+    renders = count_demo_renders(monkeypatch)
+    predict = dspy.Predict("question -> answer")
+    predict.demos = [dspy.Example(question=f"q{i}?", answer=f"a{i}") for i in range(4)]
+    lm = dummy_lm("Paris")
+
+    with dsp.settings.context(lm=lm):
+        predict(question="capital of France?")
+
+        predict.demos[0].answer = "changed"
+        predict(question="capital of France?")
+        assert "changed" in lm.prompts[-1]
+
+        predict.demos = predict.demos[:2]
+        predict(question="capital of France?")
+        assert "q3?" not in lm.prompts[-1]
+
+    assert len(renders) == 4 + 4 + 2
+
+
+QA = TemplateV2("Answer.\n\nQuestion: {question} ${q}\n\nReasoning: {rationale} ${r}\n\nAnswer: {answer} ${a}")
+
+
+@pytest.mark.parametrize("release, completion, expected", [
+    (0, "we think.\nAnswer: Paris", dict(rationale="we think.", answer="Paris")),
+    (0, "  we think.  \n\nAnswer:   Paris \n\n---", dict(rationale="we think.", answer="Paris \n\n---")),
+    (20231003, "  we think.  \n\nAnswer:   Paris \n\n---", dict(rationale="we think.", answer="Paris")),
+    (0, "a ---\nAnswer: b ---", dict(rationale="a ---", answer="b ---")),
+    (20231003, "a ---\nAnswer: b ---", dict(rationale="a", answer="b")),
+    (0, "we think.", dict(rationale="we think.")),
+    (0, "", dict()),
+    (0, "\nAnswer: Paris", dict(rationale="Answer: Paris")),
+    (0, "we think.\nAnswer:\nAnswer: x", dict(rationale="we think.", answer="Answer: x")),
+    (0, "Reasoning: nested\nAnswer: x\nQuestion: y", dict(rationale="Reasoning: nested", answer="x\nQuestion: y")),
+])
+def test_extract_splits_completions_on_field_names(release, completion, expected):
+    with dsp.settings.context(release=release):
+        assert dict(QA.extract(dict(question="q?"), completion)) == dict(question="q?", **expected)
+
+
+@pytest.mark.parametrize("release", [0, 20231003])
+def test_extract_all_matches_extract(release):
+    completions = ["we think.\nAnswer: Paris", "a ---\nAnswer: b ---\n\n---", "we think.", "", "\nAnswer: x"]
+
+    with dsp.settings.context(release=release):
+        for example in [dict(question="q?"), dict(question="q?", rationale="given")]:
+            assert QA.extract_all(example, completions) == [QA.extract(example, c) for c in completions]
+            assert dict(QA.extract(example, "we think.\nAnswer: Paris"))["question"] == "q?"
+
+    assert dict(QA.extract(dict(question="q?", rationale="given"), "a ---")) == dict(
+        question="q?", rationale="given", answer="a ---")
+
+
+def test_templates_are_parsed_once_per_string():
+    spec = "Instructions.\n\nText: {text} ${some text}\n\nSummary: {summary} ${a summary}"
+    _parse_template.cache_clear()
+
+    first, second = TemplateV2(spec), TemplateV2(spec)
+
+    assert _parse_template.cache_info().misses == 1 and _parse_template.cache_info().hits == 1
+    assert first.instructions == "Instructions."
+    assert [(f.name, f.input_variable, f.description) for f in first.fields] == [
+        ("Text:", "text", "${some text}"), ("Summary:", "summary", "${a summary}"),
+    ]
+
+    # Each template owns its fields, which optimizers edit in place.
+    first.fields[-1] = first.fields[-1]._replace(name="Abstract:")
+    assert second.fields[-1].name == "Summary:"
+
+
+def qa_predict():
+    predict = dspy.Predict("question -> answer")
+    predict.demos = [dspy.Example(question="a long question " * 100 + "?", answer="long")]
+    predict.demos += [dspy.Example(question=f"q{i}?", answer=f"a{i}") for i in range(3)]
+    return predict
+
+
+def test_demos_are_packed_into_the_token_budget(dummy_lm):
+    predict, lm = qa_predict(), dummy_lm("Paris")
+
+    with dsp.settings.context(lm=lm):
+        dsp.reset_prompt_stats()
+        predict(question="capital of France?")
+        unbounded = dsp.prompt_stats()
+
+        assert (unbounded.demos, unbounded.dropped_demos) == (4, 0)
+        assert unbounded.prompt_tokens == lm.count_tokens(lm.prompts[-1])
+
+        budget = unbounded.prompt_tokens - 50
+
+        with dsp.settings.context(max_prompt_tokens=budget):
+            dsp.reset_prompt_stats()
+            predict(question="capital of France?")
+            packed = dsp.prompt_stats()
+
+    # The long demo is skipped, and the shorter ones after it still get in.
+    assert "a long question" not in lm.prompts[-1]
+    assert all(f"q{i}?" in lm.prompts[-1] for i in range(3))
+    assert (packed.demos, packed.dropped_demos) == (3, 1)
+    assert packed.prompt_tokens <= budget
+
+
+def test_the_budget_defaults_to_what_the_context_window_leaves(dummy_lm):
+    predict, lm = qa_predict(), dummy_lm("Paris")
+    example = dsp.Example(question="capital of France?", demos=predict.demos)
+    lm.context_window = 300
+
+    with dsp.settings.context(lm=lm):
+        _, counts = predict.signature.render(example)
+
+    assert counts.budget == 300 - lm.kwargs["max_tokens"]
+    assert counts.dropped_demos == 1 and counts.prompt_tokens <= counts.budget
+
+
+def test_prompts_without_a_budget_are_unchanged(dummy_lm):
+    predict = qa_predict()
+    example = dsp.Example(question="capital of France?", demos=predict.demos)
+
+    with dsp.settings.context(lm=dummy_lm()):
+        prompt, counts = predict.signature.render(example)
+
+        assert prompt == predict.signature(example)
+        assert counts.budget is None and counts.dropped_demos == 0
+
+
+def render_qa(demos, context, **settings):
+    predict = dspy.Predict("context, question -> answer")
+    example = dsp.Example(context=context, question="what?", demos=demos)
+
+    with dsp.settings.context(**settings):
+        return predict.signature.render(example)
+
+
+@pytest.fixture
+def qa_lm(dummy_lm):
+    with dsp.settings.context(lm=dummy_lm()):
+        yield
+
+
+PARTIAL_DEMOS = [dspy.Example(question=f"q{i}?", answer=f"a{i}") for i in range(3)]
+
+
+def test_prefix_stable_prompts_share_everything_before_the_query(qa_lm):
+    for prefix_stable in (False, True):
+        (short, _), (long, counts) = [
+            render_qa(PARTIAL_DEMOS, context, prefix_stable=prefix_stable) for context in ["short", ["p1", "p2", "p3"]]
+        ]
+
+        # A query with more lines than the template has fields otherwise moves the demos before the format.
+        assert (short[:short.prefix_length] == long[:long.prefix_length]) == prefix_stable
+        assert long[long.prefix_length:].startswith("Context:\n[1] «p1»") and counts.prefix_tokens > 0
+
+    default, _ = render_qa(PARTIAL_DEMOS, "short")
+    assert default == dspy.Predict("context, question -> answer").signature(
+        dsp.Example(context="short", question="what?", demos=PARTIAL_DEMOS))
+
+
+def test_prefix_stable_packing_drops_trailing_demos_first(qa_lm):
+    demos = PARTIAL_DEMOS + [dspy.Example(question="a long question " * 5 + "?", answer="long")]
+    _, counts = render_qa(demos, "short", prefix_stable=True)
+
+    long, counts = render_qa(demos, "long " * 8, prefix_stable=True, max_prompt_tokens=counts.prompt_tokens)
+
+    assert [f"q{i}?" in long for i in range(3)] + ["a long question" in long] == [True, True, True, False]
+    assert counts.dropped_demos == 1
+
+    without_the_last, _ = render_qa(demos[:3], "short", prefix_stable=True)
+    assert long[:long.prefix_length] == without_the_last[:without_the_last.prefix_length]
+
+
+def test_clients_route_on_the_marked_prefix():
+    prompt = Prompt("prefix, then query", prefix_length=len("prefix, "))
+
+    assert _prefix_key(prompt) == "prefix, "
+    assert _prefix_key("an unmarked prompt") is None
+    assert _prefix_key(Prompt(prompt + " continued", prompt.prefix_length)) == "prefix, "